@@ -6,7 +6,8 @@
 
 import logging
 from flask import Flask
-from .extensions import db, migrate, login_manager, scheduler
+from .extensions import db, migrate, login_manager, scheduler, browser_pool, page_fetcher, host_rate_limiter, fetch_timeouts, \
+    smtp_pool, telegram_sender, page_cache
 
 from config import ProductionConfig, LOG_FILE
 
@@ -54,9 +55,43 @@ def create_app(config_class=ProductionConfig):
     login_manager.init_app(app)
     login_manager.login_view = 'auth.login'
 
+    browser_pool.init_app(app)
+    page_fetcher.init_app(app)
+    page_cache.init_app(app)
+    host_rate_limiter.init_app(app)
+    fetch_timeouts.init_app(app)
+    smtp_pool.init_app(app)
+    telegram_sender.init_app(app)
+
     scheduler.init_app(app)
 
     from . import tasks
+    if app.config['OUTBOX_DISPATCH']:
+        # Sends the emails queued by the routes and the check runs
+        from app.outbox import DISPATCH_JOB_ID
+        scheduler.add_job(
+            func=tasks.dispatch_outbox,
+            trigger="interval",
+            seconds=app.config['OUTBOX_POLL_SECONDS'],
+            id=DISPATCH_JOB_ID,
+            name="Sending the queued emails ...",
+            replace_existing=True,
+            max_instances=1,
+            coalesce=True,
+        )
+    if app.config['VALIDATION_DISPATCH']:
+        # Validates the ads added/updated on the dashboard
+        from app.validation_jobs import VALIDATION_JOB_ID
+        scheduler.add_job(
+            func=tasks.run_validations,
+            trigger="interval",
+            seconds=app.config['VALIDATION_POLL_SECONDS'],
+            id=VALIDATION_JOB_ID,
+            name="Validating the added/updated ads ...",
+            replace_existing=True,
+            max_instances=1,
+            coalesce=True,
+        )
     scheduler.start()
 
     from . import events
@@ -4,15 +4,20 @@
 #
 from flask import render_template, url_for, redirect, flash, current_app, request
 from flask_login import login_required, current_user
-from sqlalchemy import desc
+from sqlalchemy import desc, or_
+from sqlalchemy.orm import joinedload
 import logging
 from datetime import datetime
 
 from app.models.user import User, MonitoredAd
-from app.extensions import db, scheduler
+from app.models.domain import DomainProfile
+from app.extensions import db, scheduler, page_cache
+from app.models.outbox import OutboxEmail
+from app.outbox import queue_email, requeue_email, outbox_stats
+from app.validation_jobs import queue_validation, KIND_REFRESH
 from app.forms.admin_forms import EmailForm
 from app.utils.decorators import admin_required, indrajit_only
-from scripts.utils import convert_utc_to_ist, get_lines_in_reverse, count_query_occurrences_and_hash
+from scripts.utils import convert_utc_to_ist, get_lines_in_reverse
 from scripts.email_message import EmailMessage
 from config import EmailConfig, LOG_FILE
 
@@ -27,8 +32,11 @@ def home():
     if current_user.is_admin or current_user.email == EmailConfig.INDRAJIT912_GMAIL:
         # Retrieve all users and monitored ads from the database
         users = User.query.order_by(desc(User.created_at)).all()
-        monitored_ads = MonitoredAd.query.order_by(desc(MonitoredAd.created_at)).all()
+        monitored_ads = MonitoredAd.query.options(joinedload(MonitoredAd.target)).order_by(desc(MonitoredAd.created_at)).all()
         adv_job = scheduler.get_job("check_adv_count_job")
+        breaker_domains = DomainProfile.query.filter(
+            or_(DomainProfile.consecutive_failures > 0, DomainProfile.breaker_opens > 0)
+        ).order_by(desc(DomainProfile.breaker_open_until), desc(DomainProfile.consecutive_failures)).all()
         logger.info(f"Admin dashboard visited by the admin '{current_user.email}'.")
 
         return render_template(
@@ -36,6 +44,9 @@ def home():
             users=users, 
             monitored_ads=monitored_ads, 
             adv_job = adv_job,
+            breaker_domains=breaker_domains,
+            page_cache_stats=dict(page_cache.stats),
+            now=datetime.utcnow(),
             convert_utc_to_ist=convert_utc_to_ist,
             indrajit=EmailConfig.INDRAJIT912_GMAIL
         )
@@ -114,12 +125,8 @@ def toggle_admin(user_id):
     )
 
     try:
-        # Send the email to Indrajit
-        msg.send(
-            sender_email_password=EmailConfig.INDRAJITS_BOT_EMAIL_PASSWD, 
-            server_info=EmailConfig.GMAIL_SERVER,
-            print_success_status=False
-        )
+        # Queue the email to the user
+        queue_email(msg, kind='admin_status')
 
         flash(f'Admin status for user {user.fullname} has been updated.', 'success')
         logger.info(f"Admin status for user '{user.fullname}' has been updated.")
@@ -137,27 +144,14 @@ def toggle_admin(user_id):
 def update_user_ad(ad_id):
     ad_to_update = MonitoredAd.query.get_or_404(ad_id)
 
-    occurrence_count, page_hash = count_query_occurrences_and_hash(url=ad_to_update.website_url, query_str=ad_to_update.advertisement_number)
-
-    if occurrence_count > 0:
-        # Everything fine!
-        ad_to_update.occurrence_count = occurrence_count
-        ad_to_update.page_content_hash = page_hash
-        ad_to_update.last_updated = datetime.utcnow()
-
-        try:
-            db.session.commit()
-            flash("User advertisement updated successfully.", 'success')
-            logger.info(f"User entry updated by the admin '{current_user.email}'.")
-            return redirect(url_for('admin.home'))
-        
-        except:
-            flash("Error. Looks like there was a problem updating the information into the database.", 'danger')
-            return redirect(url_for('admin.home'))
-    else:
-        flash(f"Error occurred during the update!")
-        logger.error(f"Error occurred while updating the adv with id `{ad_id}`")
-        return redirect(url_for('admin.home'))
+    # The count and the hash are refreshed by a validation job.
+    try:
+        job = queue_validation(KIND_REFRESH, user_id=current_user.id, ad=ad_to_update)
+        flash("The update of the user advertisement is queued; it is done in a few seconds.", 'success')
+        logger.info(f"User entry update queued by the admin '{current_user.email}' (job '{job.id}').")
+    except:
+        flash("Error. Looks like there was a problem updating the information into the database.", 'danger')
+    return redirect(url_for('admin.home'))
     
 @admin_bp.route('/logs')
 @login_required
@@ -174,6 +168,38 @@ def logs():
         return render_template('log_error.html', error_message="Error reading log file")
 
 
+@admin_bp.route('/outbox')
+@login_required
+@admin_required
+def outbox():
+    # The latest emails of the outbox (of one status if asked)
+    status = request.args.get('status')
+    query = OutboxEmail.query
+    if status:
+        query = query.filter_by(status=status)
+    emails = query.order_by(desc(OutboxEmail.created_at)).limit(200).all()
+
+    return render_template(
+        'outbox.html',
+        emails=emails,
+        stats=outbox_stats(),
+        status=status,
+        convert_utc_to_ist=convert_utc_to_ist
+    )
+
+
+@admin_bp.route('/outbox/requeue/<int:email_id>', methods=['POST'])
+@login_required
+@admin_required
+def requeue_outbox_email(email_id):
+    if requeue_email(email_id):
+        flash(f"Email {email_id} put back on the outbox.", 'success')
+        logger.info(f"Outbox email {email_id} requeued by the admin '{current_user.email}'.")
+    else:
+        flash(f"There is no email {email_id} in the outbox.", 'warning')
+    return redirect(url_for('admin.outbox', status=request.args.get('status')))
+
+
 @admin_bp.route('/send_email', methods=['GET', 'POST'])
 @login_required
 @indrajit_only
@@ -204,12 +230,8 @@ def send_email():
         )
 
         try:
-            # Send the email to Indrajit
-            msg.send(
-                sender_email_password=EmailConfig.INDRAJITS_BOT_EMAIL_PASSWD,
-                server_info=EmailConfig.GMAIL_SERVER,
-                print_success_status=False
-            )
+            # Queue the email to the user(s)
+            queue_email(msg, kind='broadcast')
 
             form = EmailForm(formdata=None)
         
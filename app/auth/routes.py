@@ -6,6 +6,7 @@
 from flask import render_template, url_for, redirect, flash, request, jsonify
 from flask_login import login_required, login_user, logout_user, current_user
 from sqlalchemy import desc
+from sqlalchemy.orm import joinedload
 from datetime import datetime
 import logging
 
@@ -13,9 +14,13 @@ from app.forms.auth_forms import EmailRegistrationForm, UserRegistrationForm, Us
 from app.models.user import User, MonitoredAd
 from app.models.report import Report
 from app.extensions import db
+from app.outbox import queue_email
+from app.models.validation_job import ValidationJob
+from app.validation_jobs import queue_validation, validation_status as job_validation_status, KIND_ADD, KIND_UPDATE
+from app.utils.database_helpers import find_duplicate_ad
 from app.utils.decorators import logout_required
 from app.utils.token import get_token_for_email_registration, confirm_email_registration_token
-from scripts.utils import convert_utc_to_ist, count_query_occurrences_and_hash
+from scripts.utils import convert_utc_to_ist
 from scripts.email_message import EmailMessage
 from config import EmailConfig
 from . import auth_bp
@@ -79,11 +84,7 @@ def forgot_password():
             )
 
             try:
-                msg.send(
-                    sender_email_password=EmailConfig.INDRAJITS_BOT_EMAIL_PASSWD,
-                    server_info=EmailConfig.GMAIL_SERVER,
-                    print_success_status=False
-                )
+                queue_email(msg, kind='password_reset')
 
                 flash('Password reset instructions sent to your email. Please check and follow the link.', 'info')
                 logger.info(f"Password reset instructions sent to '{user.email}'.")
@@ -156,11 +157,7 @@ def register_email():
             )
 
             try:
-                msg.send(
-                    sender_email_password=EmailConfig.INDRAJITS_BOT_EMAIL_PASSWD,
-                    server_info=EmailConfig.GMAIL_SERVER,
-                    print_success_status=False
-                )
+                queue_email(msg, kind='registration')
 
                 flash('Almost there! New account registration instructions sent to your email. Please check and follow the link.', 'info')
                 logger.info(f"New acc registration instruction sent over email to '{form.email.data}'.")
@@ -229,7 +226,8 @@ def register_user(token):
 @login_required
 def dashboard():
     user = current_user
-    user_ads = MonitoredAd.query.filter_by(user_id=current_user.id).order_by(desc(MonitoredAd.last_updated)).all()
+    user_ads = MonitoredAd.query.options(joinedload(MonitoredAd.target)) \
+        .filter_by(user_id=current_user.id).order_by(desc(MonitoredAd.last_updated)).all()
     return render_template('dashboard.html', user=user, user_ads=user_ads, convert_utc_to_ist=convert_utc_to_ist)
 
 @auth_bp.route('/logout', methods=['GET', 'POST'])
@@ -249,41 +247,32 @@ def add_advertisement():
         # Get the data from the POST request
         title = request.form.get('title')
         advertisement_number = request.form.get('advertisement_number')
-        website_url = request.form.get('website_url')
+        website_url = (request.form.get('website_url') or '').strip()
         description = request.form.get('description')
 
-        # Calculate the count
-        occurrence_count, page_hash = count_query_occurrences_and_hash(url=website_url, query_str=advertisement_number)
-        
-        if occurrence_count > 0 and page_hash:
-            # Everything is fine!
-
-            ad_user_id = current_user.id
-
-            monitored_ad = MonitoredAd(
-                title=title,
-                advertisement_number = advertisement_number,
-                website_url = website_url,
-                description=description,
-                occurrence_count=occurrence_count,
-                page_content_hash=page_hash,
-                last_updated=datetime.utcnow(),
-                user_id = ad_user_id
-            )
-
-            # Add the new advertisement to the database
-            db.session.add(monitored_ad)
-            db.session.commit()
-
-            # Return a success response
-            flash("Advertisement entry added successfully!", 'success')
-            logger.info(f"User '{current_user.email}' added one entry to their dashboard.")
-            return jsonify({'success': True}), 200
-        
-        else:
-            # Error in the URL
-            flash("An error occurred while trying to access the webpage. Please verify that the URL is valid also the adv num is present on the webpage.", 'error')
-            return jsonify({'error': False}), 500
+        if not (title and advertisement_number and website_url):
+            return jsonify({'error': 'The title, the advertisement number and the url are required.'}), 400
+
+        # The same page may be entered as http/https, with 'www.', a trailing slash, ...
+        duplicate = find_duplicate_ad(current_user.id, website_url, advertisement_number)
+        if duplicate is not None:
+            flash(f"You already track this advertisement as '{duplicate.title}'.", 'warning')
+            return jsonify({'error': 'The advertisement is already on your dashboard.'}), 409
+
+        # The page is checked by a validation job; the ad is added once the
+        # advertisement number is found on it.
+        job = queue_validation(
+            KIND_ADD,
+            user_id=current_user.id,
+            title=title,
+            advertisement_number=advertisement_number,
+            website_url=website_url,
+            description=description
+        )
+        logger.info(f"User '{current_user.email}' asked to add one entry to their dashboard (job '{job.id}').")
+        return jsonify(
+            {'job_id': job.id, 'status_url': url_for('auth.validation_status', job_id=job.id)}
+        ), 202
         
     except Exception as e:
         # Handle any errors that may occur during the process
@@ -292,6 +281,23 @@ def add_advertisement():
         return jsonify({'error': str(e)}), 500
 
 
+@auth_bp.route('/validation_status/<job_id>')
+@login_required
+def validation_status(job_id):
+    """
+    The status of a validation job (see `app.validation_jobs`), polled by the
+    dashboard. The outcome is flashed once the job is finished.
+    """
+    job = ValidationJob.query.get_or_404(job_id)
+    if job.user_id != current_user.id and not current_user.is_admin:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    status = job_validation_status(job)
+    if job.finished and request.args.get('flash'):
+        flash(job.message, 'success' if status['success'] else 'warning')
+    return jsonify(status)
+
+
 @auth_bp.route('/delete_ad/<int:id>')
 @login_required
 def delete_ad(id):
@@ -327,43 +333,35 @@ def update_advertisement():
     ad_id = int(request.json['adId'])
     ad_title = request.json['advTitle']
     adv_num = request.json['advNum']
-    adv_url = request.json['advUrl']
+    adv_url = request.json['advUrl'].strip()
     adv_desc = request.json['advDesc']
 
     ad_to_update = MonitoredAd.query.get_or_404(ad_id)
     if ad_to_update.user_id == current_user.id:
-        # Check the occurrence count
-        occurrence_count, page_hash = count_query_occurrences_and_hash(url=adv_url, query_str=adv_num)
-
-        if occurrence_count > 0:
-            # Everything fine!
-            ad_to_update.title = ad_title
-            ad_to_update.advertisement_number = adv_num
-            ad_to_update.website_url = adv_url
-            ad_to_update.description = adv_desc
-            ad_to_update.occurrence_count = occurrence_count
-            ad_to_update.page_content_hash = page_hash
-            ad_to_update.last_updated = datetime.utcnow()
-
-            try:
-                db.session.commit()
-                flash("The advertisement updated successfully.", 'success')
-                logger.info(f"User entry updated by the user '{current_user.email}'.")
-                return jsonify({'message': 'Advertisement updated successfully!'})
-
-            except:
-                flash("Error. Looks like there was a problem updating the information into the database.", 'danger')
-                return jsonify({'error': 'Database error'})
-
-        elif occurrence_count == 0:
-            # Adv num is not on the page.
-            flash(f"The advertisement with the number '{adv_num}' is not present on the webpage. Please retry with a different advertisement number.", 'warning')
-            return jsonify({'error': 'Advertisement not found'})
-
-        else:
-            # Error in the URL
-            flash("An error occurred while trying to access the webpage. Please verify that the URL is valid.", 'error')
-            return jsonify({'error': 'URL error'})
+        duplicate = find_duplicate_ad(current_user.id, adv_url, adv_num, exclude_id=ad_id)
+        if duplicate is not None:
+            return jsonify({'error': f"You already track this advertisement as '{duplicate.title}'."})
+
+        # The ad is updated by a validation job once the advertisement
+        # number is found on the page.
+        try:
+            job = queue_validation(
+                KIND_UPDATE,
+                user_id=current_user.id,
+                ad=ad_to_update,
+                title=ad_title,
+                advertisement_number=adv_num,
+                website_url=adv_url,
+                description=adv_desc
+            )
+        except:
+            flash("Error. Looks like there was a problem updating the information into the database.", 'danger')
+            return jsonify({'error': 'Database error'})
+
+        logger.info(f"User '{current_user.email}' asked to update an entry (job '{job.id}').")
+        return jsonify(
+            {'job_id': job.id, 'status_url': url_for('auth.validation_status', job_id=job.id)}
+        ), 202
     else:
         flash("You are not authorized to make that request.", 'warning')
         return jsonify({'error': 'Unauthorized'})
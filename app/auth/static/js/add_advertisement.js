@@ -29,28 +29,21 @@ $(document).ready(function () {
     // Show spinner before making the request
     toggleSpinner();
 
-    // Send a POST request using jQuery
+    // Send a POST request using jQuery; the server answers with the id of
+    // the validation job which adds the advertisement.
     $.post(addAdvertisementUrl, formData, function (data) {
-      // Handle the response data (if needed)
       console.log(data);
 
-      // Check if the response indicates success (you may need to adjust this based on your server response)
-      if (data.success) {
-        // Redirect to auth.dashboard
+      // Wait for the validation (the outcome is flashed on the dashboard)
+      pollValidationJob(data.status_url, function (status) {
+        toggleSpinner();
         window.location.href = dashboardUrl;
-      }
+      });
     })
     .fail(function (error) {
       console.error('Error:', error);
+      toggleSpinner();
       window.location.href = dashboardUrl;
-    })
-    .always(function () {
-      // Hide spinner after the request is complete
-      // You may want to handle success or failure conditions appropriately
-      // For simplicity, I'm hiding the spinner after a delay in this example
-      setTimeout(function () {
-        toggleSpinner();
-      }, 7000); // Adjust the delay as needed
     });
   });
 });
@@ -41,20 +41,21 @@ function updateDashboardAdvertisement(adId) {
     })
     .then(response => response.json())
     .then(data => {
-        // Handle the response...
-        handleUpdateResponse(data);
+        if ('error' in data) {
+            // Show error message
+            alert('Error: ' + data.error);
+            handleUpdateResponse(data);
+            return;
+        }
 
-        // Check for success or error
-        if ('message' in data) {
-            // Show success message
-            alert('Advertisement updated successfully!');
+        // Wait for the validation job which updates the advertisement
+        pollValidationJob(data.status_url, function (status) {
             // Close the modal
             var modal = new bootstrap.Modal(document.getElementById('updateModal' + adId));
             modal.hide();
-        } else if ('error' in data) {
-            // Show error message
-            alert('Error: ' + data.error);
-        }
+            // (The outcome is flashed on the reloaded dashboard.)
+            handleUpdateResponse(status);
+        });
     })
     .catch(error => {
         console.error('Error:', error);
@@ -0,0 +1,27 @@
+// validation_job.js
+
+// Polls the status of a validation job (see `auth.validation_status`) until
+// it is finished, then calls `onFinished` with the final status. The outcome
+// is flashed by the server on the last poll.
+function pollValidationJob(statusUrl, onFinished, interval) {
+  interval = interval || 1500;
+
+  function poll() {
+    fetch(statusUrl + '?flash=1')
+      .then(response => response.json())
+      .then(data => {
+        if (data.finished) {
+          onFinished(data);
+        } else {
+          setTimeout(poll, interval);
+        }
+      })
+      .catch(error => {
+        console.error('Error:', error);
+        setTimeout(poll, interval * 2);
+      });
+  }
+
+  // The first poll must not flash an unfinished job, so it waits a bit.
+  setTimeout(poll, interval);
+}
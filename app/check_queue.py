@@ -0,0 +1,434 @@
+# app/check_queue.py
+#
+# Author: Indrajit Ghosh
+# Created On: Mar 05, 2024
+#
+
+"""
+A check queue in the database, so that the checks aren't tied to the Flask
+process running the scheduler.
+
+The scheduled job (or `python manage.py enqueue_checks`) puts every ad on the
+queue; any number of check workers (`python manage.py check_worker`, on any
+host that can reach the database) then lease batches of them, check them and
+mark them done:
+
+    - a batch is all queued ads of a few pages, so no page is fetched by two
+      workers,
+    - leasing is a conditional UPDATE of the claimable rows followed by a read
+      of the rows carrying the worker's lease token, so two workers never get
+      the same ad (this works the same on SQLite and MySQL),
+    - a worker renews its lease with heartbeats while it works; the lease of a
+      crashed worker expires and its ads are leased again by another worker,
+    - an ad whose lease expired `max_attempts` times is marked as failed.
+
+The checks are at-least-once: an ad whose worker dies after notifying the
+user but before finishing its batch is checked again. The ads a check
+defers (see `CHECK_RUN_DEADLINE`) go back on the queue.
+
+The workers don't notify the users batch by batch: the changes they find
+are held (see `HeldNotification`) until none of a user's ads is queued
+anymore, and then go out as one notification per user and cycle.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from sqlalchemy import and_, bindparam, insert, or_, select, update
+from sqlalchemy.orm import joinedload
+
+from app.extensions import db
+from app.models.check_job import CheckJob, HeldNotification
+from app.models.user import MonitoredAd, User
+from scripts.utils import canonicalize_url
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = 'pending'
+STATUS_LEASED = 'leased'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+def _claimable(now):
+    return or_(
+        CheckJob.status == STATUS_PENDING,
+        and_(CheckJob.status == STATUS_LEASED, CheckJob.lease_expires_at < now)
+    )
+
+
+def enqueue_checks(ad_ids=None, window_size: int = 1000):
+    """
+    Puts the ads (all of them by default) on the check queue. Ads which are
+    currently leased by a worker are left alone.
+
+    The ads are queued `window_size` at a time (read with keyset pagination,
+    their jobs inserted and reset in bulk), so neither the ads nor their jobs
+    ever sit in memory all at once.
+
+    Parameters:
+    - ad_ids (list, optional): The ids of the ads to queue.
+    - window_size (int, optional): The ads queued per statement.
+
+    Returns:
+    int: The number of ads put on the queue.
+    """
+    columns = (MonitoredAd.id, MonitoredAd.normalized_url, MonitoredAd.website_url)
+
+    enqueued = 0
+    if ad_ids is not None:
+        ad_ids = sorted(set(ad_ids))
+        for i in range(0, len(ad_ids), window_size):
+            rows = db.session.execute(select(*columns).where(MonitoredAd.id.in_(ad_ids[i:i + window_size]))).all()
+            enqueued += _enqueue_window(rows)
+        return enqueued
+
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(*columns).where(MonitoredAd.id > last_id).order_by(MonitoredAd.id).limit(window_size)
+        ).all()
+        if not rows:
+            return enqueued
+        enqueued += _enqueue_window(rows)
+        last_id = rows[-1].id
+
+
+def _enqueue_window(rows):
+    """
+    Queues the ads of a window [(id, normalized_url, website_url), ...]: a
+    bulk INSERT of the jobs they don't have yet and a bulk UPDATE resetting
+    the others (unless a worker holds them).
+    """
+    now = datetime.utcnow()
+    urls = {row.id: row.normalized_url or canonicalize_url(row.website_url) for row in rows}
+    jobs = {
+        job.ad_id: job
+        for job in db.session.execute(
+            select(CheckJob.ad_id, CheckJob.status, CheckJob.lease_expires_at).where(CheckJob.ad_id.in_(list(urls)))
+        )
+    }
+
+    queued = dict(
+        status=STATUS_PENDING, attempts=0, lease_token=None, leased_by=None, lease_expires_at=None,
+        heartbeat_at=None, enqueued_at=now, finished_at=None, last_error=None
+    )
+    new_jobs = [{'ad_id': ad_id, 'url': url, **queued} for ad_id, url in urls.items() if ad_id not in jobs]
+    requeued = [
+        {'_ad_id': ad_id, '_url': urls[ad_id]}
+        for ad_id, job in jobs.items()
+        if not (job.status == STATUS_LEASED and job.lease_expires_at and job.lease_expires_at >= now)
+    ]
+
+    table = CheckJob.__table__
+    if new_jobs:
+        db.session.execute(insert(table), new_jobs)
+    if requeued:
+        db.session.execute(
+            update(table)
+            .where(table.c.ad_id == bindparam('_ad_id'))
+            # (Not one a worker leased in the meantime)
+            .where(or_(table.c.status != STATUS_LEASED, table.c.lease_expires_at < now))
+            .values(url=bindparam('_url'), **queued),
+            requeued
+        )
+    db.session.commit()
+    return len(new_jobs) + len(requeued)
+
+
+def fail_exhausted_jobs(max_attempts: int):
+    """
+    Marks the jobs whose lease expired `max_attempts` times as failed.
+
+    Returns:
+    int: The number of failed jobs.
+    """
+    now = datetime.utcnow()
+    failed = CheckJob.query.filter(
+        CheckJob.status == STATUS_LEASED,
+        CheckJob.lease_expires_at < now,
+        CheckJob.attempts >= max_attempts
+    ).update(
+        {
+            CheckJob.status: STATUS_FAILED,
+            CheckJob.lease_token: None,
+            CheckJob.finished_at: now,
+            CheckJob.last_error: "The lease expired too many times."
+        },
+        synchronize_session=False
+    )
+    db.session.commit()
+    return failed
+
+
+def claim_batch(worker_id: str, pages: int, lease_seconds: int):
+    """
+    Leases the queued ads of up to `pages` pages for the worker.
+
+    Returns:
+    (lease_token, [ad_id, ...]); the list is empty if nothing could be leased.
+    """
+    now = datetime.utcnow()
+
+    urls = [
+        url for (url,) in db.session.query(CheckJob.url)
+        .filter(_claimable(now))
+        .group_by(CheckJob.url)
+        .order_by(db.func.min(CheckJob.id))
+        .limit(pages)
+    ]
+    if not urls:
+        db.session.commit()
+        return None, []
+
+    lease_token = uuid4().hex
+    CheckJob.query.filter(CheckJob.url.in_(urls), _claimable(now)).update(
+        {
+            CheckJob.status: STATUS_LEASED,
+            CheckJob.lease_token: lease_token,
+            CheckJob.leased_by: worker_id,
+            CheckJob.lease_expires_at: now + timedelta(seconds=lease_seconds),
+            CheckJob.heartbeat_at: now,
+            CheckJob.attempts: CheckJob.attempts + 1
+        },
+        synchronize_session=False
+    )
+    db.session.commit()
+
+    # Whatever another worker leased in between didn't get our token.
+    ad_ids = [ad_id for (ad_id,) in db.session.query(CheckJob.ad_id).filter_by(lease_token=lease_token)]
+    db.session.commit()
+    return lease_token, ad_ids
+
+
+def renew_lease(engine, lease_token: str, lease_seconds: int):
+    """
+    Extends the lease of a batch. Uses its own connection, so it can be
+    called from a heartbeat thread.
+
+    Returns:
+    int: The number of jobs still held under the lease.
+    """
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        result = conn.execute(
+            update(CheckJob.__table__)
+            .where(CheckJob.__table__.c.lease_token == lease_token)
+            .where(CheckJob.__table__.c.status == STATUS_LEASED)
+            .values(lease_expires_at=now + timedelta(seconds=lease_seconds), heartbeat_at=now)
+        )
+    return result.rowcount
+
+
+def finish_batch(lease_token: str, error: str = None, max_attempts: int = 3):
+    """
+    Marks the jobs of a batch as done; if the batch failed (`error`) they go
+    back to the queue, or are marked as failed once they ran out of attempts.
+    """
+    now = datetime.utcnow()
+    held = CheckJob.query.filter_by(lease_token=lease_token, status=STATUS_LEASED)
+
+    if error is None:
+        held.update(
+            {CheckJob.status: STATUS_DONE, CheckJob.lease_token: None, CheckJob.finished_at: now},
+            synchronize_session=False
+        )
+    else:
+        held.filter(CheckJob.attempts >= max_attempts).update(
+            {CheckJob.status: STATUS_FAILED, CheckJob.lease_token: None, CheckJob.finished_at: now, CheckJob.last_error: error},
+            synchronize_session=False
+        )
+        held.update(
+            {CheckJob.status: STATUS_PENDING, CheckJob.lease_token: None, CheckJob.lease_expires_at: None, CheckJob.last_error: error},
+            synchronize_session=False
+        )
+    db.session.commit()
+
+
+def hold_notifications(listing: dict):
+    """
+    Holds the notifications of a checked batch (a `notify_user` listing)
+    until the users' other queued checks are done (see `release_notifications`).
+
+    Returns:
+    dict: No telegram messages were sent (the outcome `notify_user` returns).
+    """
+    users = {user.email: user.id for user in User.query.filter(User.email.in_(list(listing)))}
+    now = datetime.utcnow()
+    rows = [
+        {'user_id': users[email], 'adv_url': ad['adv_url'], 'adv_num': ad['adv_num'],
+         'adv_title': ad['adv_title'], 'adv_count': ad['adv_count'], 'created_at': now}
+        for email, val in listing.items() if email in users
+        for ad in val['ads']
+    ]
+    if rows:
+        db.session.execute(insert(HeldNotification.__table__), rows)
+        db.session.commit()
+    return {'sent': 0, 'failed': 0, 'rate_limited': 0, 'retries': 0}
+
+
+def release_notifications(notify, lease_seconds: int):
+    """
+    Sends the held notifications of the users none of whose ads is queued or
+    being checked anymore: one `notify(listing)` (see `notify_user`) for all
+    of them, every user listing all of their held changes at once. The held
+    rows are leased first, so two workers never send the same ones.
+
+    Returns:
+    int: The number of users notified.
+    """
+    now = datetime.utcnow()
+    busy_users = select(MonitoredAd.user_id).join(CheckJob, CheckJob.ad_id == MonitoredAd.id) \
+        .where(CheckJob.status.in_([STATUS_PENDING, STATUS_LEASED]))
+
+    lease_token = uuid4().hex
+    HeldNotification.query.filter(
+        HeldNotification.user_id.notin_(busy_users),
+        or_(HeldNotification.lease_token.is_(None), HeldNotification.lease_expires_at < now)
+    ).update(
+        {HeldNotification.lease_token: lease_token, HeldNotification.lease_expires_at: now + timedelta(seconds=lease_seconds)},
+        synchronize_session=False
+    )
+    db.session.commit()
+
+    held = HeldNotification.query.filter_by(lease_token=lease_token).order_by(HeldNotification.id).all()
+    if not held:
+        return 0
+
+    users = {user.id: user for user in User.query.filter(User.id.in_({row.user_id for row in held}))}
+    listing = {}
+    for row in held:
+        user = users.get(row.user_id)
+        if user is None:
+            continue
+        listing.setdefault(
+            user.email, {'name': user.fullname, 'telegram': user.telegram if user.telegram else '', 'ads': []}
+        )['ads'].append(
+            {'adv_url': row.adv_url, 'adv_num': row.adv_num, 'adv_title': row.adv_title, 'adv_count': row.adv_count}
+        )
+
+    if listing:
+        notify(listing)
+    HeldNotification.query.filter_by(lease_token=lease_token).delete(synchronize_session=False)
+    db.session.commit()
+    return len(listing)
+
+
+def queue_stats():
+    """Returns the number of jobs per status {status: count}."""
+    return dict(db.session.query(CheckJob.status, db.func.count(CheckJob.id)).group_by(CheckJob.status).all())
+
+
+class CheckWorker:
+    """
+    Leases batches of ads from the check queue and checks them until the
+    queue is empty (or forever).
+
+    Parameters:
+    -----------
+        `app`: The Flask app
+        `check`: `callable`; (Checks a list of ads: `check(ads, config, notify=...)`, returning the stats of `check_ads`)
+        `notify`: `callable`; (Sends a listing of changed ads, see `notify_user`)
+        `worker_id`: `str`; (Defaults to `host:pid`)
+        `batch_pages`: `int`; (Pages leased at once)
+        `lease_seconds`: `int`; (How long a lease lasts without a heartbeat)
+        `max_attempts`: `int`; (Leases of an ad before it is marked as failed)
+        `poll_interval`: `float`; (Seconds to wait when the queue is empty)
+    """
+
+    def __init__(self, app, check, notify, worker_id=None, batch_pages=None, lease_seconds=None,
+                 max_attempts=None, poll_interval=None):
+        config = app.config
+        self.app = app
+        self.check = check
+        self.notify = notify
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.batch_pages = batch_pages or config['CHECK_QUEUE_BATCH_PAGES']
+        self.lease_seconds = lease_seconds or config['CHECK_QUEUE_LEASE_SECONDS']
+        self.max_attempts = max_attempts or config['CHECK_QUEUE_MAX_ATTEMPTS']
+        self.poll_interval = poll_interval or config['CHECK_QUEUE_POLL_INTERVAL']
+
+    def _heartbeat(self, engine, lease_token, stop):
+        while not stop.wait(self.lease_seconds / 3):
+            try:
+                if renew_lease(engine, lease_token, self.lease_seconds) == 0:
+                    logger.warning(f"CHECK_WORKER: {self.worker_id} lost the lease '{lease_token}'.")
+                    return
+            except Exception as e:
+                logger.error(f"CHECK_WORKER: Heartbeat of {self.worker_id} failed. \t {e}")
+
+    def run_batch(self):
+        """
+        Leases and checks one batch.
+
+        Returns:
+        int: The number of ads checked (0 if the queue was empty).
+        """
+        with self.app.app_context():
+            fail_exhausted_jobs(self.max_attempts)
+            lease_token, ad_ids = claim_batch(self.worker_id, self.batch_pages, self.lease_seconds)
+            if not ad_ids:
+                # (Whatever is still held, e.g. by a worker that died before releasing it)
+                self._release_notifications()
+                return 0
+
+            stop = threading.Event()
+            heartbeat = threading.Thread(
+                target=self._heartbeat, args=(db.engine, lease_token, stop),
+                name="check-worker-heartbeat", daemon=True
+            )
+            heartbeat.start()
+
+            error = None
+            deferred = []
+            try:
+                ads = MonitoredAd.query.options(joinedload(MonitoredAd.user), joinedload(MonitoredAd.target)) \
+                    .filter(MonitoredAd.id.in_(ad_ids)).all()
+                run_stats = self.check(ads, self.app.config, notify=hold_notifications)
+                deferred = (run_stats or {}).get('deferred_ad_ids', [])
+            except Exception as e:
+                db.session.rollback()
+                error = str(e) or type(e).__name__
+                logger.error(f"CHECK_WORKER: {self.worker_id} failed to check a batch of {len(ad_ids)} ads. \t {e}")
+            finally:
+                stop.set()
+                heartbeat.join()
+
+            finish_batch(lease_token, error=error, max_attempts=self.max_attempts)
+            if deferred:
+                enqueue_checks(deferred)
+                logger.info(f"CHECK_WORKER: {self.worker_id} put {len(deferred)} deferred ads back on the queue.")
+            logger.info(f"CHECK_WORKER: {self.worker_id} checked {len(ad_ids)} ads.")
+            self._release_notifications()
+            return len(ad_ids)
+
+    def _release_notifications(self):
+        """Notifies the users whose checks are all done (see `release_notifications`)."""
+        try:
+            notified = release_notifications(self.notify, self.lease_seconds)
+            if notified:
+                logger.info(f"CHECK_WORKER: {self.worker_id} notified {notified} user(s).")
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"CHECK_WORKER: {self.worker_id} failed to send the held notifications. \t {e}")
+
+    def run(self, once=False):
+        """
+        Checks batches until the queue is empty (`once`) or forever.
+
+        Returns:
+        int: The number of ads checked.
+        """
+        checked = 0
+        while True:
+            done = self.run_batch()
+            checked += done
+            if not done:
+                if once:
+                    return checked
+                time.sleep(self.poll_interval)
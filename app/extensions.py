@@ -8,9 +8,20 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_apscheduler import APScheduler
+from scripts.browser_pool import BrowserPool
+from scripts.fetcher import PageFetcher
+from scripts.rate_limiter import host_rate_limiter
+from scripts.timeouts import fetch_timeouts
+from scripts.smtp_pool import SMTPPool
+from scripts.telegram_sender import telegram_sender
+from scripts.page_cache import PageCache
 
 db = SQLAlchemy()
 migrate = Migrate()
 login_manager = LoginManager()
 scheduler = APScheduler()
+browser_pool = BrowserPool()
+page_fetcher = PageFetcher(pool=browser_pool)
+page_cache = PageCache(fetcher=page_fetcher)  # For the on-demand checks
+smtp_pool = SMTPPool()
 
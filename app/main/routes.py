@@ -10,6 +10,7 @@ from flask import flash, redirect, render_template, url_for
 from werkzeug.exceptions import NotFound, InternalServerError, BadRequest, Unauthorized, Forbidden, \
     TooManyRequests
 from app.forms.main_forms import ContactIndrajitForm
+from app.outbox import queue_email
 from scripts.email_message import EmailMessage
 from config import EmailConfig
 
@@ -51,12 +52,8 @@ def contact():
         )
 
         try:
-            # Send the email to Indrajit
-            msg.send(
-                sender_email_password=EmailConfig.INDRAJITS_BOT_EMAIL_PASSWD,
-                server_info=EmailConfig.GMAIL_SERVER,
-                print_success_status=False
-            )
+            # Queue the email to Indrajit
+            queue_email(msg, kind='contact')
 
             form = ContactIndrajitForm(formdata=None)
 
@@ -0,0 +1,57 @@
+# app/models/check_job.py
+# Author: Indrajit Ghosh
+# Created On: Mar 05, 2024
+#
+
+from datetime import datetime
+
+from app.extensions import db
+
+
+class CheckJob(db.Model):
+    """
+    An ad on the check queue. A check worker leases a batch of jobs, keeps
+    the lease alive with heartbeats while it checks them and marks them done
+    at the end; a job whose lease expired (its worker died) can be leased
+    again by any other worker.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    ad_id = db.Column(db.Integer, db.ForeignKey('monitored_ad.id'), unique=True, nullable=False)
+    url = db.Column(db.String(255), nullable=False, index=True)  # The `normalized_url` (canonical url) of the ad
+    status = db.Column(db.String(16), nullable=False, default='pending', index=True)  # pending/leased/done/failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    lease_token = db.Column(db.String(32), nullable=True, index=True)
+    leased_by = db.Column(db.String(100), nullable=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    enqueued_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+
+    ad = db.relationship(
+        'MonitoredAd',
+        backref=db.backref('check_job', uselist=False, cascade="all, delete-orphan")
+    )
+
+    def __repr__(self):
+        return f"<CheckJob(id={self.id}, ad_id={self.ad_id}, status='{self.status}', leased_by='{self.leased_by}')>"
+
+
+class HeldNotification(db.Model):
+    """
+    A change of an ad found by a check worker, held back until every queued
+    check of its user is done: the user then gets the changes of the whole
+    cycle in one notification, however many batches (and workers) found them.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True)  # (No foreign key: a deleted user's rows are dropped on release)
+    adv_url = db.Column(db.String(255), nullable=False)
+    adv_num = db.Column(db.String(100), nullable=False)
+    adv_title = db.Column(db.String(170), nullable=True)
+    adv_count = db.Column(db.Integer, nullable=True)
+    lease_token = db.Column(db.String(32), nullable=True, index=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<HeldNotification(id={self.id}, user_id={self.user_id}, adv_num='{self.adv_num}')>"
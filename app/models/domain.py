@@ -0,0 +1,28 @@
+# app/models/domain.py
+# Author: Indrajit Ghosh
+# Created On: Feb 27, 2024
+#
+
+from datetime import datetime
+
+from app.extensions import db
+
+
+class DomainProfile(db.Model):
+    """
+    What we have learned about a website domain while fetching its pages.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    domain = db.Column(db.String(255), unique=True, nullable=False)
+    needs_js = db.Column(db.Boolean, nullable=True)  # None means not decided yet
+
+    # Circuit breaker of the check runs
+    consecutive_failures = db.Column(db.Integer, default=0)
+    breaker_opens = db.Column(db.Integer, default=0)  # Consecutive openings
+    breaker_open_until = db.Column(db.DateTime, nullable=True)
+    last_failure_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    last_updated = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<DomainProfile(domain='{self.domain}', needs_js={self.needs_js})>"
@@ -0,0 +1,38 @@
+# app/models/outbox.py
+# Author: Indrajit Ghosh
+# Created On: Mar 11, 2024
+#
+
+from datetime import datetime
+
+from app.extensions import db
+
+
+class OutboxEmail(db.Model):
+    """
+    An email waiting to be sent (or already sent). The web routes and the
+    check job only put their emails here; the outbox dispatcher leases them in
+    batches, sends them and retries the failed ones with a growing backoff
+    until they run out of attempts (and are dead-lettered).
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=True)  # What the email is about, e.g. 'password_reset'
+    from_addr = db.Column(db.String(255), nullable=False)
+    to_addrs = db.Column(db.Text, nullable=False)  # Comma separated (To, Cc and Bcc)
+    subject = db.Column(db.String(255), nullable=True)
+    raw_message = db.Column(db.Text, nullable=False)  # The whole MIME message
+    status = db.Column(db.String(16), nullable=False, default='pending', index=True)  # pending/sending/sent/dead
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    lease_token = db.Column(db.String(32), nullable=True, index=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+
+    @property
+    def recipients(self):
+        return [addr for addr in self.to_addrs.split(',') if addr]
+
+    def __repr__(self):
+        return f"<OutboxEmail(id={self.id}, kind='{self.kind}', status='{self.status}', attempts={self.attempts})>"
@@ -0,0 +1,38 @@
+# app/models/page.py
+# Author: Indrajit Ghosh
+# Created On: Feb 29, 2024
+#
+
+from datetime import datetime
+
+from app.extensions import db
+
+
+class MonitoredPage(db.Model):
+    """
+    A webpage (canonical url) on which one or more ads are tracked along with
+    the HTTP validators of the last full fetch, so that the next check can ask
+    the server whether the page changed at all, the fingerprints of its
+    content, so that an unchanged page isn't parsed again, and its check
+    schedule.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    url = db.Column(db.String(255), unique=True, nullable=False)
+    etag = db.Column(db.String(255), nullable=True)
+    last_modified = db.Column(db.String(64), nullable=True)
+    content_length = db.Column(db.Integer, nullable=True)
+    last_fetched_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # Fingerprints of the last full fetch (see `PageFetcher.count`)
+    raw_digest = db.Column(db.String(64), nullable=True)
+    text_digest = db.Column(db.String(64), nullable=True)
+
+    # Adaptive check schedule (see `scripts.check_schedule`)
+    check_interval = db.Column(db.Integer, nullable=True)  # Seconds
+    next_check_at = db.Column(db.DateTime, nullable=True, index=True)  # None means due now
+    last_checked_at = db.Column(db.DateTime, nullable=True)
+    last_changed_at = db.Column(db.DateTime, nullable=True)
+    is_hot = db.Column(db.Boolean, nullable=False, default=False)  # Always checked at the minimum interval
+
+    def __repr__(self):
+        return f"<MonitoredPage(id={self.id}, url='{self.url}', etag='{self.etag}', last_modified='{self.last_modified}')>"
@@ -0,0 +1,34 @@
+# app/models/target.py
+# Author: Indrajit Ghosh
+# Created On: Mar 15, 2024
+#
+
+from datetime import datetime
+
+from app.extensions import db
+
+
+class TrackedTarget(db.Model):
+    """
+    An advertisement number on a webpage (canonical url) along with its
+    check state. It is shared by every user tracking it: each of them has a
+    `MonitoredAd` (the subscription, with their own title and description)
+    pointing here, so a check run compares and updates a target once and a
+    change is notified to all of its subscribers.
+    """
+    __table_args__ = (
+        db.UniqueConstraint('url', 'advertisement_number', name='uq_tracked_target_url_adv_num'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    url = db.Column(db.String(255), nullable=False, index=True)  # Canonical url of the page
+    advertisement_number = db.Column(db.String(100), nullable=False)
+    occurrence_count = db.Column(db.Integer, default=0)
+    page_content_hash = db.Column(db.String(128), nullable=True)
+    hash_scheme = db.Column(db.String(32), nullable=True)  # How `page_content_hash` was computed
+    region_locator = db.Column(db.String(512), nullable=True)  # Where the hashed region was found (see `ParsedPage.locator`)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_updated = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<TrackedTarget(id={self.id}, advertisement_number='{self.advertisement_number}', url='{self.url}')>"
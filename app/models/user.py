@@ -8,25 +8,57 @@ import secrets
 from itsdangerous import URLSafeTimedSerializer
 from flask import current_app
 from flask_login import UserMixin
+from sqlalchemy.orm import validates
 
 from app.extensions import db
-from scripts.utils import sha256_hash
+from app.models.target import TrackedTarget  # (For the `MonitoredAd.target` relationship)
+from scripts.utils import sha256_hash, canonicalize_url
 
 
 class MonitoredAd(db.Model):
+    """
+    A user's subscription to a `TrackedTarget`: the ad as the user entered it
+    (with their title and description). The check state lives on the target,
+    shared by all of its subscribers.
+    """
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(170), nullable=False)
     advertisement_number = db.Column(db.String(100), nullable=False)
     website_url = db.Column(db.String(255), nullable=False)
+    normalized_url = db.Column(db.String(255), nullable=True, index=True)  # Canonical url of the page (set with `website_url`)
     description = db.Column(db.Text, nullable=True)
-    occurrence_count = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    last_updated = db.Column(db.DateTime, default=datetime.utcnow)
-    page_content_hash = db.Column(db.String(128), nullable=False)
+    last_updated = db.Column(db.DateTime, default=datetime.utcnow)  # Last change of the ad (or of its target)
 
     # Foreign Key to refer to the user
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
+    # The shared target holding the check state
+    target_id = db.Column(db.Integer, db.ForeignKey('tracked_target.id', name='fk_monitored_ad_target_id'), nullable=False, index=True)
+    target = db.relationship('TrackedTarget', backref=db.backref('subscriptions', lazy='select'))
+
+    @validates('website_url')
+    def _set_normalized_url(self, key, website_url):
+        self.normalized_url = canonicalize_url(website_url)
+        return website_url
+
+    @property
+    def page_url(self):
+        """The canonical url of the ad's page (even before `normalized_url` was backfilled)."""
+        return self.normalized_url or canonicalize_url(self.website_url)
+
+    @property
+    def occurrence_count(self):
+        return self.target.occurrence_count
+
+    @property
+    def page_content_hash(self):
+        return self.target.page_content_hash
+
+    @property
+    def hash_scheme(self):
+        return self.target.hash_scheme
+
     def __repr__(self):
         return f"<MonitoredAd(id={self.id}, advertisement_number='{self.advertisement_number}', website_url='{self.website_url}', user_id={self.user_id})>"
     
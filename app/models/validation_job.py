@@ -0,0 +1,40 @@
+# app/models/validation_job.py
+# Author: Indrajit Ghosh
+# Created On: Mar 13, 2024
+#
+
+from datetime import datetime
+
+from app.extensions import db
+
+
+class ValidationJob(db.Model):
+    """
+    A requested addition (or update) of an ad waiting for its webpage to be
+    checked. The routes only queue the job and return its id; the validation
+    job of the app fetches the page and adds (or updates) the ad only if the
+    advertisement number is on it. The dashboard polls the job's status.
+    """
+    id = db.Column(db.String(32), primary_key=True)  # A uuid4 hex, handed to the client
+    kind = db.Column(db.String(16), nullable=False)  # add/update/refresh
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # Who asked for it
+    ad_id = db.Column(db.Integer, nullable=True)  # The ad updated (or added once it succeeded)
+    title = db.Column(db.String(170), nullable=True)
+    advertisement_number = db.Column(db.String(100), nullable=True)
+    website_url = db.Column(db.String(255), nullable=True)
+    description = db.Column(db.Text, nullable=True)
+    status = db.Column(db.String(16), nullable=False, default='pending', index=True)  # pending/running/succeeded/failed
+    message = db.Column(db.Text, nullable=True)  # The outcome, as shown to the user
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    lease_token = db.Column(db.String(32), nullable=True, index=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+    not_before = db.Column(db.DateTime, nullable=True)  # A retried job waits for its backoff till then
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    @property
+    def finished(self):
+        return self.status in ('succeeded', 'failed')
+
+    def __repr__(self):
+        return f"<ValidationJob(id='{self.id}', kind='{self.kind}', ad_id={self.ad_id}, status='{self.status}')>"
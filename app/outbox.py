@@ -0,0 +1,274 @@
+# app/outbox.py
+#
+# Author: Indrajit Ghosh
+# Created On: Mar 11, 2024
+#
+
+"""
+An outbox in the database for every outgoing email, so that no request (and
+no check run) waits for the mail server.
+
+Whoever wants to send an email only puts it on the outbox:
+
+    >>> queue_email(msg, kind='password_reset')
+
+and the outbox dispatcher (a scheduled job of the app, or
+`python manage.py dispatch_outbox` on its own) sends it:
+
+    - it leases a batch of due emails with a conditional UPDATE followed by a
+      read of the rows carrying its lease token (as the check queue does), so
+      several app processes never send the same email,
+    - the emails are sent through the shared `smtp_pool`,
+    - a failed email is tried again after a backoff doubling with every
+      attempt (`base_backoff`, 2 x `base_backoff`, ... up to `max_backoff`),
+    - an email which failed `max_attempts` times, or was refused for good
+      (e.g. an unknown recipient), is dead-lettered: it stays in the outbox
+      with its last error for the admins to look at (and requeue).
+"""
+
+import logging
+import smtplib
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from apscheduler.jobstores.base import JobLookupError
+from sqlalchemy import and_, or_
+
+from app.extensions import db, scheduler, smtp_pool
+from app.models.outbox import OutboxEmail
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = 'pending'
+STATUS_SENDING = 'sending'
+STATUS_SENT = 'sent'
+STATUS_DEAD = 'dead'
+
+DISPATCH_JOB_ID = "dispatch_outbox_job"
+
+
+def queue_email(msg, kind: str = None, commit: bool = True):
+    """
+    Puts an `EmailMessage` on the outbox.
+
+    Parameters:
+    - msg (EmailMessage): The email.
+    - kind (str, optional): What the email is about (shown to the admins).
+    - commit (bool): Whether to commit right away; pass False to queue many
+      emails in one transaction (and commit them yourself).
+
+    Returns:
+    OutboxEmail: The queued email.
+    """
+    email = OutboxEmail(
+        kind=kind,
+        from_addr=msg.sender,
+        to_addrs=','.join(msg.recipients),
+        subject=msg.subject,
+        raw_message=msg.as_string(),
+        status=STATUS_PENDING,
+        next_attempt_at=datetime.utcnow()
+    )
+    db.session.add(email)
+    if commit:
+        db.session.commit()
+        wake_dispatcher()
+    return email
+
+
+def wake_dispatcher():
+    """Lets the dispatcher job of this process run right away (if it is scheduled)."""
+    try:
+        scheduler.modify_job(DISPATCH_JOB_ID, next_run_time=datetime.now())
+    except (JobLookupError, AttributeError):
+        pass
+    except Exception as e:
+        logger.debug(f"OUTBOX: Couldn't wake the dispatcher. \t {e}")
+
+
+def _claimable(now):
+    return or_(
+        and_(OutboxEmail.status == STATUS_PENDING, OutboxEmail.next_attempt_at <= now),
+        and_(OutboxEmail.status == STATUS_SENDING, OutboxEmail.lease_expires_at < now)
+    )
+
+
+def claim_emails(batch_size: int, lease_seconds: int):
+    """
+    Leases up to `batch_size` due emails, the oldest first.
+
+    Returns:
+    list: The leased `OutboxEmail`s (empty if none is due).
+    """
+    now = datetime.utcnow()
+
+    ids = [
+        email_id for (email_id,) in db.session.query(OutboxEmail.id)
+        .filter(_claimable(now))
+        .order_by(OutboxEmail.next_attempt_at, OutboxEmail.id)
+        .limit(batch_size)
+    ]
+    if not ids:
+        db.session.commit()
+        return []
+
+    lease_token = uuid4().hex
+    OutboxEmail.query.filter(OutboxEmail.id.in_(ids), _claimable(now)).update(
+        {
+            OutboxEmail.status: STATUS_SENDING,
+            OutboxEmail.lease_token: lease_token,
+            OutboxEmail.lease_expires_at: now + timedelta(seconds=lease_seconds),
+            OutboxEmail.attempts: OutboxEmail.attempts + 1
+        },
+        synchronize_session=False
+    )
+    db.session.commit()
+
+    # Whatever another dispatcher leased in between didn't get our token.
+    return OutboxEmail.query.filter_by(lease_token=lease_token).order_by(OutboxEmail.id).all()
+
+
+def _is_permanent(err: Exception):
+    """Checks whether a send failed for good (retrying won't help)."""
+    if isinstance(err, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(err, smtplib.SMTPResponseException) and 500 <= err.smtp_code < 600 \
+        and not isinstance(err, smtplib.SMTPAuthenticationError)
+
+
+def backoff_seconds(attempts: int, base_backoff: int, max_backoff: int):
+    """The wait before the next attempt of an email which failed `attempts` times."""
+    return min(max_backoff, base_backoff * 2 ** max(0, attempts - 1))
+
+
+class OutboxDispatcher:
+    """
+    Sends the emails of the outbox in batches.
+
+    Parameters:
+    -----------
+        `pool`: `SMTPPool`; (Sends the emails)
+        `batch_size`: `int`; (Emails leased at once)
+        `lease_seconds`: `int`; (How long a lease lasts; an email of a crashed dispatcher is sent again afterwards)
+        `max_attempts`: `int`; (Attempts before an email is dead-lettered)
+        `base_backoff`, `max_backoff`: `int`; (Seconds; see `backoff_seconds`)
+    """
+
+    def __init__(self, pool=smtp_pool, batch_size=50, lease_seconds=300, max_attempts=5,
+                 base_backoff=60, max_backoff=3600):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+    @classmethod
+    def from_config(cls, config, pool=smtp_pool):
+        return cls(
+            pool=pool,
+            batch_size=config['OUTBOX_BATCH_SIZE'],
+            lease_seconds=config['OUTBOX_LEASE_SECONDS'],
+            max_attempts=config['OUTBOX_MAX_ATTEMPTS'],
+            base_backoff=config['OUTBOX_BASE_BACKOFF'],
+            max_backoff=config['OUTBOX_MAX_BACKOFF']
+        )
+
+    def _send(self, email, now):
+        try:
+            self.pool.send_raw(email.from_addr, email.recipients, email.raw_message)
+        except Exception as e:
+            email.last_error = str(e) or type(e).__name__
+            email.lease_token = email.lease_expires_at = None
+
+            if _is_permanent(e) or email.attempts >= self.max_attempts:
+                email.status = STATUS_DEAD
+                logger.error(f"OUTBOX: Email {email.id} ({email.kind}) to '{email.to_addrs}' is dead after {email.attempts} attempt(s). \t {e}")
+            else:
+                email.status = STATUS_PENDING
+                email.next_attempt_at = now + timedelta(
+                    seconds=backoff_seconds(email.attempts, self.base_backoff, self.max_backoff)
+                )
+                logger.warning(f"OUTBOX: Email {email.id} ({email.kind}) failed; retrying at {email.next_attempt_at}. \t {e}")
+            return False
+
+        email.status = STATUS_SENT
+        email.sent_at = datetime.utcnow()
+        email.last_error = None
+        email.lease_token = email.lease_expires_at = None
+        logger.info(f"EMAIL_SENT: An email ({email.kind}) sent to '{email.to_addrs}'!")
+        return True
+
+    def dispatch_batch(self):
+        """
+        Leases and sends one batch.
+
+        Returns:
+        (sent, failed): The number of emails sent and failed in the batch.
+        """
+        emails = claim_emails(self.batch_size, self.lease_seconds)
+        now = datetime.utcnow()
+        sent = failed = 0
+        for email in emails:
+            if self._send(email, now):
+                sent += 1
+            else:
+                failed += 1
+            # Every outcome is written right away, so a crash doesn't resend
+            # the emails already sent.
+            db.session.commit()
+        return sent, failed
+
+    def dispatch(self, max_batches=None):
+        """
+        Sends batches until no email is due (or `max_batches` were sent).
+
+        Returns:
+        dict: The number of emails sent and failed.
+        """
+        stats = {'sent': 0, 'failed': 0}
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            sent, failed = self.dispatch_batch()
+            if not sent and not failed:
+                break
+            stats['sent'] += sent
+            stats['failed'] += failed
+            batches += 1
+        return stats
+
+    def run(self, poll_interval=10, once=False):
+        """Dispatches until the outbox is empty (`once`) or forever."""
+        total = {'sent': 0, 'failed': 0}
+        while True:
+            stats = self.dispatch()
+            total['sent'] += stats['sent']
+            total['failed'] += stats['failed']
+            if once:
+                return total
+            time.sleep(poll_interval)
+
+
+def requeue_email(email_id: int):
+    """
+    Puts a dead (or sent) email back on the outbox with fresh attempts.
+
+    Returns:
+    bool: Whether the email was found.
+    """
+    email = OutboxEmail.query.get(email_id)
+    if email is None:
+        return False
+    email.status = STATUS_PENDING
+    email.attempts = 0
+    email.next_attempt_at = datetime.utcnow()
+    email.lease_token = email.lease_expires_at = None
+    db.session.commit()
+    wake_dispatcher()
+    return True
+
+
+def outbox_stats():
+    """Returns the number of emails per status {status: count}."""
+    return dict(db.session.query(OutboxEmail.status, db.func.count(OutboxEmail.id)).group_by(OutboxEmail.status).all())
@@ -7,8 +7,8 @@
 from . import task_bp
 from app.extensions import scheduler
 from app.utils.decorators import admin_required
-from app.tasks import check_adv_count
-from flask import render_template
+from app.tasks import check_adv_count, check_due_ads
+from flask import render_template, current_app
 import time
 
 
@@ -28,14 +28,25 @@ def schedule():
         return render_template('schedule_count.html', job=existing_job, formatted_next_run_time=existing_job.next_run_time.strftime("%b %d, %Y %I:%M:%S %p"))
 
     # Job doesn't exist, so add a new one
-    job = scheduler.add_job(
-        func=check_adv_count,
-        trigger="interval",
-        days=1,
-        id="check_adv_count_job",
-        name="Checking users job notifications ...",
-        replace_existing=True,
-    )
+    if current_app.config['CHECK_ADAPTIVE']:
+        # Every page is checked at its own pace; the job only picks the due ones.
+        job = scheduler.add_job(
+            func=check_due_ads,
+            trigger="interval",
+            seconds=current_app.config['CHECK_TICK_SECONDS'],
+            id="check_adv_count_job",
+            name="Checking users job notifications ...",
+            replace_existing=True,
+        )
+    else:
+        job = scheduler.add_job(
+            func=check_adv_count,
+            trigger="interval",
+            days=1,
+            id="check_adv_count_job",
+            name="Checking users job notifications ...",
+            replace_existing=True,
+        )
 
     # Format next_run_time_ist
     formatted_next_run_time = job.next_run_time.strftime("%b %d, %Y %I:%M:%S %p")
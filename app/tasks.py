@@ -8,24 +8,35 @@
 This scripts contains the tasks to be performed while the app is running!
 """
 
-from .extensions import scheduler, db
+from .extensions import scheduler, db, page_fetcher, telegram_sender
 from app.models.user import MonitoredAd, User
-from scripts.utils import count_query_occurance, send_telegram_message_by_BOT, get_webpage_sha256, count_query_occurrences_and_hash, get_webpage_sha256_selenium
-from config import INDRA_ADNOTIFIER_TELEGRAM_BOT_TOKEN
+from app.check_queue import enqueue_checks
+from app.outbox import queue_email, wake_dispatcher, OutboxDispatcher
+from app.validation_jobs import ValidationRunner
+from app.utils.database_helpers import load_js_domains, save_js_domains, load_page_validators, AdUpdateWriter, \
+    iter_monitored_ads, count_ads_per_user, load_due_ads, load_breaker_states, save_breaker_states, load_ads, \
+    delete_orphan_targets
+from scripts.fetch_engine import FetchEngine
+from scripts.sharded_checker import ShardedChecker
+from scripts.check_schedule import AdaptiveSchedule
+from scripts.circuit_breaker import DomainCircuitBreaker
+from scripts.utils import normalize_url, LEGACY_HASH_SCHEME
 from scripts.email_message import EmailMessage
 from config import EmailConfig
 from flask import render_template
 from apscheduler.triggers.cron import CronTrigger
 from pprint import pprint
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import Counter
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
 
 def notify_user(dic:dict):
     """
-    Sends email and telegram notification to user!
+    Sends email (through the outbox) and telegram notification to user!
     Author: Indrajit Ghosh
     Created On: Feb 06, 2024
 
@@ -45,7 +56,12 @@ def notify_user(dic:dict):
                 ]
             }
         }
+
+    Returns:
+    --------
+        `dict`: The outcome of the telegram messages (see `TelegramSender.send_many`)
     """
+    telegram_messages = []
     for user_email, val in dic.items():
         msg_html_str = render_template(
             'all_user_email.html',
@@ -62,18 +78,12 @@ def notify_user(dic:dict):
         )
 
         try:
-            # Send the email to Indrajit
-            msg.send(
-                sender_email_password=EmailConfig.INDRAJITS_BOT_EMAIL_PASSWD,
-                server_info=EmailConfig.GMAIL_SERVER,
-                print_success_status=False
-            )
-
-            logger.info(f"EMAIL_SENT: An email sent to '{user_email}'!")
+            # The outbox dispatcher sends it (see `app.outbox`)
+            queue_email(msg, kind='notification', commit=False)
 
         except Exception as e:
             # Handle email sending error
-            logger.error(f"TASK_ERR: Error occured while sending emails.\t {e}")
+            logger.error(f"TASK_ERR: Error occured while queueing the email to '{user_email}'.\t {e}")
 
         
         # Send telegram message.
@@ -87,120 +97,548 @@ def notify_user(dic:dict):
                 tel_msg += f"Adv url: {ad['adv_url']}\n"
                 tel_msg += "-"*20 + "\n"
 
-            # Send telegram msg
-            send_telegram_message_by_BOT(
-                bot_token=INDRA_ADNOTIFIER_TELEGRAM_BOT_TOKEN,
-                user_id=telegram_user_id,
-                message=tel_msg
-            )   
+            telegram_messages.append((telegram_user_id, tel_msg))
+
+    # All emails of the listing go on the outbox in one transaction.
+    try:
+        db.session.commit()
+        logger.info(f"EMAIL_QUEUED: {len(dic)} email(s) put on the outbox.")
+        wake_dispatcher()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"TASK_ERR: Error occured while queueing emails.\t {e}")
+
+    # The telegram messages go out concurrently (within the bot's rate limits)
+    return telegram_sender.send_many(telegram_messages)
+
+
+def _add_telegram_stats(run_stats:dict, telegram_stats:dict):
+    """Adds the outcome of `notify_user`'s telegram messages to the `run_stats`."""
+    for key in ('sent', 'failed', 'rate_limited', 'retries'):
+        run_stats[f'telegram_{key}'] += telegram_stats[key]
+
+
+def _add_to_email_listing(email_listing:dict, ad, new_count:int):
+    """
+    Adds the given ad to the `email_listing` dict that `notify_user` accepts.
+    """
+    ad_user = ad.user
+    listing = email_listing.setdefault(
+        ad_user.email, {
+            'name': ad_user.fullname,
+            'telegram': ad_user.telegram if ad_user.telegram else '',
+            'ads': []
+        }
+    )
+    listing['ads'].append(
+        {
+            'adv_url': ad.website_url,
+            'adv_num': ad.advertisement_number,
+            'adv_title': ad.title,
+            'adv_count': new_count
+        }
+    )
+
+
+def _fetch_url(ads):
+    """
+    The url at which the page of the ads (sharing a canonical url) is
+    fetched: the https spelling entered by most of them, if any.
+    """
+    spellings = Counter(normalize_url(ad.website_url) for ad in ads)
+    return min(spellings, key=lambda url: (not url.startswith('https://'), -spellings[url], url))
+
+
+def _ad_windows(ads, window_size:int):
+    """
+    Splits the ads (ordered by `normalized_url`) into lists of about
+    `window_size` ads, never splitting the ads of a page.
+    """
+    window = []
+    last_url = None
+    for ad in ads:
+        url = ad.page_url
+        if len(window) >= window_size and url != last_url:
+            yield window
+            window = []
+        window.append(ad)
+        last_url = url
+
+    if window:
+        yield window
+
+
+def _notify_checked_users(window, ads_left:dict, email_listing:dict, run_stats:dict, notify=notify_user):
+    """
+    Counts the ads of the checked `window` off `ads_left` ({user_id: ads not
+    yet checked}) and notifies the users all of whose ads are now checked
+    (counting them in the `run_stats`).
+    """
+    ready = {}
+    for ad in window:
+        left = ads_left.get(ad.user_id)
+        if left is None:
+            continue
+
+        if left > 1:
+            ads_left[ad.user_id] = left - 1
+            continue
+
+        del ads_left[ad.user_id]
+        listing = email_listing.pop(ad.user.email, None)
+        if listing:
+            ready[ad.user.email] = listing
+
+    if ready:
+        _add_telegram_stats(run_stats, notify(ready))
+        run_stats['notified_users'] += len(ready)
+
+
+def _update_ads_from_page(page, url_ads, run_stats:dict, writer:AdUpdateWriter):
+    """
+    Queues the updates of the targets tracked on a fetched (and counted) page
+    in the `writer`; every subscriber of a target that changed is to be
+    notified once written. A target is compared once, however many of the
+    `url_ads` subscribe to it.
+    """
+    if page.deferred:
+        # The run is out of time; the page stays due for the next run.
+        run_stats['deferred_pages'] += 1
+        run_stats['deferred_ad_ids'].extend(ad.id for ad in url_ads)
+        return
+
+    if page.skipped:
+        # The domain is down; its ads keep their state till it is back.
+        run_stats['breaker_skipped'] += 1
+        logger.debug(f"Webpage '{page.url}' skipped: the circuit breaker of its domain is open.")
+        writer.page_done(page)
+        return
+
+    run_stats['fetches'] += 1
+
+    if page.not_modified:
+        # Nothing changed since the last full fetch.
+        run_stats['not_modified'] += 1
+        logger.debug(f"Webpage '{page.url}' not modified since the last check.")
+        writer.page_done(page)
+        return
+
+    if page.ok:
+        run_stats['full_fetches'] += 1
+        run_stats[f'{page.mode}_fetches'] += 1
+    else:
+        run_stats['fetch_errors'] += 1
+        if page.timeout:
+            run_stats['timeouts'].append((page.url, page.timeout))
+        logger.error(f"TASK_ERR: Couldn't fetch the webpage '{page.url}'.\t {page.error}")
+
+    targets = {ad.target_id: ad.target for ad in url_ads}
+    run_stats['targets'] += len(targets)
+
+    if page.unchanged:
+        # Its fingerprints match the last check; no need to parse it.
+        run_stats[f'unchanged_{page.unchanged}'] += 1
+        logger.debug(f"Webpage '{page.url}' unchanged since the last check (by its {page.unchanged} digest).")
+        writer.page_done(page)
+        return
+    if page.ok:
+        run_stats['parsed_pages'] += 1
+        run_stats['locator_hits'] += page.locator_hits
+        run_stats['locator_misses'] += page.locator_misses
+
+    for target in targets.values():
+        prev_count = target.occurrence_count
+        prev_hash = target.page_content_hash
+
+        new_count, current_page_hash = page.counts[target.advertisement_number]
+        if new_count == -1:
+            # Couldn't check the target this time; keep the old state.
+            logger.debug(f"TrackedTarget id '{target.id}': couldn't be checked in this run.")
+            continue
+
+        logger.debug(f"TrackedTarget id '{target.id}': `occurance_count` and `webpage_hash` has been calculated.")
+
+        # Remember where the region is, so that the next check looks there first.
+        locator = (page.locators or {}).get(target.advertisement_number)
+        moved = {'region_locator': locator} if locator and locator != target.region_locator else {}
+
+        if new_count != prev_count:
+            # Update the db
+            updates = dict(occurrence_count=new_count, page_content_hash=current_page_hash, hash_scheme=page.hash_scheme)
+            logger.debug(f"TrackedTarget id '{target.id}': `occurance_count` has been changed from `{prev_count}` to `{new_count}` on the website!")
+
+        elif page.hash_scheme != (target.hash_scheme or LEGACY_HASH_SCHEME):
+            # The hash was computed differently last time (e.g. the page
+            # was rendered in a browser); store the new one silently.
+            writer.update(target, page_content_hash=current_page_hash, hash_scheme=page.hash_scheme, **moved)
+            run_stats['rebaselined'] += 1
+            logger.debug(f"TrackedTarget id '{target.id}': hash scheme changed to `{page.hash_scheme}`.")
+            continue
+
+        elif current_page_hash != prev_hash:
+            # Update the db
+            updates = dict(page_content_hash=current_page_hash)
+            logger.debug(f"TrackedTarget id '{target.id}': `occurance_count` didn't change. Current hash has changed from `{prev_hash}` to `{current_page_hash}`.")
+
+        else:
+            logger.debug(f"TrackedTarget id '{target.id}': `occurance_count` and the website hash didn't change.")
+            if moved:
+                writer.update(target, **moved)
+            continue
+
+        # Notify every subscriber (not only the ones in this run) once the
+        # update is written
+        writer.update(target, subscribers=target.subscriptions, last_updated=datetime.utcnow(), **updates, **moved)
+
+    # Only once the ads are up to date with this version of the page may
+    # later checks be answered with `304`, so the validators are written
+    # along with the ads.
+    writer.page_done(page)
+
+
+def _counted_pages(fetch_jobs, validators:dict, config, breaker:DomainCircuitBreaker=None, deadline:float=None):
+    """
+    Fetches and counts the pages of the run in this process, yielding every
+    page as soon as it is counted.
+    """
+    engine = FetchEngine(
+        page_fetcher,
+        max_concurrency=config['FETCH_CONCURRENCY'],
+        per_host=config['FETCH_PER_HOST_CONCURRENCY'],
+        timeout=config['FETCH_TIMEOUT'],
+        browser_workers=config['BROWSER_POOL_SIZE'],
+        breaker=breaker,
+        deadline=deadline
+    )
+    query_strs_by_url = dict(fetch_jobs)
+
+    for page in engine.stream(fetch_jobs, validators=validators):
+        if not page.not_modified:
+            page_fetcher.count(page, query_strs_by_url[page.url], last_check=validators.get(page.url))
+        yield page
+
+
+def check_ads(ads, config, ads_per_user=None, notify=notify_user):
+    """
+    Counts the occurances of the given advertisements and if the count
+    changes email the respective user.
+
+    Ads are grouped by their `normalized_url` (the canonical url of the
+    page) so that every distinct page is fetched and parsed only once per
+    run, no matter how many ads (of how many users, with whatever spelling
+    of its url) are tracked on it. The ads are subscriptions to
+    shared targets (see `TrackedTarget`): a target is compared and updated
+    once, and its change is notified to all of its subscribers. Pages are
+    fetched concurrently,
+    over plain HTTP unless their domain is known to need a browser, and are
+    processed as soon as they arrive. A page the server reports as not
+    modified since the last full fetch is skipped without parsing, and so is
+    a page whose raw or normalized text digest didn't change since its last
+    check (see `PageFetcher.count`).
+
+    With `CHECK_WORKERS` > 1 the pages are sharded by domain over that many
+    worker processes which fetch, parse and count them; the database updates
+    and the notifications still happen here, the same way as in a run in a
+    single process.
+
+    A domain which fails `CHECK_BREAKER_THRESHOLD` times in a row is skipped
+    for the rest of the run and backed off exponentially over the next runs
+    (see `DomainCircuitBreaker`); the ads on its pages keep their state.
+
+    Every fetch is bounded by the `FETCH_*_TIMEOUT` settings and the whole
+    run by `CHECK_RUN_DEADLINE` seconds: the pages not fetched by then are
+    deferred (their ads keep their state and are listed in the stats, so
+    that the caller can check them in the next run).
+
+    The ads are checked in windows of `CHECK_WINDOW_SIZE` ads (cut between
+    pages), so they can be streamed (see `iter_monitored_ads`). A user is
+    notified as soon as all of their ads are checked, and then forgotten.
+
+    Needs an app context.
+
+    Parameters:
+    -----------
+        `ads`: [`MonitoredAd`, ...]; (An iterable ordered by `normalized_url` if
+               `ads_per_user` is given; otherwise a list which is sorted here)
+        `config`: The app config
+        `ads_per_user`: {user_id: number of ads}; (How many of the `ads` belong to each user)
+        `notify`: `callable`; (Gets the listings of changed ads; a check worker holds them
+                  back with `hold_notifications` to notify every user once per cycle)
+
+    Returns:
+    --------
+        `dict`: The stats of the run
+    """
+    page_fetcher.remember_domains(load_js_domains())
+
+    if ads_per_user is None:
+        ads = sorted(ads, key=lambda ad: (ad.page_url, ad.id))
+        ads_per_user = Counter(ad.user_id for ad in ads)
+    ads_left = dict(ads_per_user)
+
+    run_stats = {
+        'ads': 0,
+        'targets': 0,
+        'urls': 0,
+        'fetches': 0,
+        'fetch_errors': 0,
+        'breaker_skipped': 0,
+        'timeouts': [],  # [(url, what timed out), ...]
+        'deferred_pages': 0,
+        'deferred_ad_ids': [],
+        'not_modified': 0,
+        'unchanged_raw': 0,
+        'unchanged_text': 0,
+        'parsed_pages': 0,
+        'locator_hits': 0,
+        'locator_misses': 0,
+        'full_fetches': 0,
+        'http_fetches': 0,
+        'browser_fetches': 0,
+        'rebaselined': 0,
+        'notified_users': 0,
+        'telegram_sent': 0,
+        'telegram_failed': 0,
+        'telegram_rate_limited': 0,
+        'telegram_retries': 0,
+    }
+
+    email_listing = {}
+    writer = AdUpdateWriter(
+        batch_size=config['CHECK_WRITE_BATCH_SIZE'],
+        on_written=lambda ad, new_count: _add_to_email_listing(email_listing, ad, new_count),
+        schedule=AdaptiveSchedule.from_config(config)
+    )
+    new_decisions = {}
+    breaker = DomainCircuitBreaker.from_config(config, states=load_breaker_states())
+    deadline = time.time() + config['CHECK_RUN_DEADLINE'] if config['CHECK_RUN_DEADLINE'] else None
+
+    # One pool of worker processes (and their browsers) for the whole run
+    sharded_checker = None
+    if config['CHECK_WORKERS'] > 1:
+        sharded_checker = ShardedChecker.from_config(
+            config, js_domains=page_fetcher.js_domains, breaker=breaker, deadline=deadline
+        )
+
+    try:
+        for window in _ad_windows(ads, config['CHECK_WINDOW_SIZE']):
+            # Group the ads by the page they live on
+            ads_by_url = {}
+            for ad in window:
+                ads_by_url.setdefault(ad.page_url, []).append(ad)
+            # The canonical url is only a key; a page is fetched at one of the urls its users entered.
+            fetch_urls = {url: _fetch_url(url_ads) for url, url_ads in ads_by_url.items()}
+            urls_by_fetch_url = {fetch_url: url for url, fetch_url in fetch_urls.items()}
+
+            if deadline is not None and time.time() >= deadline:
+                # Out of time; the rest of the ads wait for the next run.
+                run_stats['deferred_pages'] += len(ads_by_url)
+                run_stats['deferred_ad_ids'].extend(ad.id for ad in window)
+                continue
+
+            run_stats['ads'] += len(window)
+            run_stats['urls'] += len(ads_by_url)
+
+            fetch_jobs = [
+                (fetch_urls[url], {ad.target.advertisement_number for ad in url_ads})
+                for url, url_ads in ads_by_url.items()
+            ]
+            stored = load_page_validators(ads_by_url.keys())
+            validators = {
+                fetch_urls[url]: {
+                    **stored.get(url, {}),
+                    # Where the regions of the targets were found last time
+                    'locators': {
+                        ad.target.advertisement_number: ad.target.region_locator
+                        for ad in url_ads if ad.target.region_locator
+                    }
+                }
+                for url, url_ads in ads_by_url.items()
+            }
+
+            if sharded_checker is not None:
+                pages = sharded_checker.stream(fetch_jobs, validators=validators)
+            else:
+                pages = _counted_pages(fetch_jobs, validators, config, breaker=breaker, deadline=deadline)
+
+            # Fetch every page once for all ads on it
+            for page in pages:
+                page.url = urls_by_fetch_url[page.url]  # (The page is stored under its canonical url)
+                _update_ads_from_page(page, ads_by_url[page.url], run_stats, writer)
+            writer.flush()
+
+            if sharded_checker is not None:
+                # The workers learnt which domains need a browser.
+                page_fetcher.remember_domains(sharded_checker.new_decisions)
+                new_decisions.update(sharded_checker.new_decisions)
+
+            _notify_checked_users(window, ads_left, email_listing, run_stats, notify)
+    finally:
+        if sharded_checker is not None:
+            sharded_checker.close()
+
+    run_stats['write_batches'] = writer.stats['batches']
+    run_stats['write_errors'] = writer.stats['failed']
+    run_stats['notified_ads'] = writer.stats['notified_ads']
+
+    new_decisions.update(page_fetcher.pop_new_decisions())
+    save_js_domains(new_decisions)
+    save_breaker_states(breaker.pop_changes())
+
+    run_stats['fetches_saved'] = run_stats['ads'] - run_stats['fetches']
+    locator_lookups = run_stats['locator_hits'] + run_stats['locator_misses']
+    run_stats['locator_hit_rate'] = run_stats['locator_hits'] / locator_lookups if locator_lookups else 0.0
+    run_stats['deferred_ads'] = len(run_stats['deferred_ad_ids'])
+    logger.info(
+        f"TASK_STATS: {run_stats['ads']} ads ({run_stats['targets']} distinct targets) on {run_stats['urls']} distinct urls; "
+        f"{run_stats['fetches']} fetches ({run_stats['not_modified']} not modified (304), "
+        f"{run_stats['full_fetches']} full: {run_stats['http_fetches']} http/{run_stats['browser_fetches']} browser, "
+        f"{run_stats['fetch_errors']} failed), "
+        f"change detection: {run_stats['not_modified']} pages stopped at 304, {run_stats['unchanged_raw']} at the raw digest, "
+        f"{run_stats['unchanged_text']} at the text digest, {run_stats['parsed_pages']} fully parsed "
+        f"(regions found at their cached locator: {run_stats['locator_hits']}/{locator_lookups}, "
+        f"{run_stats['locator_hit_rate']:.0%} hit rate); "
+        f"{run_stats['breaker_skipped']} pages skipped by the circuit breaker, "
+        f"{len(run_stats['timeouts'])} timeouts, "
+        f"{run_stats['deferred_pages']} pages ({run_stats['deferred_ads']} ads) deferred to the next run, "
+        f"{run_stats['fetches_saved']} fetches saved by grouping, "
+        f"{run_stats['rebaselined']} hashes rebaselined; "
+        f"{run_stats['write_batches']} write batches, {run_stats['write_errors']} target updates failed to be written, "
+        f"{run_stats['notified_ads']} subscribed ads changed."
+    )
+    for url, timeout in run_stats['timeouts']:
+        logger.warning(f"TASK_TIMEOUT: '{url}' timed out ({timeout}).")
+
+    if email_listing:
+        # Users whose ads were added or removed during the run
+        _add_telegram_stats(run_stats, notify(email_listing))
+        run_stats['notified_users'] += len(email_listing)
+
+    if run_stats['notified_users']:
+        logger.info(
+            f"TASK_DONE: {run_stats['notified_users']} user(s) notified! Telegram: "
+            f"{run_stats['telegram_sent']} sent, {run_stats['telegram_failed']} failed, "
+            f"{run_stats['telegram_retries']} retries, {run_stats['telegram_rate_limited']} times rate limited."
+        )
+    else:
+        logger.warning("TASK_DONE: No new updates for users found. Hence no email was sent!")
+
+    return run_stats
 
 
 def check_adv_count():
     """
     This function counts the occurances of all advertisements in the database
-    and if the count changes email the respective user. 
+    and if the count changes email the respective user (see `check_ads`).
+
+    With `CHECK_QUEUE` on, the ads are only put on the check queue, and the
+    check workers (`python manage.py check_worker`) check them.
     """
     with scheduler.app.app_context():
-        ads = MonitoredAd.query.all()
+        config = scheduler.app.config
 
-        email_listing = {}
-        
-        for ad in ads:
-            ad_title = ad.title
-            ad_num = ad.advertisement_number
-            ad_url = ad.website_url
-            ad_user = ad.user
-            ad_prev_count = ad.occurrence_count
-            ad_prev_hash = ad.page_content_hash
-            telegram = (
-                ad_user.telegram
-                if ad_user.telegram
-                else ''
-            )
-
-            # Count the occurances
-            new_count, current_page_hash = count_query_occurrences_and_hash(url=ad_url, query_str=ad_num)
-            logger.debug(f"MonitoredAd id '{ad.id}': `occurance_count` and `webpage_hash` has been calculated.")
-
-            if new_count != ad_prev_count:
-                # uncomment - Update the db
-                ad.occurrence_count = new_count
-                ad.page_content_hash = current_page_hash
-                logger.debug(f"MonitoredAd id '{ad.id}': `occurance_count` has been changed from `{ad_prev_count}` to `{new_count}` on the website!")
-                
-                ad.last_updated = datetime.utcnow()
-
-                db.session.commit()
-
-                # Add to the dict
-                if ad_user.email in email_listing.keys():
-                    email_listing[ad_user.email]['ads'].append(
-                        {
-                            'adv_url': ad_url,
-                            'adv_num': ad_num,
-                            'adv_title': ad_title,
-                            'adv_count': new_count
-                        }
-                    )
-                else:
-                    email_listing.setdefault(
-                        ad_user.email, {
-                            'name': ad_user.fullname,
-                            'telegram': telegram,
-                            'ads': [
-                                {
-                                    'adv_url': ad_url,
-                                    'adv_num': ad_num,
-                                    'adv_title': ad_title,
-                                    'adv_count': new_count
-                                }
-                            ]
-                        }
-                    )
-            else:
-                logger.debug(f"MonitoredAd id '{ad.id}': `occurance_count` didn't change so checking the current website hash ...")
-
-                if current_page_hash != ad_prev_hash:
-                    # Update the db
-                    ad.page_content_hash = current_page_hash
-                    ad.last_updated = datetime.utcnow()
-                    logger.debug(f"MonitoredAd id '{ad.id}': `occurance_count` didn't change. Current hash has changed from `{ad_prev_hash}` to `{current_page_hash}`.")
-                    db.session.commit()
-                    # Add to the dict
-                    if ad_user.email in email_listing.keys():
-                        email_listing[ad_user.email]['ads'].append(
-                            {
-                                'adv_url': ad_url,
-                                'adv_num': ad_num,
-                                'adv_title': ad_title,
-                                'adv_count': new_count
-                            }
-                        )
-                    else:
-                        email_listing.setdefault(
-                            ad_user.email, {
-                                'name': ad_user.fullname,
-                                'telegram': telegram,
-                                'ads': [
-                                    {
-                                        'adv_url': ad_url,
-                                        'adv_num': ad_num,
-                                        'adv_title': ad_title,
-                                        'adv_count': new_count
-                                    }
-                                ]
-                            }
-                        )
-            
-        
-        if email_listing:
+        # The targets whose last subscriber deleted their ad
+        orphans = delete_orphan_targets()
+        if orphans:
+            logger.info(f"TASK_CLEANUP: {orphans} targets without subscribers deleted.")
 
-            # Email the user.
-            notify_user(email_listing)
-            logger.info("TASK_DONE: User(s) notified!")
-            
-        else:
-            logger.warning("TASK_DONE: No new updates for users found. Hence no email was sent!")
+        if config['CHECK_QUEUE']:
+            enqueued = enqueue_checks(window_size=config['CHECK_WINDOW_SIZE'])
+            logger.info(f"TASK_QUEUED: {enqueued} ads put on the check queue.")
+            return {'enqueued': enqueued}
+
+        run_stats = check_ads(
+            iter_monitored_ads(config['CHECK_WINDOW_SIZE']),
+            config,
+            ads_per_user=count_ads_per_user()
+        )
+        _schedule_deferred_check(run_stats['deferred_ad_ids'], config)
+        return run_stats
+
+
+def _schedule_deferred_check(ad_ids, config):
+    """
+    Checks the ads a run had to defer (see `CHECK_RUN_DEADLINE`) in a
+    follow-up run, `CHECK_TICK_SECONDS` later.
+    """
+    if not ad_ids:
+        return
+
+    job = scheduler.add_job(
+        func=check_deferred_ads,
+        trigger="date",
+        run_date=datetime.now() + timedelta(seconds=config['CHECK_TICK_SECONDS']),
+        args=[list(ad_ids)],
+        id="check_deferred_ads_job",
+        name="Checking the deferred ads ...",
+        replace_existing=True,
+    )
+    logger.info(f"TASK_DEFERRED: {len(ad_ids)} ads deferred to the run at {job.next_run_time}.")
+
+
+def check_deferred_ads(ad_ids):
+    """
+    Checks the ads deferred by an earlier run (and defers again whatever
+    doesn't fit in this one).
+    """
+    with scheduler.app.app_context():
+        config = scheduler.app.config
+        run_stats = check_ads(load_ads(ad_ids), config)
+        _schedule_deferred_check(run_stats['deferred_ad_ids'], config)
+        return run_stats
+
+
+def dispatch_outbox():
+    """
+    Sends the due emails of the outbox (see `app.outbox`). Runs every
+    `OUTBOX_POLL_SECONDS` and right after an email is queued.
+    """
+    with scheduler.app.app_context():
+        stats = OutboxDispatcher.from_config(scheduler.app.config).dispatch()
+        if stats['sent'] or stats['failed']:
+            logger.info(f"OUTBOX: {stats['sent']} email(s) sent, {stats['failed']} failed.")
+        return stats
+
+
+def run_validations():
+    """
+    Runs the pending validation jobs (see `app.validation_jobs`). Runs every
+    `VALIDATION_POLL_SECONDS` and right after a job is queued.
+    """
+    with scheduler.app.app_context():
+        runner = ValidationRunner.from_config(scheduler.app.config)
+        jobs = 0
+        while True:
+            leased = runner.run_batch()
+            if not leased:
+                break
+            jobs += leased
+        if jobs:
+            logger.info(f"VALIDATION: {jobs} job(s) run; page cache: {runner.fetcher.stats}.")
+
+
+def check_due_ads():
+    """
+    Checks the ads of the pages which are due for a check (see
+    `scripts.check_schedule`), at most `CHECK_TICK_MAX_PAGES` pages at a
+    time, the most overdue first. Meant to run every `CHECK_TICK_SECONDS`.
+    (The pages a run defers stay due, so the next tick takes them first.)
+
+    With `CHECK_QUEUE` on, the due ads are only put on the check queue.
+    """
+    with scheduler.app.app_context():
+        config = scheduler.app.config
+        ads = load_due_ads(max_pages=config['CHECK_TICK_MAX_PAGES'])
+        if not ads:
+            logger.debug("TASK_DONE: No page is due for a check.")
+            return {'ads': 0}
+
+        if config['CHECK_QUEUE']:
+            enqueued = enqueue_checks([ad.id for ad in ads], window_size=config['CHECK_WINDOW_SIZE'])
+            logger.info(f"TASK_QUEUED: {enqueued} due ads put on the check queue.")
+            return {'enqueued': enqueued}
+
+        return check_ads(ads, config)
 
 # @scheduler.task(
 #     "interval",
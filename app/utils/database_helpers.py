@@ -1,20 +1,42 @@
+from datetime import datetime
+
 from app.models.user import MonitoredAd
+from app.models.target import TrackedTarget
+from app.models.domain import DomainProfile
+from app.models.page import MonitoredPage
+from app.models.check_job import CheckJob
 from app.extensions import db
-from scripts.utils import get_webpage_sha256
-from sqlalchemy.exc import SQLAlchemyError
+from scripts.utils import get_webpage_sha256, canonicalize_url
+from scripts.check_schedule import AdaptiveSchedule
+from scripts.circuit_breaker import BreakerState
+from sqlalchemy import and_, bindparam, delete, insert, or_, select, update
+from sqlalchemy.orm import joinedload
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+import logging
+
+logger = logging.getLogger(__name__)
+
+PAGE_CHECK_COLUMNS = (
+    'etag', 'last_modified', 'content_length', 'last_fetched_at', 'raw_digest', 'text_digest',
+    'check_interval', 'next_check_at', 'last_checked_at', 'last_changed_at'
+)
 
 def update_page_content_hashes():
     """
-    Update the page_content_hash for MonitoredAd records with a None value.
+    Update the page_content_hash for TrackedTarget records with a None value.
     
-    This function iterates through MonitoredAd records with a page_content_hash of None,
+    This function iterates through TrackedTarget records with a page_content_hash of None,
     calculates the hash using the get_webpage_sha256 function, and updates the records.
+    The canonical url of a target is only a key; the page is fetched at the url
+    one of its subscribers entered.
     """
     try:
-        ads_without_hashes = MonitoredAd.query.filter_by(page_content_hash=None).all()
+        targets_without_hashes = TrackedTarget.query.filter_by(page_content_hash=None).all()
 
-        for ad in ads_without_hashes:
-            ad.page_content_hash = get_webpage_sha256(ad.website_url)
+        for target in targets_without_hashes:
+            if not target.subscriptions:
+                continue
+            target.page_content_hash = get_webpage_sha256(target.subscriptions[0].website_url)
 
         db.session.commit()
         print("Page content hashes updated successfully.")
@@ -23,3 +45,564 @@ def update_page_content_hashes():
         print(f"Error updating page content hashes: {e}")
     except Exception as e:
         print(f"Unexpected error: {e}")
+
+
+def get_or_create_target(website_url: str, advertisement_number: str):
+    """
+    Returns the `TrackedTarget` of an ad (the canonical url and the
+    advertisement number), adding it to the session if it is new.
+
+    Returns:
+    (TrackedTarget, bool): The target and whether it was created.
+    """
+    url = canonicalize_url(website_url)
+    advertisement_number = advertisement_number.strip()
+    target = TrackedTarget.query.filter_by(url=url, advertisement_number=advertisement_number).first()
+    if target is not None:
+        return target, False
+
+    target = TrackedTarget(url=url, advertisement_number=advertisement_number)
+    try:
+        with db.session.begin_nested():
+            db.session.add(target)
+    except IntegrityError:
+        # Someone else added it just now
+        target = TrackedTarget.query.filter_by(url=url, advertisement_number=advertisement_number).one()
+        return target, False
+    return target, True
+
+
+def find_duplicate_ad(user_id: int, website_url: str, advertisement_number: str, exclude_id: int = None):
+    """
+    Returns the user's ad tracking the same advertisement number on the same
+    page (whatever the spelling of its url), if any; `exclude_id` is the ad
+    being updated.
+    """
+    query = MonitoredAd.query.filter_by(
+        user_id=user_id,
+        normalized_url=canonicalize_url(website_url),
+        advertisement_number=advertisement_number.strip()
+    )
+    if exclude_id is not None:
+        query = query.filter(MonitoredAd.id != exclude_id)
+    return query.first()
+
+
+def delete_orphan_targets():
+    """
+    Deletes the targets nobody subscribes to anymore.
+
+    Returns:
+    int: The number of targets deleted.
+    """
+    subscribed = select(MonitoredAd.target_id).where(MonitoredAd.target_id.isnot(None))
+    result = db.session.execute(delete(TrackedTarget).where(TrackedTarget.id.notin_(subscribed)))
+    db.session.commit()
+    return result.rowcount
+
+
+def _merge_rows(connection, table, rows, key, keep, before_delete=None):
+    """
+    Re-keys the rows of a table to their canonical urls: of the rows sharing
+    a canonical url (`key(row)`) the one `keep` picks gets the new url, the
+    others are deleted (after `before_delete(merged)` moved what refers to them).
+
+    Returns:
+    dict: {id of a deleted row: id of the row kept in its place}.
+    """
+    groups = {}
+    for row in rows:
+        groups.setdefault(key(row), []).append(row)
+
+    merged = {}
+    renames = []
+    for new_key, group in groups.items():
+        kept = keep(group)
+        merged.update({row.id: kept.id for row in group if row.id != kept.id})
+        if kept.url != new_key[0]:
+            renames.append({'_id': kept.id, 'new_url': new_key[0]})
+
+    if merged:
+        if before_delete is not None:
+            before_delete(merged)
+        connection.execute(delete(table).where(table.c.id.in_(list(merged))))
+    if renames:
+        connection.execute(update(table).where(table.c.id == bindparam('_id')).values(url=bindparam('new_url')), renames)
+    return merged
+
+
+def backfill_normalized_urls():
+    """
+    Stores the canonical url (see `canonicalize_url`) of every ad in
+    `MonitoredAd.normalized_url` and re-keys what is keyed by the page url
+    to it:
+
+        - the targets of the variants of a page merge into one (the most
+          recently updated one keeps its state) and their ads point to it,
+        - the monitored pages merge into one (the most recently checked one
+          keeps its validators and schedule; it stays hot if any was),
+        - the queued checks take the canonical url.
+
+    Safe to run again.
+
+    Returns:
+    dict: The number of ads whose url changed and of targets and pages merged.
+    """
+    with db.engine.begin() as connection:
+        ad_table = MonitoredAd.__table__
+        ad_rows = [
+            {'_id': row.id, 'new_normalized_url': canonicalize_url(row.website_url)}
+            for row in connection.execute(select(ad_table.c.id, ad_table.c.website_url, ad_table.c.normalized_url))
+            if row.normalized_url != canonicalize_url(row.website_url)
+        ]
+        if ad_rows:
+            connection.execute(
+                update(ad_table).where(ad_table.c.id == bindparam('_id')).values(normalized_url=bindparam('new_normalized_url')),
+                ad_rows
+            )
+
+        def move_subscriptions(merged):
+            connection.execute(
+                update(ad_table).where(ad_table.c.target_id == bindparam('_old_id')).values(target_id=bindparam('_new_id')),
+                [{'_old_id': old_id, '_new_id': new_id} for old_id, new_id in merged.items()]
+            )
+
+        target_table = TrackedTarget.__table__
+        merged_targets = _merge_rows(
+            connection, target_table, connection.execute(select(target_table)).all(),
+            key=lambda row: (canonicalize_url(row.url), row.advertisement_number),
+            keep=lambda group: max(group, key=lambda row: (row.last_updated or datetime.min, row.id)),
+            before_delete=move_subscriptions
+        )
+
+        page_table = MonitoredPage.__table__
+        page_rows = connection.execute(select(page_table)).all()
+        hot_keys = {canonicalize_url(row.url) for row in page_rows if row.is_hot}
+        merged_pages = _merge_rows(
+            connection, page_table, page_rows,
+            key=lambda row: (canonicalize_url(row.url),),
+            keep=lambda group: max(group, key=lambda row: (row.last_checked_at or datetime.min, row.id))
+        )
+        if hot_keys:
+            connection.execute(update(page_table).where(page_table.c.url.in_(hot_keys)).values(is_hot=True))
+
+        job_table = CheckJob.__table__
+        job_rows = [
+            {'_id': row.id, 'new_url': canonicalize_url(row.url)}
+            for row in connection.execute(select(job_table.c.id, job_table.c.url))
+            if row.url != canonicalize_url(row.url)
+        ]
+        if job_rows:
+            connection.execute(update(job_table).where(job_table.c.id == bindparam('_id')).values(url=bindparam('new_url')), job_rows)
+
+    return {'ads': len(ad_rows), 'targets': len(merged_targets), 'pages': len(merged_pages)}
+
+
+def load_js_domains():
+    """
+    Returns the {domain: needs_js} decisions stored in the database.
+    """
+    profiles = DomainProfile.query.filter(DomainProfile.needs_js.isnot(None)).all()
+    return {profile.domain: profile.needs_js for profile in profiles}
+
+
+def save_js_domains(decisions: dict):
+    """
+    Stores the {domain: needs_js} decisions taken by the `PageFetcher`.
+    """
+    if not decisions:
+        return
+
+    profiles = {
+        profile.domain: profile
+        for profile in DomainProfile.query.filter(DomainProfile.domain.in_(decisions.keys())).all()
+    }
+    for domain, needs_js in decisions.items():
+        profile = profiles.get(domain)
+        if profile is None:
+            profile = DomainProfile(domain=domain)
+            db.session.add(profile)
+        profile.needs_js = needs_js
+        profile.last_updated = datetime.utcnow()
+
+    db.session.commit()
+
+
+def load_breaker_states():
+    """
+    Returns the {domain: BreakerState} of the domains which failed lately.
+    """
+    profiles = DomainProfile.query.filter(
+        or_(DomainProfile.consecutive_failures > 0, DomainProfile.breaker_opens > 0)
+    ).all()
+    return {
+        profile.domain: BreakerState(
+            failures=profile.consecutive_failures or 0,
+            opens=profile.breaker_opens or 0,
+            open_until=profile.breaker_open_until,
+            last_error=profile.last_error
+        )
+        for profile in profiles
+    }
+
+
+def save_breaker_states(states: dict):
+    """
+    Stores the {domain: BreakerState} changed by a `DomainCircuitBreaker`.
+    """
+    if not states:
+        return
+
+    now = datetime.utcnow()
+    profiles = {
+        profile.domain: profile
+        for profile in DomainProfile.query.filter(DomainProfile.domain.in_(states.keys())).all()
+    }
+    for domain, state in states.items():
+        profile = profiles.get(domain)
+        if profile is None:
+            profile = DomainProfile(domain=domain)
+            db.session.add(profile)
+        if state.failures and state.failures != profile.consecutive_failures:
+            profile.last_failure_at = now
+        profile.consecutive_failures = state.failures
+        profile.breaker_opens = state.opens
+        profile.breaker_open_until = state.open_until
+        profile.last_error = state.last_error
+        profile.last_updated = now
+
+    db.session.commit()
+
+
+def iter_monitored_ads(window_size: int = 1000):
+    """
+    Streams all ads, along with their users (loaded in the same query),
+    ordered by (`normalized_url`, `id`), so the ads of a page come one after
+    another. The ads are read `window_size` at a time with keyset
+    pagination, so the whole table never sits in memory.
+
+    (Ads whose `normalized_url` isn't backfilled yet come first: NULL never
+    compares in the keyset, so the key is the url or ''.)
+    """
+    url_key = db.func.coalesce(MonitoredAd.normalized_url, '')
+    last = None
+    while True:
+        query = MonitoredAd.query.options(joinedload(MonitoredAd.user), joinedload(MonitoredAd.target)) \
+            .order_by(url_key, MonitoredAd.id)
+        if last is not None:
+            last_url, last_id = last
+            query = query.filter(or_(
+                url_key > last_url,
+                and_(url_key == last_url, MonitoredAd.id > last_id)
+            ))
+
+        ads = query.limit(window_size).all()
+        if not ads:
+            return
+
+        yield from ads
+        last = (ads[-1].normalized_url or '', ads[-1].id)
+
+
+def count_ads_per_user():
+    """Returns {user_id: number of ads}."""
+    return dict(
+        db.session.query(MonitoredAd.user_id, db.func.count(MonitoredAd.id))
+        .group_by(MonitoredAd.user_id)
+        .all()
+    )
+
+
+def load_page_validators(urls=None):
+    """
+    Returns the stored HTTP validators and fingerprints of the monitored
+    pages (all of them or the ones of the given `urls`) as
+    {url: {'etag': ..., 'last_modified': ..., 'raw_digest': ..., 'text_digest': ...}}.
+    """
+    query = MonitoredPage.query
+    if urls is not None:
+        query = query.filter(MonitoredPage.url.in_(list(urls)))
+
+    return {
+        page.url: {
+            'etag': page.etag, 'last_modified': page.last_modified,
+            'raw_digest': page.raw_digest, 'text_digest': page.text_digest
+        }
+        for page in query.all()
+        if page.etag or page.last_modified or page.raw_digest
+    }
+
+
+def _page_check_values(page, result, changed, now, schedule):
+    """The new column values of a `MonitoredPage` (or None for a new one) after a check."""
+    if result.ok:
+        # Fully fetched; only a plain HTTP fetch has validators worth keeping.
+        is_http = result.mode == 'http'
+        values = {
+            'etag': result.etag if is_http else None,
+            'last_modified': result.last_modified if is_http else None,
+            'content_length': result.content_length if is_http else None,
+            'last_fetched_at': now,
+            'raw_digest': result.raw_digest,
+            'text_digest': result.text_digest
+        }
+    else:
+        values = {
+            column: getattr(page, column) if page is not None else None
+            for column in ('etag', 'last_modified', 'content_length', 'last_fetched_at', 'raw_digest', 'text_digest')
+        }
+
+    interval = schedule.next_interval(
+        page.check_interval if page is not None else None,
+        changed=changed,
+        hot=page is not None and page.is_hot,
+        failed=not (result.ok or result.not_modified)
+    )
+    values.update(
+        check_interval=interval,
+        next_check_at=schedule.next_check_at(now, interval),
+        last_checked_at=now,
+        last_changed_at=now if changed else (page.last_changed_at if page is not None else None)
+    )
+    return values
+
+
+def save_page_checks(checks, schedule, connection=None):
+    """
+    Stores the outcome of the checks of some pages: the HTTP validators of
+    the pages fully fetched over plain HTTP (so that the next check can ask
+    the server whether the page changed; pages rendered in a browser have
+    their validators cleared), the fingerprints of the pages fully fetched
+    (so that the next check needn't parse an unchanged page) and the next
+    check time of every page.
+
+    Parameters:
+    - checks (list): [(`FetchResult`, changed), ...]; `changed` tells whether
+      any ad on the page changed.
+    - schedule (AdaptiveSchedule): Decides the next check of the pages.
+    - connection (optional): A connection whose transaction the pages are
+      written in; by default they are committed on their own.
+    """
+    if not checks:
+        return
+    if connection is None:
+        with db.engine.begin() as connection:
+            return save_page_checks(checks, schedule, connection)
+
+    now = datetime.utcnow()
+    table = MonitoredPage.__table__
+    checks = {result.url: (result, changed) for result, changed in checks}
+
+    existing = {
+        page.url: page
+        for page in connection.execute(select(table).where(table.c.url.in_(checks.keys())))
+    }
+
+    # (bind parameters can't share the names of the updated columns)
+    updates = []
+    inserts = []
+    for url, (result, changed) in checks.items():
+        page = existing.get(url)
+        values = _page_check_values(page, result, changed, now, schedule)
+        if page is None:
+            inserts.append({'url': url, **values})
+        else:
+            updates.append({'_id': page.id, **{f'new_{column}': value for column, value in values.items()}})
+
+    if updates:
+        connection.execute(
+            update(table).where(table.c.id == bindparam('_id')).values(
+                **{column: bindparam(f'new_{column}') for column in PAGE_CHECK_COLUMNS}
+            ),
+            updates
+        )
+    if inserts:
+        connection.execute(insert(table), inserts)
+
+
+def load_page_schedule():
+    """Returns {url: next_check_at} of the monitored pages (None means due)."""
+    return dict(db.session.query(MonitoredPage.url, MonitoredPage.next_check_at).all())
+
+
+def load_due_ads(now=None, max_pages=None):
+    """
+    Returns the ads (with their users and targets) of the pages due for a check: the
+    pages whose `next_check_at` has passed and the pages never checked. With
+    `max_pages` only that many pages are taken, the most overdue first (the
+    never checked ones before all others).
+    """
+    now = now or datetime.utcnow()
+    schedule = load_page_schedule()
+
+    # The canonical urls of the due pages
+    urls = []
+    not_normalized = False  # (Ads whose `normalized_url` isn't backfilled yet; always due)
+    for (url,) in db.session.query(MonitoredAd.normalized_url).distinct():
+        if url is None:
+            not_normalized = True
+            continue
+        next_check_at = schedule.get(url)
+        if next_check_at is None or next_check_at <= now:
+            urls.append(url)
+
+    urls.sort(key=lambda url: schedule.get(url) or datetime.min)
+    if max_pages:
+        urls = urls[:max_pages]
+
+    ads = []
+    if not_normalized:
+        ads.extend(
+            MonitoredAd.query.options(joinedload(MonitoredAd.user), joinedload(MonitoredAd.target))
+            .filter(MonitoredAd.normalized_url.is_(None))
+            .all()
+        )
+    for i in range(0, len(urls), 500):
+        ads.extend(
+            MonitoredAd.query.options(joinedload(MonitoredAd.user), joinedload(MonitoredAd.target))
+            .filter(MonitoredAd.normalized_url.in_(urls[i:i + 500]))
+            .all()
+        )
+    return ads
+
+
+def load_ads(ad_ids):
+    """
+    Returns the ads (with their users and targets) of the given ids that still exist.
+    """
+    ad_ids = list(ad_ids)
+    ads = []
+    for i in range(0, len(ad_ids), 500):
+        ads.extend(
+            MonitoredAd.query.options(joinedload(MonitoredAd.user), joinedload(MonitoredAd.target))
+            .filter(MonitoredAd.id.in_(ad_ids[i:i + 500]))
+            .all()
+        )
+    return ads
+
+
+def set_page_hot(url: str, hot: bool = True):
+    """
+    Marks a page (canonical url) as hot, so that it is checked at the
+    minimum interval from now on (starting right away), or unmarks it.
+    """
+    page = MonitoredPage.query.filter_by(url=url).first()
+    if page is None:
+        page = MonitoredPage(url=url)
+        db.session.add(page)
+
+    page.is_hot = hot
+    if hot:
+        page.next_check_at = datetime.utcnow()
+    db.session.commit()
+    return page
+
+
+class AdUpdateWriter:
+    """
+    Collects the updates of the tracked targets during a check run and
+    writes them back in batches: one bulk UPDATE (and one commit) per batch
+    instead of one transaction per changed target.
+
+    A batch is written once it holds `batch_size` targets, but only between
+    pages, so that the targets of a page and the page's validators and next
+    check time (see `save_page_checks`) always land in the same transaction.
+    A batch that fails is rolled back on its own: its targets keep their old
+    state, its pages get no validators (so they are fully fetched next time)
+    and stay due, and `on_written` isn't called for them.
+
+    A change worth a notification fans out to every subscriber of the
+    target: their `last_updated` is bumped in the same batch and
+    `on_written` is called for each of them.
+
+    The updates go through their own connection and leave the ORM session
+    (and the targets loaded in it) alone.
+
+    Parameters:
+    -----------
+        `batch_size`: `int`; (Targets per batch)
+        `on_written`: `callable`; (Called as `on_written(ad, new_count)` for
+                      every subscriber to notify once its batch is committed)
+        `schedule`: `AdaptiveSchedule`; (Decides the next check of the pages)
+    """
+
+    COLUMNS = ('occurrence_count', 'page_content_hash', 'hash_scheme', 'region_locator', 'last_updated')
+
+    def __init__(self, batch_size=200, on_written=None, schedule=None):
+        self.batch_size = max(1, batch_size)
+        self.on_written = on_written
+        self.schedule = schedule or AdaptiveSchedule()
+        self.stats = {'written': 0, 'batches': 0, 'failed_batches': 0, 'failed': 0, 'notified_ads': 0}
+        self._rows = []
+        self._callbacks = []
+        self._changed_targets = []
+        self._pages = []
+        self._page_changed = False
+
+    def update(self, target, subscribers=None, **values):
+        """
+        Queues an update of the target. `values` are the new values of some
+        of `COLUMNS`; the others keep the target's current values. With
+        `subscribers` (its `MonitoredAd`s) the change is notified to them.
+        """
+        row = {f'new_{column}': values.get(column, getattr(target, column)) for column in self.COLUMNS}
+        row['_id'] = target.id
+        self._rows.append(row)
+        if subscribers:
+            # A change worth a notification is a change of the page.
+            self._callbacks.extend((ad, row['new_occurrence_count']) for ad in subscribers)
+            self._changed_targets.append({'_target_id': target.id, 'new_last_updated': row['new_last_updated']})
+            self._page_changed = True
+
+    def page_done(self, page):
+        """
+        Marks the end of the updates of the targets of a page; `page` is its
+        fetch result (possibly not modified or failed).
+        """
+        self._pages.append((page, self._page_changed))
+        self._page_changed = False
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the queued updates as one batch."""
+        if not (self._rows or self._pages):
+            return
+
+        rows, callbacks, changed_targets, pages = self._rows, self._callbacks, self._changed_targets, self._pages
+        self._rows, self._callbacks, self._changed_targets, self._pages = [], [], [], []
+
+        table = TrackedTarget.__table__
+        ad_table = MonitoredAd.__table__
+        try:
+            with db.engine.begin() as connection:
+                if rows:
+                    connection.execute(
+                        update(table).where(table.c.id == bindparam('_id')).values(
+                            **{column: bindparam(f'new_{column}') for column in self.COLUMNS}
+                        ),
+                        rows
+                    )
+                if changed_targets:
+                    connection.execute(
+                        update(ad_table).where(ad_table.c.target_id == bindparam('_target_id')).values(
+                            last_updated=bindparam('new_last_updated')
+                        ),
+                        changed_targets
+                    )
+                save_page_checks(pages, self.schedule, connection)
+        except SQLAlchemyError as e:
+            self.stats['failed_batches'] += 1
+            self.stats['failed'] += len(rows)
+            logger.error(
+                f"TASK_ERR: Couldn't write a batch of {len(rows)} target updates ({len(pages)} pages); "
+                f"it was rolled back.\t {e}"
+            )
+            return
+
+        self.stats['batches'] += 1
+        self.stats['written'] += len(rows)
+        self.stats['notified_ads'] += len(callbacks)
+        if self.on_written is not None:
+            for ad, new_count in callbacks:
+                self.on_written(ad, new_count)
@@ -0,0 +1,317 @@
+# app/validation_jobs.py
+#
+# Author: Indrajit Ghosh
+# Created On: Mar 13, 2024
+#
+
+"""
+Validation jobs, so that adding or updating an ad doesn't render its webpage
+inside the request.
+
+The routes only queue a job and answer with its id right away:
+
+    >>> job = queue_validation('add', user_id=current_user.id, title=..., advertisement_number=...,
+    ...                        website_url=..., description=...)
+
+and the validation job of the app (or `python manage.py validate_ads` on its
+own) does the slow part:
+
+    - it leases a batch of pending jobs (a conditional UPDATE followed by a
+      read of the rows carrying its lease token, as the outbox does),
+    - fetches their pages a few at a time (`workers`) through the page
+      cache, so the jobs on a page just fetched (or being fetched) don't
+      fetch it again,
+    - adds (or updates) an ad only if its advertisement number is on the
+      page, and records the outcome on the job,
+    - a page that couldn't be fetched is tried again, up to `max_attempts`,
+      after a backoff doubling with every attempt (as the outbox does).
+
+The dashboard polls `auth.validation_status` for the outcome.
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from apscheduler.jobstores.base import JobLookupError
+from sqlalchemy import and_, or_
+
+from app.extensions import db, scheduler, page_cache
+from app.models.user import MonitoredAd
+from app.models.validation_job import ValidationJob
+from app.outbox import backoff_seconds
+from app.utils.database_helpers import get_or_create_target
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = 'pending'
+STATUS_RUNNING = 'running'
+STATUS_SUCCEEDED = 'succeeded'
+STATUS_FAILED = 'failed'
+
+KIND_ADD = 'add'
+KIND_UPDATE = 'update'
+KIND_REFRESH = 'refresh'  # Only the count and the hash of an ad's target (by the admins)
+
+VALIDATION_JOB_ID = "validate_ads_job"
+
+
+def queue_validation(kind: str, user_id: int, ad: MonitoredAd = None, **fields):
+    """
+    Queues a validation job.
+
+    Parameters:
+    - kind (str): 'add', 'update' or 'refresh'.
+    - user_id (int): The user asking for it (the owner of an added ad).
+    - ad (MonitoredAd, optional): The ad to update or refresh.
+    - fields: The title, advertisement_number, website_url and description
+      asked for (a refresh takes them from the ad).
+
+    Returns:
+    ValidationJob: The queued job.
+    """
+    if kind == KIND_REFRESH:
+        fields = {
+            'title': ad.title,
+            'advertisement_number': ad.advertisement_number,
+            'website_url': ad.website_url,
+            'description': ad.description
+        }
+
+    job = ValidationJob(
+        id=uuid4().hex,
+        kind=kind,
+        user_id=user_id,
+        ad_id=ad.id if ad is not None else None,
+        status=STATUS_PENDING,
+        **fields
+    )
+    db.session.add(job)
+    db.session.commit()
+    wake_validator()
+    return job
+
+
+def wake_validator():
+    """Lets the validation job of this process run right away (if it is scheduled)."""
+    try:
+        scheduler.modify_job(VALIDATION_JOB_ID, next_run_time=datetime.now())
+    except (JobLookupError, AttributeError):
+        pass
+    except Exception as e:
+        logger.debug(f"VALIDATION: Couldn't wake the validation job. \t {e}")
+
+
+def _claimable(now):
+    return or_(
+        and_(
+            ValidationJob.status == STATUS_PENDING,
+            or_(ValidationJob.not_before.is_(None), ValidationJob.not_before <= now)
+        ),
+        and_(ValidationJob.status == STATUS_RUNNING, ValidationJob.lease_expires_at < now)
+    )
+
+
+def claim_validations(batch_size: int, lease_seconds: int):
+    """
+    Leases up to `batch_size` jobs, the oldest first.
+
+    Returns:
+    list: The leased `ValidationJob`s (empty if none is pending).
+    """
+    now = datetime.utcnow()
+
+    ids = [
+        job_id for (job_id,) in db.session.query(ValidationJob.id)
+        .filter(_claimable(now))
+        .order_by(ValidationJob.created_at)
+        .limit(batch_size)
+    ]
+    if not ids:
+        db.session.commit()
+        return []
+
+    lease_token = uuid4().hex
+    ValidationJob.query.filter(ValidationJob.id.in_(ids), _claimable(now)).update(
+        {
+            ValidationJob.status: STATUS_RUNNING,
+            ValidationJob.lease_token: lease_token,
+            ValidationJob.lease_expires_at: now + timedelta(seconds=lease_seconds),
+            ValidationJob.attempts: ValidationJob.attempts + 1
+        },
+        synchronize_session=False
+    )
+    db.session.commit()
+
+    return ValidationJob.query.filter_by(lease_token=lease_token).order_by(ValidationJob.created_at).all()
+
+
+def _finish(job, status: str, message: str):
+    job.status = status
+    job.message = message
+    job.finished_at = datetime.utcnow()
+    job.lease_token = job.lease_expires_at = None
+
+
+class ValidationRunner:
+    """
+    Runs the validation jobs in batches.
+
+    Parameters:
+    -----------
+        `fetcher`: `PageCache`; (Fetches the pages; concurrent jobs on a page share one fetch)
+        `workers`: `int`; (Pages fetched at once)
+        `batch_size`: `int`; (Jobs leased at once)
+        `lease_seconds`: `int`; (How long a lease lasts; a job of a crashed runner is run again afterwards)
+        `max_attempts`: `int`; (Attempts to fetch the page of a job)
+        `base_backoff`, `max_backoff`: `int`; (Seconds a job waits before it is retried; see `backoff_seconds`)
+    """
+
+    def __init__(self, fetcher=page_cache, workers=2, batch_size=10, lease_seconds=300, max_attempts=2,
+                 base_backoff=30, max_backoff=600):
+        self.fetcher = fetcher
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+    @classmethod
+    def from_config(cls, config, fetcher=page_cache):
+        return cls(
+            fetcher=fetcher,
+            workers=config['VALIDATION_WORKERS'],
+            batch_size=config['VALIDATION_BATCH_SIZE'],
+            lease_seconds=config['VALIDATION_LEASE_SECONDS'],
+            max_attempts=config['VALIDATION_MAX_ATTEMPTS'],
+            base_backoff=config['VALIDATION_BASE_BACKOFF'],
+            max_backoff=config['VALIDATION_MAX_BACKOFF']
+        )
+
+    def _evaluate(self, url: str, adv_num: str):
+        # (Runs in a worker thread: no database work here.)
+        try:
+            return self.fetcher.evaluate(url, [adv_num])
+        except Exception as e:
+            logger.error(f"VALIDATION: Error while fetching '{url}'. \t {e}")
+            return None
+
+    def _apply(self, job, page):
+        """Adds/updates the ad of the job if the page has its advertisement number."""
+        occurrence_count, page_hash = page.counts[job.advertisement_number] if page is not None else (-1, None)
+
+        if occurrence_count < 0 or (occurrence_count > 0 and not page_hash):
+            if job.attempts < self.max_attempts:
+                # The page may only be slow right now; try once more (after a while).
+                job.status = STATUS_PENDING
+                job.lease_token = job.lease_expires_at = None
+                job.not_before = datetime.utcnow() + timedelta(
+                    seconds=backoff_seconds(job.attempts, self.base_backoff, self.max_backoff)
+                )
+                return
+            _finish(
+                job, STATUS_FAILED,
+                "An error occurred while trying to access the webpage. Please verify that the URL is valid."
+            )
+            return
+
+        if occurrence_count == 0:
+            _finish(
+                job, STATUS_FAILED,
+                f"The advertisement with the number '{job.advertisement_number}' is not present on the webpage. "
+                "Please retry with a different advertisement number."
+            )
+            return
+
+        if job.kind == KIND_ADD:
+            ad = MonitoredAd(user_id=job.user_id)
+        else:
+            ad = MonitoredAd.query.get(job.ad_id)
+            if ad is None:
+                _finish(job, STATUS_FAILED, "The advertisement no longer exists.")
+                return
+
+        if job.kind in (KIND_ADD, KIND_UPDATE):
+            # (The target first: a new ad can't be flushed without it.)
+            target, rebaseline = get_or_create_target(job.website_url, job.advertisement_number)
+            ad.title = job.title
+            ad.advertisement_number = job.advertisement_number
+            ad.website_url = job.website_url
+            ad.description = job.description
+            ad.target = target
+            db.session.add(ad)
+        else:
+            target, rebaseline = ad.target, True
+
+        # A target tracked by others keeps its state: a change the check runs
+        # haven't seen yet must still be notified to its subscribers. (Only a
+        # new target, or the admins' refresh, takes the state of this fetch.)
+        if rebaseline:
+            target.occurrence_count = occurrence_count
+            target.page_content_hash = page_hash
+            target.hash_scheme = page.hash_scheme
+            target.region_locator = (page.locators or {}).get(job.advertisement_number)
+            target.last_updated = datetime.utcnow()
+        ad.last_updated = datetime.utcnow()
+        db.session.flush()
+
+        job.ad_id = ad.id
+        _finish(
+            job, STATUS_SUCCEEDED,
+            "Advertisement entry added successfully!" if job.kind == KIND_ADD
+            else "The advertisement updated successfully."
+        )
+        logger.info(f"VALIDATION: Job '{job.id}' ({job.kind}) of the user {job.user_id} succeeded for the ad {ad.id}.")
+
+    def run_batch(self):
+        """
+        Leases and runs one batch.
+
+        Returns:
+        int: The number of jobs leased.
+        """
+        jobs = claim_validations(self.batch_size, self.lease_seconds)
+        if not jobs:
+            return 0
+
+        targets = [(job.website_url, job.advertisement_number) for job in jobs]
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(jobs)), thread_name_prefix="validation") as executor:
+            pages = list(executor.map(lambda target: self._evaluate(*target), targets))
+
+        for job, page in zip(jobs, pages):
+            try:
+                self._apply(job, page)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                _finish(job, STATUS_FAILED, "Error. Looks like there was a problem to update the information into the database.")
+                db.session.commit()
+                logger.error(f"VALIDATION: Database error in the job '{job.id}'. \t {e}")
+        return len(jobs)
+
+    def run(self, poll_interval=5, once=False):
+        """Runs the jobs until none can be run (`once`; retries still backing off are left) or forever."""
+        total = 0
+        while True:
+            leased = self.run_batch()
+            total += leased
+            if not leased:
+                if once:
+                    return total
+                time.sleep(poll_interval)
+
+
+def validation_status(job):
+    """The status of a job as the dashboard gets it."""
+    return {
+        'job_id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'finished': job.finished,
+        'success': job.status == STATUS_SUCCEEDED,
+        'message': job.message,
+        'ad_id': job.ad_id
+    }
@@ -57,7 +57,140 @@ class DatabaseConfig:
         )
 
 
-class DevelopmentConfig:
+class CheckerConfig:
+    # Headless browser pool shared by the check job and the web routes
+    BROWSER_POOL_SIZE = int(os.environ.get("BROWSER_POOL_SIZE", 2))
+    BROWSER_MAX_PAGES = int(os.environ.get("BROWSER_MAX_PAGES", 50))
+    BROWSER_MAX_RSS_MB = int(os.environ.get("BROWSER_MAX_RSS_MB", 1024))
+    BROWSER_CHECKOUT_TIMEOUT = int(os.environ.get("BROWSER_CHECKOUT_TIMEOUT", 300))
+
+    # Concurrent fetching during the check runs
+    FETCH_CONCURRENCY = int(os.environ.get("FETCH_CONCURRENCY", 16))
+    FETCH_PER_HOST_CONCURRENCY = int(os.environ.get("FETCH_PER_HOST_CONCURRENCY", 2))
+
+    # Timeouts (seconds) of every fetch: establishing a connection, waiting
+    # for the server to send data and loading a page in the browser
+    FETCH_CONNECT_TIMEOUT = float(os.environ.get("FETCH_CONNECT_TIMEOUT", 10))
+    FETCH_READ_TIMEOUT = float(os.environ.get("FETCH_READ_TIMEOUT", 30))
+    FETCH_RENDER_TIMEOUT = float(os.environ.get("FETCH_RENDER_TIMEOUT", 45))
+
+    # ... and of a page as a whole (not counting its wait for a browser); by
+    # default long enough for all the stages of a page falling back to the browser
+    FETCH_TIMEOUT = float(os.environ.get(
+        "FETCH_TIMEOUT", FETCH_CONNECT_TIMEOUT + FETCH_READ_TIMEOUT + FETCH_RENDER_TIMEOUT
+    ))
+
+    # Politeness: requests per second per host (with bursts of FETCH_RATE_BURST),
+    # per-domain overrides like 'wbpsc.gov.in=0.2,example.com=5' and whether the
+    # Crawl-delay of robots.txt is honoured. A rate of 0 means no limit.
+    FETCH_RATE_PER_HOST = float(os.environ.get("FETCH_RATE_PER_HOST", 1))
+    FETCH_RATE_BURST = int(os.environ.get("FETCH_RATE_BURST", 2))
+    FETCH_RATE_OVERRIDES = os.environ.get("FETCH_RATE_OVERRIDES", "")
+    FETCH_RESPECT_ROBOTS = os.environ.get("FETCH_RESPECT_ROBOTS", "0").lower() in ("1", "true", "yes")
+
+    # Html parser for counting and hashing: 'html.parser', 'lxml' or 'selectolax'
+    HTML_PARSER = os.environ.get("HTML_PARSER", "html.parser")
+
+    # Worker processes fetching, parsing and counting the pages of a check
+    # run (sharded by domain); 1 runs everything in the app process.
+    CHECK_WORKERS = int(os.environ.get("CHECK_WORKERS", 1))
+
+    # Ad updates written back per transaction during a check run
+    CHECK_WRITE_BATCH_SIZE = int(os.environ.get("CHECK_WRITE_BATCH_SIZE", 200))
+
+    # Ads read from the database and checked at once during a check run
+    CHECK_WINDOW_SIZE = int(os.environ.get("CHECK_WINDOW_SIZE", 1000))
+
+    # Adaptive scheduling (off by default: the pages are checked once a day
+    # as before): every page is checked at its own interval (in seconds),
+    # learned from how often it changes. The scheduled job runs every
+    # CHECK_TICK_SECONDS and checks the pages due by then.
+    CHECK_ADAPTIVE = os.environ.get("CHECK_ADAPTIVE", "0").lower() in ("1", "true", "yes")
+    CHECK_MIN_INTERVAL = int(os.environ.get("CHECK_MIN_INTERVAL", 3600))
+    CHECK_MAX_INTERVAL = int(os.environ.get("CHECK_MAX_INTERVAL", 7 * 86400))
+    CHECK_DEFAULT_INTERVAL = int(os.environ.get("CHECK_DEFAULT_INTERVAL", 86400))
+    CHECK_TICK_SECONDS = int(os.environ.get("CHECK_TICK_SECONDS", 600))
+    CHECK_TICK_MAX_PAGES = int(os.environ.get("CHECK_TICK_MAX_PAGES", 500))
+
+    # Deadline (seconds) of a check run; the pages not checked by then are
+    # deferred to the next run (0 means no deadline).
+    CHECK_RUN_DEADLINE = int(os.environ.get("CHECK_RUN_DEADLINE", 3600))
+
+    # Circuit breaker: a domain failing CHECK_BREAKER_THRESHOLD times in a row
+    # is skipped for CHECK_BREAKER_BASE_BACKOFF seconds, doubled on every
+    # further opening up to CHECK_BREAKER_MAX_BACKOFF.
+    CHECK_BREAKER_THRESHOLD = int(os.environ.get("CHECK_BREAKER_THRESHOLD", 3))
+    CHECK_BREAKER_BASE_BACKOFF = int(os.environ.get("CHECK_BREAKER_BASE_BACKOFF", 1800))
+    CHECK_BREAKER_MAX_BACKOFF = int(os.environ.get("CHECK_BREAKER_MAX_BACKOFF", 7 * 86400))
+
+    # Check queue: with CHECK_QUEUE on the scheduled job only queues the ads
+    # and `python manage.py check_worker` processes check them.
+    CHECK_QUEUE = os.environ.get("CHECK_QUEUE", "0").lower() in ("1", "true", "yes")
+    CHECK_QUEUE_BATCH_PAGES = int(os.environ.get("CHECK_QUEUE_BATCH_PAGES", 20))
+    CHECK_QUEUE_LEASE_SECONDS = int(os.environ.get("CHECK_QUEUE_LEASE_SECONDS", 600))
+    CHECK_QUEUE_MAX_ATTEMPTS = int(os.environ.get("CHECK_QUEUE_MAX_ATTEMPTS", 3))
+    CHECK_QUEUE_POLL_INTERVAL = float(os.environ.get("CHECK_QUEUE_POLL_INTERVAL", 30))
+
+    # Outgoing mail: every email is sent through a pool of at most
+    # SMTP_POOL_SIZE logged in sessions, each replaced after SMTP_MAX_MESSAGES
+    # messages or SMTP_IDLE_TIMEOUT idle seconds.
+    MAIL_SERVER = EmailConfig.GMAIL_SERVER
+    MAIL_USERNAME = EmailConfig.INDRAJITS_BOT_EMAIL_ID
+    MAIL_PASSWORD = EmailConfig.INDRAJITS_BOT_EMAIL_PASSWD
+    SMTP_POOL_SIZE = int(os.environ.get("SMTP_POOL_SIZE", 2))
+    SMTP_MAX_MESSAGES = int(os.environ.get("SMTP_MAX_MESSAGES", 100))
+    SMTP_IDLE_TIMEOUT = float(os.environ.get("SMTP_IDLE_TIMEOUT", 60))
+    SMTP_CHECKOUT_TIMEOUT = float(os.environ.get("SMTP_CHECKOUT_TIMEOUT", 120))
+    SMTP_TIMEOUT = float(os.environ.get("SMTP_TIMEOUT", 30))
+
+    # Outbox: the emails are queued in the database and sent by a dispatcher
+    # job of the app every OUTBOX_POLL_SECONDS (turn OUTBOX_DISPATCH off to run
+    # `python manage.py dispatch_outbox` instead). A failed email is retried
+    # after OUTBOX_BASE_BACKOFF seconds, doubled with every attempt up to
+    # OUTBOX_MAX_BACKOFF, and dead-lettered after OUTBOX_MAX_ATTEMPTS attempts.
+    OUTBOX_DISPATCH = os.environ.get("OUTBOX_DISPATCH", "1").lower() in ("1", "true", "yes")
+    OUTBOX_POLL_SECONDS = int(os.environ.get("OUTBOX_POLL_SECONDS", 30))
+    OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", 50))
+    OUTBOX_LEASE_SECONDS = int(os.environ.get("OUTBOX_LEASE_SECONDS", 300))
+    OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 5))
+    OUTBOX_BASE_BACKOFF = int(os.environ.get("OUTBOX_BASE_BACKOFF", 60))
+    OUTBOX_MAX_BACKOFF = int(os.environ.get("OUTBOX_MAX_BACKOFF", 3600))
+
+    # Telegram: the notifications of a run are sent by TELEGRAM_WORKERS threads
+    # at once, at most TELEGRAM_RATE_PER_SECOND messages a second overall and
+    # one every TELEGRAM_PER_CHAT_INTERVAL seconds to the same chat.
+    TELEGRAM_BOT_TOKEN = INDRA_ADNOTIFIER_TELEGRAM_BOT_TOKEN
+    TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
+    TELEGRAM_WORKERS = int(os.environ.get("TELEGRAM_WORKERS", 8))
+    TELEGRAM_RATE_PER_SECOND = float(os.environ.get("TELEGRAM_RATE_PER_SECOND", 25))
+    TELEGRAM_PER_CHAT_INTERVAL = float(os.environ.get("TELEGRAM_PER_CHAT_INTERVAL", 1))
+    TELEGRAM_MAX_ATTEMPTS = int(os.environ.get("TELEGRAM_MAX_ATTEMPTS", 3))
+
+    # Validation jobs: adding/updating an ad only queues a job; a job of the
+    # app runs them every VALIDATION_POLL_SECONDS (and right after one is
+    # queued), fetching VALIDATION_WORKERS pages at once. Turn
+    # VALIDATION_DISPATCH off to run `python manage.py validate_ads` instead.
+    VALIDATION_DISPATCH = os.environ.get("VALIDATION_DISPATCH", "1").lower() in ("1", "true", "yes")
+    VALIDATION_POLL_SECONDS = int(os.environ.get("VALIDATION_POLL_SECONDS", 10))
+    VALIDATION_WORKERS = int(os.environ.get("VALIDATION_WORKERS", 2))
+    VALIDATION_BATCH_SIZE = int(os.environ.get("VALIDATION_BATCH_SIZE", 10))
+    VALIDATION_LEASE_SECONDS = int(os.environ.get("VALIDATION_LEASE_SECONDS", 300))
+    VALIDATION_MAX_ATTEMPTS = int(os.environ.get("VALIDATION_MAX_ATTEMPTS", 2))
+    # A job whose page couldn't be fetched is retried after VALIDATION_BASE_BACKOFF
+    # seconds, doubled on every further attempt up to VALIDATION_MAX_BACKOFF.
+    VALIDATION_BASE_BACKOFF = int(os.environ.get("VALIDATION_BASE_BACKOFF", 30))
+    VALIDATION_MAX_BACKOFF = int(os.environ.get("VALIDATION_MAX_BACKOFF", 600))
+
+    # Page cache of the on-demand checks (validation jobs): a fetched page is
+    # reused for PAGE_CACHE_TTL seconds, at most PAGE_CACHE_MAX_BYTES of html
+    # are kept in memory, and with PAGE_CACHE_DIR the pages are shared by all
+    # processes of the host.
+    PAGE_CACHE_TTL = int(os.environ.get("PAGE_CACHE_TTL", 120))
+    PAGE_CACHE_MAX_BYTES = int(os.environ.get("PAGE_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+    PAGE_CACHE_DIR = os.environ.get("PAGE_CACHE_DIR", "")
+
+
+class DevelopmentConfig(CheckerConfig):
     DEBUG = True
     SECRET_KEY = os.environ.get('SECRET_KEY') or token_hex(16)
     SECURITY_PASSWORD_SALT = os.environ.get('SECURITY_PASSWORD_SALT') or token_hex(16)
@@ -67,7 +200,7 @@ class DevelopmentConfig:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
 
-class ProductionConfig:
+class ProductionConfig(CheckerConfig):
     DEBUG = False
     SECRET_KEY = os.environ.get('SECRET_KEY') or token_hex(16)
     SECURITY_PASSWORD_SALT = os.environ.get('SECURITY_PASSWORD_SALT') or token_hex(16)
@@ -7,7 +7,12 @@ from flask import current_app
 from flask.cli import FlaskGroup
 from app.extensions import db
 from app.models.user import User
-from app.utils.database_helpers import update_page_content_hashes
+from app.utils.database_helpers import update_page_content_hashes, set_page_hot, backfill_normalized_urls
+from scripts.utils import canonicalize_url
+from app.check_queue import CheckWorker, enqueue_checks, queue_stats
+from app.outbox import OutboxDispatcher, outbox_stats
+from app.validation_jobs import ValidationRunner
+import click
 import getpass
 
 cli = FlaskGroup(current_app)
@@ -15,9 +20,9 @@ cli = FlaskGroup(current_app)
 @cli.command("update_hashes")
 def update_hashes():
     """
-    Command-line utility to update the page_content_hash for MonitoredAd records.
+    Command-line utility to update the page_content_hash for TrackedTarget records.
 
-    This command calculates and updates the page_content_hash for MonitoredAd records
+    This command calculates and updates the page_content_hash for TrackedTarget records
     with a None value.
 
     Usage:
@@ -88,5 +93,110 @@ def create_admin():
             print(f"\nERROR: {e}")
 
 
+@cli.command("enqueue_checks")
+def enqueue_checks_command():
+    """
+    Puts every ad on the check queue for the check workers.
+
+    Usage:
+        python manage.py enqueue_checks
+    """
+    with current_app.app_context():
+        enqueued = enqueue_checks(window_size=current_app.config['CHECK_WINDOW_SIZE'])
+        print(f"{enqueued} ads put on the check queue.")
+        print(queue_stats())
+
+
+@cli.command("check_worker")
+@click.option("--once", is_flag=True, help="Exit once the queue is empty instead of waiting for more.")
+@click.option("--batch-pages", type=int, default=None, help="Pages leased at once (CHECK_QUEUE_BATCH_PAGES).")
+@click.option("--worker-id", default=None, help="Name of the worker in the queue (host:pid by default).")
+def check_worker(once, batch_pages, worker_id):
+    """
+    Runs a check worker: leases batches of ads from the check queue and
+    checks them. Any number of workers can run at once, on any host that can
+    reach the database.
+
+    Usage:
+        python manage.py check_worker [--once] [--batch-pages 20]
+    """
+    from app.tasks import check_ads, notify_user
+
+    worker = CheckWorker(
+        current_app._get_current_object(), check_ads, notify_user, worker_id=worker_id, batch_pages=batch_pages
+    )
+    checked = worker.run(once=once)
+    print(f"{checked} ads checked.")
+
+
+@cli.command("dispatch_outbox")
+@click.option("--once", is_flag=True, help="Exit once no email is due instead of waiting for more.")
+def dispatch_outbox(once):
+    """
+    Sends the queued emails of the outbox (with OUTBOX_DISPATCH off the app
+    leaves this to this command).
+
+    Usage:
+        python manage.py dispatch_outbox [--once]
+    """
+    config = current_app.config
+    dispatcher = OutboxDispatcher.from_config(config)
+    stats = dispatcher.run(poll_interval=config['OUTBOX_POLL_SECONDS'], once=once)
+    print(f"{stats['sent']} emails sent, {stats['failed']} failed.")
+    print(outbox_stats())
+
+
+@cli.command("validate_ads")
+@click.option("--once", is_flag=True, help="Exit once no job is pending instead of waiting for more.")
+def validate_ads(once):
+    """
+    Runs the validation jobs of the added/updated ads (with
+    VALIDATION_DISPATCH off the app leaves this to this command).
+
+    Usage:
+        python manage.py validate_ads [--once]
+    """
+    config = current_app.config
+    runner = ValidationRunner.from_config(config)
+    jobs = runner.run(poll_interval=config['VALIDATION_POLL_SECONDS'], once=once)
+    print(f"{jobs} validation jobs run.")
+
+
+@cli.command("normalize_urls")
+def normalize_urls():
+    """
+    Backfills the canonical url (`MonitoredAd.normalized_url`) of the
+    existing ads and merges the targets, pages and queued checks of the
+    different spellings of a url (http/https, 'www.', a trailing slash,
+    tracking query params, fragments) into one. Run it after upgrading
+    (and after `flask db upgrade`); running it again is harmless.
+
+    Usage:
+        python manage.py normalize_urls
+    """
+    with current_app.app_context():
+        backfilled = backfill_normalized_urls()
+        print(
+            f"{backfilled['ads']} ads got their canonical url; "
+            f"{backfilled['targets']} targets and {backfilled['pages']} pages merged."
+        )
+
+
+@cli.command("hot_page")
+@click.argument("url")
+@click.option("--off", is_flag=True, help="Unmark the page.")
+def hot_page(url, off):
+    """
+    Marks a page as hot: it is checked right away and then at the minimum
+    check interval (CHECK_MIN_INTERVAL), whatever its change history says.
+
+    Usage:
+        python manage.py hot_page https://wbpsc.gov.in [--off]
+    """
+    with current_app.app_context():
+        page = set_page_hot(canonicalize_url(url), hot=not off)
+        print(f"'{page.url}' is {'no longer ' if off else ''}hot.")
+
+
 if __name__ == '__main__':
     cli()
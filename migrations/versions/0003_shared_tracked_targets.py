@@ -0,0 +1,145 @@
+"""shared tracked targets
+
+Moves the check state of the ads (`occurrence_count`, `page_content_hash`,
+`hash_scheme`) to shared targets: one `tracked_target` per canonical url and
+advertisement number, holding the state of its most recently updated ad,
+and every ad pointing to its target.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 17:31:13.100814
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+from scripts.utils import canonicalize_url
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+STATE_COLUMNS = ('occurrence_count', 'page_content_hash', 'hash_scheme')
+
+# (Lightweight tables: the models may have moved on since.)
+monitored_ad = sa.table(
+    'monitored_ad',
+    sa.column('id', sa.Integer),
+    sa.column('website_url', sa.String),
+    sa.column('advertisement_number', sa.String),
+    sa.column('last_updated', sa.DateTime),
+    sa.column('target_id', sa.Integer),
+    sa.column('occurrence_count', sa.Integer),
+    sa.column('page_content_hash', sa.String),
+    sa.column('hash_scheme', sa.String),
+)
+tracked_target = sa.table(
+    'tracked_target',
+    sa.column('id', sa.Integer),
+    sa.column('url', sa.String),
+    sa.column('advertisement_number', sa.String),
+    sa.column('occurrence_count', sa.Integer),
+    sa.column('page_content_hash', sa.String),
+    sa.column('hash_scheme', sa.String),
+    sa.column('created_at', sa.DateTime),
+    sa.column('last_updated', sa.DateTime),
+)
+
+
+def upgrade():
+    op.create_table('tracked_target',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('url', sa.String(length=255), nullable=False),
+    sa.Column('advertisement_number', sa.String(length=100), nullable=False),
+    sa.Column('occurrence_count', sa.Integer(), nullable=True),
+    sa.Column('page_content_hash', sa.String(length=128), nullable=True),
+    sa.Column('hash_scheme', sa.String(length=32), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('last_updated', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('url', 'advertisement_number', name='uq_tracked_target_url_adv_num')
+    )
+    with op.batch_alter_table('tracked_target', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_tracked_target_url'), ['url'], unique=False)
+
+    # Nullable until every ad has its target
+    with op.batch_alter_table('monitored_ad', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('target_id', sa.Integer(), nullable=True))
+
+    _backfill_targets(op.get_bind())
+
+    with op.batch_alter_table('monitored_ad', schema=None) as batch_op:
+        batch_op.alter_column('target_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_index(batch_op.f('ix_monitored_ad_target_id'), ['target_id'], unique=False)
+        batch_op.create_foreign_key('fk_monitored_ad_target_id', 'tracked_target', ['target_id'], ['id'])
+        batch_op.drop_column('page_content_hash')
+        batch_op.drop_column('hash_scheme')
+        batch_op.drop_column('occurrence_count')
+
+
+def _backfill_targets(connection):
+    """Creates the target of every ad (the most recently updated ad of a target wins) and points the ad to it."""
+    states = {}
+    ad_targets = {}
+    for row in connection.execute(sa.select(monitored_ad).order_by(monitored_ad.c.last_updated)).mappings():
+        key = (canonicalize_url(row['website_url']), row['advertisement_number'].strip())
+        states[key] = {column: row[column] for column in STATE_COLUMNS}
+        states[key]['last_updated'] = row['last_updated']
+        ad_targets[row['id']] = key
+
+    if not states:
+        return
+
+    now = datetime.utcnow()
+    connection.execute(
+        sa.insert(tracked_target),
+        [
+            {'url': url, 'advertisement_number': adv_num, 'created_at': now, **state}
+            for (url, adv_num), state in states.items()
+        ]
+    )
+    target_ids = {
+        (target.url, target.advertisement_number): target.id
+        for target in connection.execute(sa.select(tracked_target.c.id, tracked_target.c.url, tracked_target.c.advertisement_number))
+    }
+    connection.execute(
+        sa.update(monitored_ad).where(monitored_ad.c.id == sa.bindparam('_id')).values(target_id=sa.bindparam('_target_id')),
+        [{'_id': ad_id, '_target_id': target_ids[key]} for ad_id, key in ad_targets.items()]
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('monitored_ad', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('occurrence_count', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('hash_scheme', sa.String(length=32), nullable=True))
+        batch_op.add_column(sa.Column('page_content_hash', sa.String(length=128), nullable=True))
+
+    # Every ad gets the state of its target back.
+    connection = op.get_bind()
+    connection.execute(
+        sa.update(monitored_ad).values({
+            column: sa.select(getattr(tracked_target.c, column))
+            .where(tracked_target.c.id == monitored_ad.c.target_id)
+            .scalar_subquery()
+            for column in STATE_COLUMNS
+        })
+    )
+    connection.execute(
+        sa.update(monitored_ad).where(monitored_ad.c.page_content_hash.is_(None)).values(page_content_hash='')
+    )
+
+    with op.batch_alter_table('monitored_ad', schema=None) as batch_op:
+        batch_op.alter_column('page_content_hash', existing_type=sa.String(length=128), nullable=False)
+        batch_op.drop_constraint('fk_monitored_ad_target_id', type_='foreignkey')
+        batch_op.drop_index(batch_op.f('ix_monitored_ad_target_id'))
+        batch_op.drop_column('target_id')
+
+    with op.batch_alter_table('tracked_target', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_tracked_target_url'))
+
+    op.drop_table('tracked_target')
@@ -15,17 +15,15 @@ Usage:
     >>> /env/bin/gunicorn --bind 0.0.0.0:5000 run:app
 
 Database initialization:
-    1. flask shell
-        >>> from app import db
-        >>> db.create_all()
+    1. flask db upgrade
 
     2. python run.py
 
 Note: Flask Migration
-    1. flask db init
-    2. flask db migrate -m 'Initial Migrate'
-    3. flask db upgrade
-    These 2 and 3 you need to do everytime you change some in your db!
+    1. flask db migrate -m 'What changed'
+    2. flask db upgrade
+    These you need to do everytime you change some in your db (and ship
+    the new revision in `migrations/versions`)!
 """
 
 from app import create_app
@@ -40,7 +38,10 @@ elif FLASK_ENV == 'prod':
     PORT = 5000
 
 
-app = create_app(config_class=app_config)
+# (Not in the worker processes of a sharded check run, which import this
+# module again as `__mp_main__`: they must not build another app.)
+if __name__ != '__mp_main__':
+    app = create_app(config_class=app_config)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=PORT)
\ No newline at end of file
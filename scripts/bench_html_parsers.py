@@ -0,0 +1,115 @@
+# Benchmark for the html parser backends
+#
+# Author: Indrajit Ghosh
+#
+# Date: Mar 03, 2024
+#
+
+"""
+Counts and hashes the advertisement numbers of a corpus of saved pages with
+every html parser backend and reports the time taken, the peak memory of the
+process and whether the results agree with the default `html.parser`.
+
+Every backend runs in a fresh subprocess so that the peak memory of one
+doesn't hide the other.
+
+The corpus is a directory of saved `.html` pages; a query file `<page>.txt`
+next to a page lists its advertisement numbers (one per line). Without a
+query file the first few words of the page's text are used. Without a corpus
+a synthetic notice board is used.
+
+Usage:
+    >>> python -m scripts.bench_html_parsers [corpus_dir]
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from scripts.html_parser import HTML_PARSERS, parse_html
+from scripts.utils import count_and_hash_page
+from scripts.bench_minimal_tag import make_notice_board, QUERY_STR
+
+QUERIES_PER_PAGE = 5
+
+
+def load_corpus(corpus_dir: str = None):
+    """Returns [(name, html, query_strs), ...]."""
+    if not corpus_dir:
+        return [('synthetic', make_notice_board(2000), [QUERY_STR, 'Notice 7 ', 'Download'])]
+
+    corpus = []
+    for filename in sorted(os.listdir(corpus_dir)):
+        if not filename.endswith(('.html', '.htm')):
+            continue
+        path = os.path.join(corpus_dir, filename)
+        with open(path, encoding='utf-8', errors='replace') as f:
+            html = f.read()
+
+        query_file = os.path.splitext(path)[0] + '.txt'
+        if os.path.exists(query_file):
+            with open(query_file, encoding='utf-8') as f:
+                query_strs = [line.strip() for line in f if line.strip()]
+        else:
+            words = ' '.join(text for text, _ in parse_html(html).iter_texts()).split()
+            query_strs = list(dict.fromkeys(words))[:QUERIES_PER_PAGE]
+
+        corpus.append((filename, html, query_strs))
+    return corpus
+
+
+def run_backend(parser: str, corpus_dir: str = None):
+    """Counts/hashes the corpus with one parser and prints the stats as json."""
+    corpus = load_corpus(corpus_dir)
+
+    start = time.perf_counter()
+    results = {
+        name: count_and_hash_page(html, query_strs, parser=parser)
+        for name, html, query_strs in corpus
+    }
+    elapsed = time.perf_counter() - start
+
+    print(json.dumps({
+        'parser': parser,
+        'pages': len(corpus),
+        'seconds': elapsed,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'results': results
+    }))
+
+
+def main():
+    corpus_dir = sys.argv[1] if len(sys.argv) > 1 else None
+
+    stats = {}
+    for parser in HTML_PARSERS:
+        args = [sys.executable, '-m', 'scripts.bench_html_parsers', '--backend', parser]
+        if corpus_dir:
+            args.append(corpus_dir)
+        proc = subprocess.run(args, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"{parser:>12}: failed ({proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else proc.returncode})")
+            continue
+        stats[parser] = json.loads(proc.stdout)
+
+    baseline = stats.get('html.parser', {}).get('results')
+    print(f"{'parser':>12} {'pages':>6} {'seconds':>9} {'peak rss (MB)':>14} {'mismatches':>11}")
+    for parser, stat in stats.items():
+        mismatches = 'n/a'
+        if baseline is not None:
+            mismatches = sum(
+                stat['results'][name][query_str] != result
+                for name, page_results in baseline.items()
+                for query_str, result in page_results.items()
+            )
+        print(f"{parser:>12} {stat['pages']:>6} {stat['seconds']:9.2f} {stat['peak_rss_mb']:14.1f} {mismatches:>11}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--backend':
+        run_backend(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+    else:
+        main()
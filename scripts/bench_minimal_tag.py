@@ -0,0 +1,76 @@
+# Micro-benchmark for the minimal region computation
+#
+# Author: Indrajit Ghosh
+#
+# Date: Mar 02, 2024
+#
+
+"""
+Times `find_minimal_tag` (lowest common ancestor of the occurrences) against
+the old three-parents-up search on synthetic notice boards with 10 to 10,000
+occurrences of the same advertisement number.
+
+Usage:
+    >>> python -m scripts.bench_minimal_tag
+"""
+
+import time
+
+from bs4 import BeautifulSoup
+
+from scripts.utils import find_minimal_tag
+
+QUERY_STR = 'ADV-83-2020'
+SIZES = [10, 100, 1000, 10000]
+
+
+def legacy_find_minimal_tag(soup: BeautifulSoup, query_str: str, occurrences):
+    """The region search used before the lowest common ancestor computation."""
+    minimal_tag = None
+    for occurrence in occurrences:
+        ancestor = occurrence.find_parent().find_parent().find_parent()
+        if minimal_tag is None or ancestor.find(minimal_tag):
+            minimal_tag = ancestor
+    return minimal_tag
+
+
+def make_notice_board(occurrences: int):
+    """A table of notices where every row mentions the advertisement number."""
+    rows = ''.join(
+        f'<tr><td>{i + 1}</td><td><p><span>Notice {i} regarding {QUERY_STR}</span></p></td>'
+        f'<td><a href="/notices/{i}.pdf">Download</a></td></tr>'
+        for i in range(occurrences)
+    )
+    return (
+        '<html><head><title>Notice Board</title></head><body>'
+        '<div class="header"><h1>Recruitment Notices</h1></div>'
+        f'<div class="content"><table><tbody>{rows}</tbody></table></div>'
+        '</body></html>'
+    )
+
+
+def best_of(func, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    print(f"{'occurrences':>12} {'lca (ms)':>12} {'legacy (ms)':>12}")
+    for size in SIZES:
+        soup = BeautifulSoup(make_notice_board(size), 'html.parser')
+        occurrences = soup.find_all(string=lambda text: QUERY_STR in text)
+        assert len(occurrences) == size
+
+        lca_time = best_of(lambda: find_minimal_tag(soup, QUERY_STR, occurrences=occurrences))
+
+        legacy_time = best_of(lambda: legacy_find_minimal_tag(soup, QUERY_STR, occurrences), repeat=1)
+
+        print(f"{size:>12} {lca_time * 1000:12.2f} {legacy_time * 1000:12.2f}")
+
+
+if __name__ == '__main__':
+    main()
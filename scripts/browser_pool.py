@@ -0,0 +1,238 @@
+# A pool of long-lived headless browsers
+#
+# Author: Indrajit Ghosh
+#
+# Date: Feb 26, 2024
+#
+
+"""
+Starting a headless Chrome costs a couple of seconds and a few hundred MB of
+memory, so instead of starting one per page we keep a small pool of browsers
+around and hand them out to whoever needs to render a page (the scheduled
+check job and the add/update advertisement routes).
+
+Every browser is recycled after `max_pages` page loads or once its process
+tree grows beyond `max_rss_mb`, a browser that raised while in use is thrown
+away, and leftover Chrome processes are killed and reaped on teardown.
+"""
+
+import atexit
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import psutil
+from selenium import webdriver
+from selenium.webdriver.chrome.options import Options
+
+from scripts.timeouts import fetch_timeouts
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(TimeoutError):
+    """No browser of the pool got free within `checkout_timeout`."""
+
+
+class PooledBrowser:
+    """
+    A headless Chrome driver along with some bookkeeping.
+    """
+
+    def __init__(self):
+        chrome_options = Options()
+        chrome_options.add_argument('--headless')
+        chrome_options.add_argument('--disable-dev-shm-usage')
+        self.driver = webdriver.Chrome(options=chrome_options)
+        self.driver.set_page_load_timeout(fetch_timeouts.render)
+        self.pages = 0
+
+        # Remember the processes of this browser so that they can be killed
+        # even if `driver.quit()` fails.
+        self.pids = set()
+        service_process = getattr(self.driver.service, 'process', None)
+        if service_process is not None:
+            self.pids.add(service_process.pid)
+            self.pids.update(p.pid for p in self._processes())
+
+    def _processes(self):
+        """Returns the live processes (chromedriver and its children) of this browser."""
+        processes = []
+        for pid in list(self.pids):
+            try:
+                proc = psutil.Process(pid)
+                processes.append(proc)
+                processes.extend(proc.children(recursive=True))
+            except psutil.Error:
+                continue
+        return processes
+
+    def rss_mb(self):
+        """Returns the total resident memory of the browser processes in MB."""
+        total = 0
+        for proc in self._processes():
+            try:
+                total += proc.memory_info().rss
+            except psutil.Error:
+                continue
+        return total / (1024 * 1024)
+
+    def quit(self):
+        """Quits the browser and makes sure none of its processes survive."""
+        processes = self._processes()
+        try:
+            self.driver.quit()
+        except Exception as e:
+            logger.warning(f"BROWSER_POOL: driver.quit() failed. \t {e}")
+
+        for proc in processes:
+            try:
+                if proc.is_running():
+                    proc.kill()
+            except psutil.Error:
+                continue
+        psutil.wait_procs(processes, timeout=5)
+
+
+class BrowserPool:
+    """
+    A thread-safe pool of headless Chrome browsers.
+
+    Usage:
+    ------
+        >>> pool = BrowserPool(size=2)
+        >>> html = pool.fetch('https://wbpsc.gov.in')
+
+        or, to use the driver directly,
+
+        >>> with pool.browser() as driver:
+        ...     driver.get('https://wbpsc.gov.in')
+    """
+
+    def __init__(self, size=2, max_pages=50, max_rss_mb=1024, checkout_timeout=300):
+        self.configure(size, max_pages, max_rss_mb, checkout_timeout)
+        self._idle = []  # The most recently returned browser last
+        self._slots = threading.Condition()  # Guards `_idle` and `_created`; notified when either frees up
+        self._created = 0
+        self._closed = False
+        atexit.register(self.close)
+
+    def configure(self, size, max_pages, max_rss_mb, checkout_timeout):
+        self.size = size
+        self.max_pages = max_pages
+        self.max_rss_mb = max_rss_mb
+        self.checkout_timeout = checkout_timeout
+
+    def init_app(self, app):
+        """Reads the pool settings from the app config."""
+        self.configure(
+            size=app.config.get('BROWSER_POOL_SIZE', self.size),
+            max_pages=app.config.get('BROWSER_MAX_PAGES', self.max_pages),
+            max_rss_mb=app.config.get('BROWSER_MAX_RSS_MB', self.max_rss_mb),
+            checkout_timeout=app.config.get('BROWSER_CHECKOUT_TIMEOUT', self.checkout_timeout),
+        )
+
+    def _checkout(self):
+        """
+        Hands out an idle browser, or starts a new one while the pool has
+        fewer than `size`; otherwise waits (up to `checkout_timeout`) for a
+        browser to be returned or discarded.
+        """
+        deadline = time.monotonic() + self.checkout_timeout
+        with self._slots:
+            while True:
+                if self._closed:
+                    raise RuntimeError("The browser pool has been closed.")
+                if self._idle:
+                    return self._idle.pop()
+                if self._created < self.size:
+                    self._created += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout("Timed out waiting for a free browser from the pool.")
+                self._slots.wait(remaining)
+
+        try:
+            return PooledBrowser()
+        except Exception:
+            self._free_slot()
+            raise
+
+    def _free_slot(self):
+        """Gives up the slot of a browser which is gone, waking a thread waiting for one."""
+        with self._slots:
+            self._created -= 1
+            self._slots.notify()
+
+    def _discard(self, browser):
+        self._free_slot()
+        browser.quit()
+        self.reap_zombies()
+
+    def _return(self, browser):
+        if self._closed:
+            self._discard(browser)
+        elif browser.pages >= self.max_pages:
+            logger.debug(f"BROWSER_POOL: Recycling browser after {browser.pages} pages.")
+            self._discard(browser)
+        elif browser.rss_mb() > self.max_rss_mb:
+            logger.info(f"BROWSER_POOL: Recycling browser using {browser.rss_mb():.0f} MB.")
+            self._discard(browser)
+        else:
+            with self._slots:
+                self._idle.append(browser)
+                self._slots.notify()
+
+    @contextmanager
+    def browser(self):
+        """
+        Checks out a browser from the pool and returns it afterwards.
+        A browser which raised an exception while in use is discarded.
+        """
+        browser = self._checkout()
+        try:
+            yield browser.driver
+        except BaseException:
+            self._discard(browser)
+            raise
+        else:
+            browser.pages += 1
+            self._return(browser)
+
+    def fetch(self, url: str, on_ready=None):
+        """
+        Loads the url in a pooled browser and returns its page source.
+        `on_ready()` (optional) is called once the browser is checked out,
+        right before the page starts loading.
+        """
+        with self.browser() as driver:
+            if on_ready is not None:
+                on_ready()
+            driver.get(url)
+
+            # Wait for some time to ensure dynamic content is loaded (you may need to adjust this)
+            driver.implicitly_wait(5)
+
+            return driver.page_source
+
+    def close(self):
+        """Quits every idle browser of the pool."""
+        with self._slots:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._slots.notify_all()  # (The waiters give up)
+        for browser in idle:
+            self._discard(browser)
+
+    @staticmethod
+    def reap_zombies():
+        """Reaps the exited (zombie) child processes of the current process."""
+        for child in psutil.Process().children():
+            try:
+                if child.status() == psutil.STATUS_ZOMBIE:
+                    child.wait(timeout=0)
+            except (psutil.Error, psutil.TimeoutExpired):
+                continue
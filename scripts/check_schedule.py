@@ -0,0 +1,80 @@
+# Adaptive check intervals for the monitored pages
+#
+# Author: Indrajit Ghosh
+#
+# Date: Mar 06, 2024
+#
+
+"""
+Checking every page once a day spends as much on pages that haven't changed
+in months as on pages that change every hour. `AdaptiveSchedule` gives every
+page its own check interval, learned from its change history:
+
+    - a page that changed since its last check is checked twice as often,
+    - a page that didn't is checked `slowdown` times less often,
+    - the interval always stays within [`min_interval`, `max_interval`],
+    - a page marked as hot is always checked every `min_interval`.
+
+A page that couldn't be fetched keeps its interval.
+
+Usage:
+------
+    >>> schedule = AdaptiveSchedule(min_interval=3600, max_interval=7 * 86400)
+    >>> schedule.next_interval(86400, changed=True)
+    43200
+"""
+
+from datetime import timedelta
+
+
+class AdaptiveSchedule:
+    """
+    Parameters:
+    -----------
+        `min_interval`: `int`; (Seconds)
+        `max_interval`: `int`; (Seconds)
+        `default_interval`: `int`; (Seconds; the interval of a page checked for the first time)
+        `speedup`: `float`; (The interval is multiplied by this when the page changed)
+        `slowdown`: `float`; (The interval is multiplied by this when it didn't)
+    """
+
+    def __init__(self, min_interval=3600, max_interval=7 * 86400, default_interval=86400,
+                 speedup=0.5, slowdown=1.5):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.default_interval = self.clamp(default_interval)
+        self.speedup = speedup
+        self.slowdown = slowdown
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            min_interval=config['CHECK_MIN_INTERVAL'],
+            max_interval=config['CHECK_MAX_INTERVAL'],
+            default_interval=config['CHECK_DEFAULT_INTERVAL']
+        )
+
+    def clamp(self, interval):
+        return int(min(self.max_interval, max(self.min_interval, interval)))
+
+    def next_interval(self, interval, changed=False, hot=False, failed=False):
+        """
+        Returns the check interval (seconds) of a page after a check.
+
+        Parameters:
+        -----------
+            `interval`: `int`; (The current interval; None for a new page)
+            `changed`: `bool`; (Whether the page changed since the last check)
+            `hot`: `bool`; (Whether the page is marked as hot)
+            `failed`: `bool`; (Whether the page couldn't be fetched)
+        """
+        if hot:
+            return self.min_interval
+        if interval is None:
+            interval = self.default_interval
+        if failed:
+            return self.clamp(interval)
+        return self.clamp(interval * (self.speedup if changed else self.slowdown))
+
+    def next_check_at(self, now, interval):
+        return now + timedelta(seconds=interval)
@@ -0,0 +1,136 @@
+# Per-domain circuit breaker for the check runs
+#
+# Author: Indrajit Ghosh
+#
+# Date: Mar 08, 2024
+#
+
+"""
+When a portal is down every page on it fails after a full timeout, and a
+check run used to wait that out for every single page of the domain.
+`DomainCircuitBreaker` counts the consecutive failures of every domain:
+
+    - after `threshold` consecutive failures the breaker of the domain opens
+      and its remaining pages are skipped for `base_backoff` seconds,
+    - every further opening (without a success in between) doubles the
+      backoff, up to `max_backoff`, so a dead portal is retried less and less,
+    - once the backoff is over the breaker is half-open: the next page is
+      fetched, a success closes the breaker and a failure opens it again.
+
+Only failures that say something about the site count: connection errors,
+timeouts and `5xx` responses (a `404` only means that the page is gone).
+The breaker state is kept across runs by the caller (see `states` and
+`pop_changes`).
+"""
+
+import logging
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from scripts.fetcher import get_domain
+from scripts.timeouts import TIMEOUT_QUEUE
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BreakerState:
+    failures: int = 0  # Consecutive failures
+    opens: int = 0  # Consecutive openings
+    open_until: datetime = None
+    last_error: str = None
+
+    def is_open(self, now):
+        return self.open_until is not None and self.open_until > now
+
+
+def is_domain_failure(result):
+    """Checks whether a `FetchResult` failed because of the site (and not the page)."""
+    if result.ok or result.not_modified or result.skipped or result.deferred:
+        return False
+    if result.timeout == TIMEOUT_QUEUE:
+        return False  # It waited for one of our browsers, the site wasn't even asked
+    return result.status_code is None or result.status_code >= 500
+
+
+class DomainCircuitBreaker:
+    """
+    Parameters:
+    -----------
+        `threshold`: `int`; (Consecutive failures which open the breaker)
+        `base_backoff`: `int`; (Seconds the breaker stays open the first time)
+        `max_backoff`: `int`; (Longest time in seconds the breaker stays open)
+        `states`: `dict`; ({domain: BreakerState} known from earlier runs)
+    """
+
+    def __init__(self, threshold=3, base_backoff=1800, max_backoff=7 * 86400, states=None):
+        self.threshold = max(1, threshold)
+        self.base_backoff = base_backoff
+        self.max_backoff = max(base_backoff, max_backoff)
+        self.states = dict(states or {})
+        self._changed = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, states=None):
+        return cls(
+            threshold=config['CHECK_BREAKER_THRESHOLD'],
+            base_backoff=config['CHECK_BREAKER_BASE_BACKOFF'],
+            max_backoff=config['CHECK_BREAKER_MAX_BACKOFF'],
+            states=states
+        )
+
+    def settings(self):
+        """The arguments to build the same breaker elsewhere (e.g. in a worker process)."""
+        return {'threshold': self.threshold, 'base_backoff': self.base_backoff, 'max_backoff': self.max_backoff}
+
+    def allow(self, url: str):
+        """Checks whether the url may be fetched (its domain's breaker isn't open)."""
+        state = self.states.get(get_domain(url))
+        return state is None or not state.is_open(datetime.utcnow())
+
+    def record(self, result):
+        """Learns from the `FetchResult` of a page."""
+        if result.skipped or result.deferred:
+            return
+
+        domain = get_domain(result.url)
+        now = datetime.utcnow()
+        with self._lock:
+            state = self.states.get(domain)
+
+            if is_domain_failure(result):
+                state = self.states.setdefault(domain, BreakerState())
+                state.failures += 1
+                state.last_error = result.error
+                half_open = state.opens > 0
+                if (half_open or state.failures >= self.threshold) and not state.is_open(now):
+                    state.opens += 1
+                    backoff = min(self.max_backoff, self.base_backoff * 2 ** (state.opens - 1))
+                    state.open_until = now + timedelta(seconds=backoff)
+                    logger.warning(
+                        f"BREAKER: '{domain}' failed {state.failures} times in a row; "
+                        f"skipping it for {backoff} seconds. \t {result.error}"
+                    )
+                self._changed.add(domain)
+
+            elif state is not None:
+                # The site answered (even a 404 means it is up)
+                if state.opens:
+                    logger.info(f"BREAKER: '{domain}' is back; closing its breaker.")
+                self.states[domain] = BreakerState()
+                self._changed.add(domain)
+
+    def merge(self, states: dict):
+        """Takes over the {domain: BreakerState} changes made by another breaker."""
+        with self._lock:
+            self.states.update(states)
+            self._changed.update(states)
+
+    def pop_changes(self):
+        """Returns (and forgets) the {domain: BreakerState} changed since the last call."""
+        with self._lock:
+            changes = {domain: self.states[domain] for domain in self._changed}
+            self._changed = set()
+        return changes
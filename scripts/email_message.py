@@ -154,6 +154,10 @@ class EmailMessage(MIMEMultipart):
 
 
     def send(self, sender_email_password, server_info=None, print_success_status=True):
+        """
+        Sends the message over a new SMTP session of its own. To send many
+        messages use a `scripts.smtp_pool.SMTPPool` (`pool.send(msg)`) instead.
+        """
         # creates SMTP session
         server_name, server_port = server_info
 
@@ -0,0 +1,332 @@
+# Concurrent fetch engine for the check runs
+#
+# Author: Indrajit Ghosh
+#
+# Date: Feb 28, 2024
+#
+
+"""
+Fetching the tracked pages one after another makes a check run as long as
+the sum of all page loads. `FetchEngine` fetches them concurrently on an
+asyncio event loop (running in a background thread) with
+
+    - a global cap on the number of pages in flight,
+    - a per-host cap so that no single portal gets hammered,
+    - the per-host rate limits of `host_rate_limiter`,
+    - the connect/read/render timeouts of `fetch_timeouts` and a timeout
+      for every page as a whole (not counting its wait for a browser of the
+      pool, which is ours and not the site's),
+    - an optional deadline: pages not fetched by then come back `deferred`,
+      and
+    - an optional `DomainCircuitBreaker`: once a domain failed too often in
+      a row its remaining pages are skipped (see `FetchResult.skipped`).
+
+The pages are started round-robin over their domains and a page only takes
+a global slot once its host lets it in and its rate-limit token is due, so a
+slow (or rate limited) host doesn't hold back the pages of the other hosts.
+
+It uses the same tiers as `PageFetcher` (plain HTTP first, the browser pool
+only when needed) and streams the fetched pages back to the caller as soon
+as they complete, so the counting and the database work can start while
+the rest of the pages are still loading.
+
+Pages fetched over plain HTTP are requested conditionally when their stored
+validators (ETag/Last-Modified) are given; a `304 Not Modified` comes back
+as a result with `not_modified` set and no html.
+
+Usage:
+------
+    >>> engine = FetchEngine(page_fetcher, max_concurrency=16, per_host=2)
+    >>> for page in engine.stream([('https://wbpsc.gov.in', ['ADV-1'])]):
+    ...     print(page.url, page.mode, page.ok)
+"""
+
+import asyncio
+import logging
+import queue
+import ssl
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from scripts.fetcher import FetchResult, HTTP_HEADERS, FETCH_MODE_HTTP, conditional_headers, http_fetch_result, get_domain
+from scripts.rate_limiter import host_rate_limiter
+from scripts.timeouts import fetch_timeouts, TIMEOUT_CONNECT, TIMEOUT_READ, TIMEOUT_PAGE
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+def interleave_by_domain(jobs):
+    """
+    Reorders the fetch jobs [(url, query_strs), ...] round-robin over their
+    domains (keeping the order within each domain).
+    """
+    by_domain = {}
+    for job in jobs:
+        by_domain.setdefault(get_domain(job[0]), deque()).append(job)
+
+    interleaved = []
+    queues = deque(by_domain.values())
+    while queues:
+        domain_jobs = queues.popleft()
+        interleaved.append(domain_jobs.popleft())
+        if domain_jobs:
+            queues.append(domain_jobs)
+    return interleaved
+
+
+def _is_ssl_error(err: Exception):
+    """Checks whether an httpx error was caused by a failed TLS handshake."""
+    while err is not None:
+        if isinstance(err, ssl.SSLError):
+            return True
+        err = err.__cause__ or err.__context__
+    return False
+
+
+class _PageClock:
+    """
+    The time a page spends fetching: from taking its global slot on, less
+    the spans it was queued for a browser (`queued()` ... `resumed()`).
+    `resumed` is called from the browser threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._queued = 0.0
+        self._queued_since = None
+
+    def queued(self):
+        with self._lock:
+            if self._queued_since is None:
+                self._queued_since = time.perf_counter()
+
+    def resumed(self):
+        with self._lock:
+            if self._queued_since is not None:
+                self._queued += time.perf_counter() - self._queued_since
+                self._queued_since = None
+
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+    def active(self):
+        with self._lock:
+            now = time.perf_counter()
+            queued = self._queued + (now - self._queued_since if self._queued_since is not None else 0.0)
+            return now - self._start - queued
+
+
+class FetchEngine:
+    """
+    Fetches many pages concurrently.
+
+    Parameters:
+    -----------
+        `fetcher`: `PageFetcher`; (Knows which domains need a browser and renders them)
+        `max_concurrency`: `int`; (Pages in flight at once)
+        `per_host`: `int`; (Pages in flight at once per host)
+        `timeout`: `float`; (Seconds a single page may take, not counting its wait
+                             for a browser; by default all the stages of `fetch_timeouts`)
+        `browser_workers`: `int`; (Threads rendering pages in the browser pool)
+        `breaker`: `DomainCircuitBreaker`; (optional)
+        `deadline`: `float`; (optional; `time.time()` by which the fetching has to stop)
+    """
+
+    def __init__(self, fetcher, max_concurrency=16, per_host=2, timeout=None, browser_workers=2, breaker=None,
+                 deadline=None):
+        self.fetcher = fetcher
+        self.max_concurrency = max_concurrency
+        self.per_host = per_host
+        self.timeout = timeout if timeout is not None else fetch_timeouts.page
+        self.browser_workers = browser_workers
+        self.breaker = breaker
+        self.deadline = deadline
+
+    def stream(self, jobs, validators=None):
+        """
+        Fetches the pages of `jobs` concurrently and yields a `FetchResult`
+        for each of them as soon as it is done (in completion order).
+
+        Parameters:
+        -----------
+            `jobs`: [(url, query_strs), ...]
+            `validators`: {url: {'etag': ..., 'last_modified': ...}}; (optional)
+        """
+        jobs = interleave_by_domain(jobs)
+        validators = validators or {}
+        results = queue.Queue()
+
+        thread = threading.Thread(
+            target=lambda: asyncio.run(self._run(jobs, validators, results.put)),
+            name="fetch-engine",
+            daemon=True
+        )
+        thread.start()
+
+        while True:
+            result = results.get()
+            if result is _DONE:
+                break
+            yield result
+
+        thread.join()
+
+    async def _run(self, jobs, validators, emit):
+        try:
+            global_limit = asyncio.Semaphore(self.max_concurrency)
+            host_limits = defaultdict(lambda: asyncio.Semaphore(self.per_host))
+
+            limits = httpx.Limits(
+                max_connections=self.max_concurrency,
+                max_keepalive_connections=self.max_concurrency
+            )
+            client_kwargs = dict(
+                headers=HTTP_HEADERS,
+                timeout=httpx.Timeout(self.timeout, connect=fetch_timeouts.connect, read=fetch_timeouts.read),
+                limits=limits,
+                follow_redirects=True
+            )
+
+            with ThreadPoolExecutor(max_workers=self.browser_workers, thread_name_prefix="fetch-browser") as browser_executor:
+                async with httpx.AsyncClient(**client_kwargs) as client, \
+                        httpx.AsyncClient(verify=False, **client_kwargs) as insecure_client:
+                    tasks = [
+                        asyncio.create_task(
+                            self._fetch_one(
+                                url, list(query_strs), validators.get(url),
+                                global_limit, host_limits[httpx.URL(url).host],
+                                client, insecure_client, browser_executor
+                            )
+                        )
+                        for url, query_strs in jobs
+                    ]
+                    for task in asyncio.as_completed(tasks):
+                        emit(await task)
+
+        except Exception as e:
+            logger.error(f"FETCH_ENGINE: The fetch loop crashed. \t {e}")
+
+        finally:
+            emit(_DONE)
+
+    def _skipped(self, url):
+        if self.breaker is None or self.breaker.allow(url):
+            return None
+        return FetchResult(url=url, error="Skipped: the circuit breaker of the domain is open.", skipped=True)
+
+    @staticmethod
+    def _deferred(url):
+        return FetchResult(url=url, error="Deferred: the run reached its deadline.", deferred=True)
+
+    async def _fetch_one(self, url, query_strs, validators, global_limit, host_limit, client, insecure_client, browser_executor):
+        # The host first: a page waiting for its host must not block a
+        # global slot another host could use.
+        async with host_limit:
+            # (Checked again once the host lets the page in: the breaker may
+            # have opened while it was waiting.)
+            skipped = self._skipped(url)
+            if skipped is not None:
+                return skipped
+
+            # Then the host's rate limit, still without a global slot: a
+            # page sleeping off its host's limit would only hold it idle.
+            await host_rate_limiter.wait_async(url)
+
+            async with global_limit:
+                if self.deadline is not None and self.deadline <= time.time():
+                    return self._deferred(url)
+
+                # The page's timeout runs on its own clock, which stops while
+                # the page is queued for a browser.
+                clock = _PageClock()
+                task = asyncio.ensure_future(
+                    self._fetch_tiered(url, query_strs, validators, client, insecure_client, browser_executor, clock)
+                )
+                try:
+                    while not task.done():
+                        wait = self.timeout - clock.active()
+                        if self.deadline is not None:
+                            wait = min(wait, self.deadline - time.time())
+                        if wait <= 0:
+                            break
+                        await asyncio.wait({task}, timeout=wait)
+                finally:
+                    timed_out = not task.done()
+                    if timed_out:
+                        task.cancel()
+
+                if timed_out:
+                    if clock.active() < self.timeout:
+                        # Cut short by the deadline, not the site's fault
+                        return self._deferred(url)
+                    result = FetchResult(
+                        url=url, error=f"Timed out after {self.timeout} seconds.",
+                        elapsed=clock.elapsed(), timeout=TIMEOUT_PAGE
+                    )
+                elif task.exception() is not None:
+                    result = FetchResult(url=url, error=str(task.exception()), elapsed=clock.elapsed())
+                else:
+                    result = task.result()
+
+            if self.breaker is not None:
+                self.breaker.record(result)
+            return result
+
+    async def _fetch_tiered(self, url, query_strs, validators, client, insecure_client, browser_executor, clock):
+        # (`_fetch_one` took the host's rate-limit token of the first request.)
+        if self.fetcher.needs_js(url):
+            return await self._render(url, browser_executor, clock)
+
+        static = await self._fetch_http(url, validators, client, insecure_client)
+        if static.not_modified or self.fetcher.static_is_enough(url, static, query_strs):
+            return static
+
+        clock.queued()
+        await host_rate_limiter.wait_async(url)
+        rendered = await self._render(url, browser_executor, clock)
+        return self.fetcher.pick(url, static, rendered, query_strs)
+
+    async def _render(self, url, browser_executor, clock):
+        """
+        Renders the url in the browser pool (with the host's token taken); the
+        page's clock stands still until a browser starts loading it.
+        """
+        clock.queued()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(browser_executor, self.fetcher.fetch_browser, url, True, clock.resumed)
+
+    async def _fetch_http(self, url, validators, client, insecure_client):
+        start = time.perf_counter()
+        headers = conditional_headers(validators)
+        try:
+            try:
+                response = await client.get(url, headers=headers)
+            except httpx.ConnectError as e:
+                if not _is_ssl_error(e):
+                    raise
+                response = await insecure_client.get(url, headers=headers)
+            if response.status_code != 304:
+                response.raise_for_status()
+
+            return http_fetch_result(url, response, time.perf_counter() - start)
+
+        except httpx.HTTPError as e:
+            response = getattr(e, 'response', None)
+            timeout = None
+            if isinstance(e, httpx.TimeoutException):
+                timeout = TIMEOUT_CONNECT if isinstance(e, (httpx.ConnectTimeout, httpx.PoolTimeout)) else TIMEOUT_READ
+            return FetchResult(
+                url=url,
+                mode=FETCH_MODE_HTTP,
+                status_code=response.status_code if response is not None else None,
+                error=str(e) or type(e).__name__,
+                elapsed=time.perf_counter() - start,
+                timeout=timeout
+            )
@@ -0,0 +1,354 @@
+# Tiered webpage fetcher
+#
+# Author: Indrajit Ghosh
+#
+# Date: Feb 27, 2024
+#
+
+"""
+Most recruitment portals serve static html, so rendering them in Chrome is a
+waste of a few seconds per page. `PageFetcher` first tries a plain HTTP GET
+and only falls back to the headless browser when the static html doesn't
+contain the advertisement numbers we are looking for (or the request fails).
+
+Whether a domain needs the browser is remembered, so later fetches of that
+domain skip the HTTP probe altogether. The decisions taken since the last
+`pop_new_decisions()` call can be persisted by the caller.
+"""
+
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+
+import requests
+import urllib3
+from selenium.common.exceptions import TimeoutException
+
+from scripts.browser_pool import PoolTimeout
+from scripts.matcher import MultiPatternMatcher
+from scripts.utils import fetch_page_source, hash_page_regions, get_hash_scheme, raw_page_digest, \
+    text_page_digest
+from scripts.rate_limiter import host_rate_limiter
+from scripts.timeouts import fetch_timeouts, TIMEOUT_CONNECT, TIMEOUT_READ, TIMEOUT_RENDER, TIMEOUT_QUEUE
+
+logger = logging.getLogger(__name__)
+
+# Several government portals have broken certificate chains; we retry them
+# without verification (as we always did), so don't flood the logs about it.
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+HTTP_HEADERS = {
+    'User-Agent': (
+        "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/121.0 Safari/537.36 AdNotifier"
+    ),
+    'Accept': "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+}
+
+FETCH_MODE_HTTP = 'http'
+FETCH_MODE_BROWSER = 'browser'
+
+# The stages at which a page can be found unchanged without parsing it (see `PageFetcher.count`)
+UNCHANGED_RAW = 'raw'
+UNCHANGED_TEXT = 'text'
+
+
+@dataclass
+class FetchResult:
+    url: str
+    html: str = None
+    mode: str = None
+    status_code: int = None
+    error: str = None
+    elapsed: float = 0.0
+    counts: dict = None  # {query_str: (occurrence_count, webpage_hash)}
+    skipped: bool = False  # Not fetched at all (the domain's circuit breaker is open)
+    deferred: bool = False  # Not fetched (or cut short) because the run ran out of time
+    timeout: str = None  # What timed out ('connect', 'read', 'render' or 'page'), if anything
+
+    # HTTP validators of the response (for conditional requests)
+    not_modified: bool = False
+    etag: str = None
+    last_modified: str = None
+    content_length: int = None
+
+    # Fingerprints of the fetched page (see `PageFetcher.count`)
+    raw_digest: str = None
+    text_digest: str = None
+    unchanged: str = None  # The stage which found the page unchanged (then there are no `counts`)
+
+    # Where the regions were found (see `hash_page_regions`)
+    locators: dict = None  # {query_str: locator}
+    locator_hits: int = 0  # Regions found at the locator of the last check
+    locator_misses: int = 0  # Regions searched for in the whole page
+
+    @property
+    def ok(self):
+        return self.html is not None
+
+    @property
+    def hash_scheme(self):
+        return get_hash_scheme(self.mode)
+
+
+def conditional_headers(validators: dict):
+    """
+    Returns the `If-None-Match`/`If-Modified-Since` headers for the stored
+    validators {'etag': ..., 'last_modified': ...} of a page.
+    """
+    headers = {}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def http_fetch_result(url: str, response, elapsed: float):
+    """
+    Builds the `FetchResult` of a successful (2xx or 304) HTTP response of
+    either `requests` or `httpx`.
+    """
+    content_length = response.headers.get('Content-Length')
+    not_modified = response.status_code == 304
+    return FetchResult(
+        url=url,
+        html=None if not_modified else response.text,
+        mode=FETCH_MODE_HTTP,
+        status_code=response.status_code,
+        elapsed=elapsed,
+        not_modified=not_modified,
+        etag=response.headers.get('ETag'),
+        last_modified=response.headers.get('Last-Modified'),
+        content_length=int(content_length) if content_length and content_length.isdigit() else None
+    )
+
+
+def get_domain(url: str):
+    """Returns the lowercased host name of the url."""
+    return (urlsplit(url).hostname or '').lower()
+
+
+def contains_all(html: str, query_strs):
+    """Checks whether every query string is present in the html."""
+    return all(query_str in html for query_str in query_strs)
+
+
+def count_found(html: str, query_strs):
+    """Returns how many of the query strings are present in the html."""
+    return sum(query_str in html for query_str in query_strs)
+
+
+class PageFetcher:
+    """
+    Fetches webpages over plain HTTP first and with a headless browser only
+    when needed.
+
+    Parameters:
+    -----------
+        `pool`: `BrowserPool`; (The pool to render pages with, optional)
+        `js_domains`: `dict`; ({domain: needs_js} decisions known beforehand)
+        `parser`: `str`; (The html parser used for counting and hashing)
+    """
+
+    def __init__(self, pool=None, js_domains=None, parser='html.parser'):
+        self.pool = pool
+        self.parser = parser
+        self.js_domains = dict(js_domains or {})
+        self._new_decisions = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def init_app(self, app):
+        """Reads the fetcher settings from the app config."""
+        self.parser = app.config.get('HTML_PARSER', self.parser)
+
+    @property
+    def session(self):
+        # `requests.Session` isn't thread-safe, so every thread gets its own.
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update(HTTP_HEADERS)
+            self._local.session = session
+        return session
+
+    def remember_domains(self, js_domains: dict):
+        """Loads previously persisted {domain: needs_js} decisions."""
+        with self._lock:
+            self.js_domains.update(js_domains)
+
+    def pop_new_decisions(self):
+        """Returns (and forgets) the {domain: needs_js} decisions taken since the last call."""
+        with self._lock:
+            decisions, self._new_decisions = self._new_decisions, {}
+        return decisions
+
+    def needs_js(self, url: str):
+        return self.js_domains.get(get_domain(url), False)
+
+    def _decide(self, url: str, needs_js: bool):
+        domain = get_domain(url)
+        with self._lock:
+            if self.js_domains.get(domain) != needs_js:
+                logger.info(f"FETCHER: Domain '{domain}' {'needs' if needs_js else 'does not need'} a browser.")
+            self.js_domains[domain] = needs_js
+            self._new_decisions[domain] = needs_js
+
+    def fetch_http(self, url: str, validators: dict = None):
+        """
+        Fetches the static html of the url with a plain GET request. If the
+        stored `validators` of the page are given the request is conditional
+        and the result may be `not_modified`.
+        """
+        start = time.perf_counter()
+        headers = conditional_headers(validators)
+        try:
+            host_rate_limiter.wait(url)
+            try:
+                response = self.session.get(url, headers=headers, timeout=fetch_timeouts.http)
+            except requests.exceptions.SSLError:
+                response = self.session.get(url, headers=headers, timeout=fetch_timeouts.http, verify=False)
+            if response.status_code != 304:
+                response.raise_for_status()
+
+            return http_fetch_result(url, response, time.perf_counter() - start)
+
+        except requests.RequestException as e:
+            timeout = None
+            if isinstance(e, requests.Timeout):
+                timeout = TIMEOUT_CONNECT if isinstance(e, requests.ConnectTimeout) else TIMEOUT_READ
+            return FetchResult(
+                url=url,
+                mode=FETCH_MODE_HTTP,
+                status_code=getattr(e.response, 'status_code', None),
+                error=str(e),
+                elapsed=time.perf_counter() - start,
+                timeout=timeout
+            )
+
+    def fetch_browser(self, url: str, rate_limited=False, on_ready=None):
+        """
+        Renders the url in a headless browser (rate limited by `fetch_page_source`
+        unless the caller already took the host's token: `rate_limited`).
+        `on_ready()` is called once a browser is about to load the page.
+        """
+        start = time.perf_counter()
+        try:
+            html = fetch_page_source(url, pool=self.pool, rate_limited=rate_limited, on_ready=on_ready)
+            return FetchResult(url=url, html=html, mode=FETCH_MODE_BROWSER, elapsed=time.perf_counter() - start)
+        except TimeoutException:
+            return FetchResult(
+                url=url, mode=FETCH_MODE_BROWSER, error=f"Page load timed out after {fetch_timeouts.render} seconds.",
+                elapsed=time.perf_counter() - start, timeout=TIMEOUT_RENDER
+            )
+        except PoolTimeout as e:
+            return FetchResult(
+                url=url, mode=FETCH_MODE_BROWSER, error=str(e), elapsed=time.perf_counter() - start,
+                timeout=TIMEOUT_QUEUE
+            )
+        except Exception as e:
+            return FetchResult(url=url, mode=FETCH_MODE_BROWSER, error=str(e), elapsed=time.perf_counter() - start)
+
+    def static_is_enough(self, url: str, static: FetchResult, query_strs):
+        """
+        Checks whether the static html shows every query string, in which case
+        there is no need to render the page.
+        """
+        if static.ok and contains_all(static.html, query_strs):
+            if get_domain(url) not in self.js_domains:
+                self._decide(url, False)
+            return True
+        return False
+
+    def pick(self, url: str, static: FetchResult, rendered: FetchResult, query_strs):
+        """
+        Chooses between the static and the rendered fetch of a page whose
+        static html wasn't enough, and learns from the choice.
+        """
+        if rendered.ok and (
+            not static.ok or count_found(rendered.html, query_strs) > count_found(static.html, query_strs)
+        ):
+            # The browser saw what the static html didn't.
+            self._decide(url, True)
+            return rendered
+
+        # The ad numbers are really missing (or the browser failed too), so
+        # stick to the cheap result to keep the fetch mode stable. If both
+        # failed, a timed out request says more than the browser's error.
+        return static if static.ok or (static.timeout and not rendered.ok) else rendered
+
+    def fetch(self, url: str, query_strs=()):
+        """
+        Fetches the url with the cheapest method that shows all `query_strs`.
+
+        Returns:
+        --------
+            `FetchResult`
+        """
+        if self.needs_js(url):
+            return self.fetch_browser(url)
+
+        static = self.fetch_http(url)
+        if self.static_is_enough(url, static, query_strs):
+            return static
+
+        rendered = self.fetch_browser(url)
+        return self.pick(url, static, rendered, query_strs)
+
+    def count(self, result: FetchResult, query_strs, last_check: dict = None):
+        """
+        Counts/hashes every query string on a fetched page and stores them
+        in `result.counts`. Every query string gets `(-1, None)` if the page
+        couldn't be fetched.
+
+        With the fingerprints {'raw_digest': ..., 'text_digest': ...} of the
+        page's `last_check` the page is compared in stages, the cheapest
+        first, and only parsed if both differ:
+
+            1. the digest of the html as fetched (see `raw_page_digest`),
+            2. the digest of its normalized text (see `text_page_digest`),
+            3. the counts and region hashes (see `hash_page_regions`); the
+               regions are first looked for at the `'locators'`
+               {query_str: locator} of the last check.
+
+        A page found unchanged gets `result.unchanged` (the stage) and no
+        counts. The digests are stored in the result either way.
+        """
+        if not result.ok:
+            result.counts = {query_str: (-1, None) for query_str in query_strs}
+            return result
+
+        last_check = last_check or {}
+        result.raw_digest = raw_page_digest(result.html, query_strs, result.hash_scheme)
+        if result.raw_digest == last_check.get('raw_digest'):
+            result.text_digest = last_check.get('text_digest')
+            result.unchanged = UNCHANGED_RAW
+            return result
+
+        occurrence_counts = MultiPatternMatcher(query_strs).count(result.html)
+        result.text_digest = text_page_digest(result.html, occurrence_counts, result.hash_scheme)
+        if result.text_digest == last_check.get('text_digest'):
+            result.unchanged = UNCHANGED_TEXT
+            return result
+
+        result.counts, result.locators, result.locator_hits = hash_page_regions(
+            result.html, query_strs, parser=self.parser,
+            occurrence_counts=occurrence_counts, locators=last_check.get('locators')
+        )
+        result.locator_misses = len(result.counts) - result.locator_hits
+        return result
+
+    def evaluate(self, url: str, query_strs):
+        """
+        Fetches the url and counts/hashes every query string on it.
+
+        Returns:
+        --------
+            `FetchResult` with `counts` = {query_str: (occurrence_count, webpage_hash)}.
+        """
+        query_strs = list(query_strs)
+        return self.count(self.fetch(url, query_strs), query_strs)
@@ -0,0 +1,502 @@
+# Pluggable html parsers for counting and hashing
+#
+# Author: Indrajit Ghosh
+#
+# Date: Mar 03, 2024
+#
+
+"""
+The region of a page around an advertisement number can be found with any of
+these parsers:
+
+    - 'html.parser': BeautifulSoup with Python's built-in parser (the default),
+    - 'lxml': libxml2's html parser (needs `lxml`),
+    - 'selectolax': the lexbor HTML5 parser (needs `selectolax`).
+
+All of them are wrapped in a `ParsedPage` which gives the same answers no
+matter which parser built the tree:
+
+    - the tags `html`, `head`, `body` and `tbody` (which parsers add or leave
+      out differently) are transparent: they are skipped when climbing up to
+      the region and when serializing it,
+    - void tags (`br`, `img`, `wbr`, ...) never contain anything, even if the
+      parser nested the following siblings inside them,
+    - a region is hashed through `canonical_html()`, which writes the tags with
+      their sorted (lowercased) attributes and the whitespace-collapsed text, but leaves out
+      comments, doctypes and the contents of `script`/`style` tags,
+    - `locator()` describes where a region sits in the page (e.g.
+      'lxml:html[0]/body[0]/table[1]') and `find_locator()` goes back
+      there on a later version of the page; a locator belongs to the parser
+      which made it.
+
+Usage:
+------
+    >>> page = parse_html('<table><tr><td>ADV-1</td></tr></table>', 'lxml')
+    >>> region = page.minimal_region([node for text, node in page.iter_texts() if 'ADV-1' in text])
+    >>> page.canonical_html(region)
+    '<table><tr><td>ADV-1</td></tr></table>'
+"""
+
+from html import escape
+
+from bs4 import BeautifulSoup, NavigableString, Tag, Doctype, Declaration, ProcessingInstruction
+from bs4.element import PreformattedString
+
+HTML_PARSERS = ['html.parser', 'lxml', 'selectolax']
+
+# Tags some parsers make up while others don't.
+TRANSPARENT_TAGS = {'html', 'head', 'body', 'tbody'}
+
+# Tags whose contents are left out of a region's canonical html.
+SKIPPED_TAGS = {'script', 'style'}
+
+# Tags which can't have children. Older parsers (libxml2) don't know some of
+# them and nest the following siblings inside, so their children are treated
+# as their siblings.
+VOID_TAGS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen',
+    'link', 'meta', 'param', 'source', 'track', 'wbr'
+}
+
+# How many levels above the text of an advertisement number its region starts.
+REGION_CONTEXT_LEVELS = 3
+
+
+def lowest_common_ancestor(nodes, parent=None, key=id):
+    """
+    Finds the lowest common ancestor of the given nodes of a parsed document
+    in a single pass.
+
+    The root-to-node path of the first node is recorded along with the depths;
+    every other node only climbs up until it meets that path (or a branch
+    walked before), and the common ancestor moves up whenever a node meets the
+    path above it. So every node of the document is visited at most once.
+
+    Parameters:
+    - nodes (iterable): The nodes of the same document.
+    - parent (callable, optional): Returns the parent of a node (or None for
+      the root). Defaults to the `parent` attribute.
+    - key (callable, optional): Returns a hashable identity of a node.
+
+    Returns:
+    The lowest common ancestor of the nodes (or None if no node is given).
+    """
+    if parent is None:
+        parent = lambda node: node.parent
+
+    path_depths = None  # {key(node): depth} for the nodes on the recorded path
+    lca, lca_depth = None, None
+
+    for node in nodes:
+        if path_depths is None:
+            path = []
+            while node is not None:
+                path.append(node)
+                node = parent(node)
+            path.reverse()
+
+            path_depths = {key(ancestor): depth for depth, ancestor in enumerate(path)}
+            lca, lca_depth = path[-1], len(path) - 1
+            continue
+
+        seen = []
+        while key(node) not in path_depths:
+            seen.append(node)
+            node = parent(node)
+
+        depth = path_depths[key(node)]
+        for off_path in seen:
+            # Off the path; later nodes never need to climb past these again.
+            path_depths[key(off_path)] = None
+
+        if depth is None:
+            # Met the branch of an earlier node, which already merged below
+            # the current common ancestor.
+            continue
+        if depth < lca_depth:
+            lca, lca_depth = node, depth
+
+    return lca
+
+
+class ParsedPage:
+    """
+    A parsed html page. Subclasses wrap the tree of a particular parser.
+    """
+    name = None
+
+    def __init__(self, html_content: str):
+        raise NotImplementedError
+
+    # To be implemented by the parser specific subclasses
+    @property
+    def root(self):
+        """The document node."""
+        raise NotImplementedError
+
+    def raw_parent(self, node):
+        """The parent of the node in the parser's tree (None for the root)."""
+        raise NotImplementedError
+
+    def tag_name(self, node):
+        """The lowercased tag name of an element (None for the root)."""
+        raise NotImplementedError
+
+    def attributes(self, node):
+        """The attributes {name: value} of an element."""
+        raise NotImplementedError
+
+    def children(self, node):
+        """Yields ('text', str) and ('element', node) for the children of a node."""
+        raise NotImplementedError
+
+    def iter_texts(self, node=None):
+        """
+        Yields (text, node) for every text (and comment) of the page (or of
+        the subtree of `node`), `node` being the node it lives in.
+        """
+        raise NotImplementedError
+
+    def key(self, node):
+        """A hashable identity of the node."""
+        return id(node)
+
+    def is_root(self, node):
+        return node is self.root
+
+    # Same for every parser
+    def is_transparent(self, node):
+        return self.is_root(node) or self.tag_name(node) in TRANSPARENT_TAGS
+
+    def _is_skipped_ancestor(self, node):
+        return self.tag_name(node) in TRANSPARENT_TAGS or self.tag_name(node) in VOID_TAGS
+
+    def parent(self, node):
+        """The closest non-transparent (and non-void) ancestor of the node (or the root)."""
+        if self.is_root(node):
+            return None
+
+        node = self.raw_parent(node)
+        while node is not None and not self.is_root(node) and self._is_skipped_ancestor(node):
+            node = self.raw_parent(node)
+
+        return self.root if node is None else node
+
+    def context(self, node, levels=REGION_CONTEXT_LEVELS):
+        """
+        The region around a text living in `node`: the node itself counts as
+        the first level above the text.
+        """
+        if self.is_root(node):
+            return node
+        if self._is_skipped_ancestor(node):
+            node = self.parent(node)
+        for _ in range(levels - 1):
+            if self.is_root(node):
+                break
+            node = self.parent(node)
+        return node
+
+    def _element_children(self, node, name):
+        """The children of the node with the given tag name."""
+        for kind, child in self.children(node):
+            if kind == 'element' and self.tag_name(child) == name:
+                yield child
+
+    def locator(self, node):
+        """
+        Where the node sits in the page: the parser's name and the tag names
+        from the root down, each with its position among the siblings of
+        the same tag, e.g. 'html.parser:html[0]/body[0]/table[1]/tr[3]'.
+        """
+        steps = []
+        while not self.is_root(node):
+            parent = self.raw_parent(node)
+            name = self.tag_name(node)
+            index = next(
+                index for index, sibling in enumerate(self._element_children(parent, name))
+                if self.key(sibling) == self.key(node)
+            )
+            steps.append(f"{name}[{index}]")
+            node = parent
+        return f"{self.name}:" + '/'.join(reversed(steps))
+
+    def find_locator(self, locator: str):
+        """The node at a `locator()` on this page (None if there is none or another parser made it)."""
+        name, _, steps = locator.partition(':')
+        if name != self.name:
+            return None
+
+        node = self.root
+        try:
+            for step in filter(None, steps.split('/')):
+                tag, _, index = step.rstrip(']').partition('[')
+                node = next(
+                    (child for i, child in enumerate(self._element_children(node, tag)) if i == int(index)),
+                    None
+                )
+                if node is None:
+                    return None
+        except ValueError:
+            return None  # Not a locator
+        return node
+
+    def minimal_region(self, nodes, levels=REGION_CONTEXT_LEVELS):
+        """
+        The minimal region containing the given text nodes: the lowest common
+        ancestor of their contexts.
+        """
+        return lowest_common_ancestor(
+            (self.context(node, levels) for node in nodes),
+            parent=self.parent,
+            key=self.key
+        )
+
+    def canonical_html(self, node):
+        """
+        Serializes the node in a form that doesn't depend on the parser.
+        """
+        parts = []
+        text_run = []
+
+        def flush_text():
+            text = ' '.join(''.join(text_run).split())
+            if text:
+                parts.append(escape(text, quote=False))
+            text_run.clear()
+
+        stack = [('element', node)]
+        while stack:
+            kind, item = stack.pop()
+
+            if kind == 'text':
+                text_run.append(item)
+                continue
+
+            flush_text()
+            if kind == 'close':
+                parts.append(f"</{item}>")
+                continue
+
+            children = list(self.children(item))
+            if not self.is_transparent(item):
+                name = self.tag_name(item)
+                if name in SKIPPED_TAGS:
+                    continue
+
+                attrs = ''.join(
+                    f' {attr}="{escape(" ".join((value or "").split()))}"'
+                    for attr, value in sorted(
+                        (attr.lower(), value) for attr, value in self.attributes(item).items()
+                    )
+                )
+                parts.append(f"<{name}{attrs}>")
+                if name not in VOID_TAGS:
+                    stack.append(('close', name))
+
+            stack.extend(reversed(children))
+
+        flush_text()
+        return ''.join(parts)
+
+
+class SoupPage(ParsedPage):
+    """BeautifulSoup with the `html.parser` (the parser we always used)."""
+    name = 'html.parser'
+
+    _SKIPPED_STRINGS = (Doctype, Declaration, ProcessingInstruction)
+
+    def __init__(self, html_content: str):
+        self.soup = BeautifulSoup(html_content, 'html.parser')
+
+    @property
+    def root(self):
+        return self.soup
+
+    def raw_parent(self, node):
+        return node.parent
+
+    def tag_name(self, node):
+        return None if node is self.soup else node.name.lower()
+
+    def attributes(self, node):
+        return {
+            attr: ' '.join(value) if isinstance(value, list) else value
+            for attr, value in node.attrs.items()
+        }
+
+    def children(self, node):
+        for child in node.contents:
+            if isinstance(child, Tag):
+                yield 'element', child
+            elif not isinstance(child, PreformattedString):
+                yield 'text', str(child)
+
+    def iter_texts(self, node=None):
+        for element in (self.soup if node is None else node).descendants:
+            if isinstance(element, NavigableString) and not isinstance(element, self._SKIPPED_STRINGS):
+                yield str(element), element.parent
+
+
+class LxmlPage(ParsedPage):
+    """libxml2's html parser."""
+    name = 'lxml'
+
+    _ROOT = object()  # lxml has no node for the document itself
+
+    def __init__(self, html_content: str):
+        import lxml.html
+
+        parser = lxml.html.HTMLParser(encoding='utf-8')
+        try:
+            self.html = lxml.html.document_fromstring(html_content.encode('utf-8'), parser=parser)
+        except Exception:
+            # lxml refuses empty documents
+            self.html = lxml.html.document_fromstring(b'<html></html>', parser=parser)
+        self._comment = lxml.html.HtmlComment
+
+    @property
+    def root(self):
+        return self._ROOT
+
+    def key(self, node):
+        # Keeps the element (and so its lxml proxy object) alive.
+        return node
+
+    def raw_parent(self, node):
+        if node is self._ROOT:
+            return None
+        parent = node.getparent()
+        return self._ROOT if parent is None else parent
+
+    def tag_name(self, node):
+        return None if node is self._ROOT else node.tag.lower()
+
+    def attributes(self, node):
+        return dict(node.attrib)
+
+    def _is_element(self, node):
+        return isinstance(node.tag, str)
+
+    def children(self, node):
+        if node is self._ROOT:
+            yield 'element', self.html
+            return
+
+        if node.text:
+            yield 'text', node.text
+        for child in node:
+            if self._is_element(child):
+                yield 'element', child
+            if child.tail:
+                yield 'text', child.tail
+
+    def _iter_element_texts(self, top):
+        for element in top.iter():
+            parent = self.raw_parent(element)
+            if isinstance(element, self._comment):
+                if element.text:
+                    yield element.text, parent
+            elif self._is_element(element) and element.text:
+                yield element.text, element
+
+            if element.tail and element is not top:
+                yield element.tail, parent
+
+    def iter_texts(self, node=None):
+        if node is not None and node is not self._ROOT:
+            yield from self._iter_element_texts(node)
+            return
+
+        for sibling in reversed(list(self.html.itersiblings(preceding=True))):
+            if isinstance(sibling, self._comment) and sibling.text:
+                yield sibling.text, self._ROOT
+
+        yield from self._iter_element_texts(self.html)
+
+        for sibling in self.html.itersiblings():
+            if isinstance(sibling, self._comment) and sibling.text:
+                yield sibling.text, self._ROOT
+
+
+class SelectolaxPage(ParsedPage):
+    """The lexbor HTML5 parser through selectolax."""
+    name = 'selectolax'
+
+    def __init__(self, html_content: str):
+        from selectolax.lexbor import LexborHTMLParser
+
+        self.tree = LexborHTMLParser(html_content)
+        self.document = self.tree.root.parent if self.tree.root is not None else None
+
+    @property
+    def root(self):
+        return self.document
+
+    def key(self, node):
+        return node.mem_id
+
+    def is_root(self, node):
+        # selectolax hands out a new wrapper object on every access, so the
+        # root has to be recognized by its identity key.
+        return node.mem_id == self.document.mem_id
+
+    def raw_parent(self, node):
+        return node.parent
+
+    def tag_name(self, node):
+        return None if node.tag == '-document' else node.tag.lower()
+
+    def attributes(self, node):
+        return node.attributes
+
+    def children(self, node):
+        child = node.child
+        while child is not None:
+            if child.tag == '-text':
+                yield 'text', child.text_content or ''
+            elif not child.tag.startswith('-'):
+                yield 'element', child
+            child = child.next
+
+    def iter_texts(self, node=None):
+        if self.document is None:
+            return
+
+        stack = [self.document if node is None else node]
+        while stack:
+            node = stack.pop()
+            child = node.child
+            children = []
+            while child is not None:
+                if child.tag == '-text':
+                    if child.text_content:
+                        yield child.text_content, node
+                elif child.tag == '-comment':
+                    if child.comment_content:
+                        yield child.comment_content, node
+                elif not child.tag.startswith('-'):
+                    children.append(child)
+                child = child.next
+            stack.extend(reversed(children))
+
+
+_PAGE_CLASSES = {page_class.name: page_class for page_class in (SoupPage, LxmlPage, SelectolaxPage)}
+
+
+def parse_html(html_content: str, parser: str = 'html.parser'):
+    """
+    Parses the html with the given parser.
+
+    Parameters:
+    - html_content (str): The html of the webpage.
+    - parser (str): One of `HTML_PARSERS`.
+
+    Returns:
+    ParsedPage
+    """
+    try:
+        page_class = _PAGE_CLASSES[parser]
+    except KeyError:
+        raise ValueError(f"Unknown html parser '{parser}'. Choose one of {HTML_PARSERS}.")
+    return page_class(html_content)
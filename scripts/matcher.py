@@ -0,0 +1,153 @@
+# Multi-pattern matcher for the advertisement numbers on a page
+#
+# Author: Indrajit Ghosh
+#
+# Date: Mar 01, 2024
+#
+
+"""
+Many ads (of many users) are usually tracked on the same page. Counting and
+locating each advertisement number separately scans the page once per number;
+`MultiPatternMatcher` builds an Aho-Corasick automaton out of all of them and
+finds every occurrence of every number in a single pass.
+
+Usage:
+------
+    >>> matcher = MultiPatternMatcher(['ADV-1', 'ADV-12'])
+    >>> matcher.count('ADV-12 and ADV-1')
+    {'ADV-1': 2, 'ADV-12': 1}
+"""
+
+import re
+from collections import deque
+
+
+class MultiPatternMatcher:
+    """
+    An Aho-Corasick automaton over a set of literal patterns.
+
+    Parameters:
+    -----------
+        `patterns`: [`str`, `str`, ..., `str`]
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(dict.fromkeys(patterns))
+
+        # The trie: goto[state] = {char: next_state}; out[state] = pattern ids
+        # ending at the state (including the ones reachable by failure links).
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+
+        for pattern_id, pattern in enumerate(self.patterns):
+            if pattern:
+                self._add(pattern, pattern_id)
+        self._build_failure_links()
+
+        # In the root state only the first characters of the patterns can make
+        # progress, so we jump straight to the next one of them.
+        first_chars = {pattern[0] for pattern in self.patterns if pattern}
+        self._next_start = (
+            re.compile('|'.join(re.escape(c) for c in sorted(first_chars))).search
+            if first_chars else None
+        )
+
+    def _add(self, pattern, pattern_id):
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[state][char] = next_state
+            state = next_state
+        self._out[state].append(pattern_id)
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fallback = self._goto[fail].get(char, 0)
+                self._fail[next_state] = fallback if fallback != next_state else 0
+                self._out[next_state] = self._out[next_state] + self._out[self._fail[next_state]]
+
+    def iter_matches(self, text: str):
+        """
+        Yields `(end_index, pattern_id)` for every (possibly overlapping)
+        occurrence of the patterns in the text, in the order of `end_index`.
+        """
+        if self._next_start is None:
+            return
+
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        i = 0
+        n = len(text)
+        while i < n:
+            if state == 0:
+                match = self._next_start(text, i)
+                if match is None:
+                    return
+                i = match.start()
+
+            char = text[i]
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+
+            for pattern_id in out[state]:
+                yield i + 1, pattern_id
+            i += 1
+
+    def count(self, text: str):
+        """
+        Counts the non-overlapping occurrences of every pattern in the text,
+        exactly like `text.count(pattern)` would.
+
+        Returns:
+        --------
+            {pattern: count}
+        """
+        counts = [0] * len(self.patterns)
+        last_end = [0] * len(self.patterns)
+        lengths = [len(pattern) for pattern in self.patterns]
+
+        for end, pattern_id in self.iter_matches(text):
+            if end - lengths[pattern_id] >= last_end[pattern_id]:
+                counts[pattern_id] += 1
+                last_end[pattern_id] = end
+
+        return {
+            pattern: counts[pattern_id] if pattern else text.count(pattern)
+            for pattern_id, pattern in enumerate(self.patterns)
+        }
+
+    def find_text_nodes(self, texts):
+        """
+        Finds the nodes of a parsed page whose text contains each pattern in a
+        single walk over the texts of the page.
+
+        Parameters:
+        -----------
+            `texts`: [(text, node), ...]; (see `ParsedPage.iter_texts`)
+
+        Returns:
+        --------
+            {pattern: [node, ...]}
+        """
+        nodes = {pattern: [] for pattern in self.patterns}
+        for text, node in texts:
+            found = {pattern_id for _, pattern_id in self.iter_matches(text)}
+            for pattern_id in sorted(found):
+                nodes[self.patterns[pattern_id]].append(node)
+
+        return nodes
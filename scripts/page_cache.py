@@ -0,0 +1,303 @@
+# Short lived page cache with single-flight fetches
+#
+# Author: Indrajit Ghosh
+#
+# Date: Mar 14, 2024
+#
+
+"""
+When a result is out, many users add (or update) ads on the same page within
+minutes, and every one of them used to fetch (often render) that page again.
+`PageCache` sits in front of a `PageFetcher` for these on-demand checks:
+
+    - a fetched page is kept for `ttl` seconds, keyed by its canonical url
+      (so every spelling of the url shares it); the least recently used pages are evicted once the cached html takes
+      more than `max_bytes`,
+    - concurrent requests for a page that isn't cached share one fetch
+      (single-flight): the first one fetches, the others wait for it,
+    - with a `cache_dir` the pages are also kept on disk, shared by every
+      process of the host (e.g. the gunicorn workers), and a file lock makes
+      the single-flight work across the processes too,
+    - `stats` counts the hits, misses, coalesced requests and evictions.
+
+A cached static page that lacks the query strings of a later request isn't
+fetched again over HTTP; only the browser is asked (as `PageFetcher.fetch`
+would). Failed fetches aren't cached.
+
+Usage:
+------
+    >>> cache = PageCache(fetcher=PageFetcher(), ttl=120)
+    >>> cache.evaluate('https://wbpsc.gov.in', ['ADV-12-2023']).counts
+    {'ADV-12-2023': (2, '5f0c...')}
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows: no cross-process single-flight then
+    fcntl = None
+
+from scripts.fetcher import FetchResult, FETCH_MODE_BROWSER, contains_all
+from scripts.utils import canonicalize_url
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedPage:
+    result: FetchResult
+    browser_checked: bool  # The browser saw the page (or was asked and saw no more)
+    expires_at: float  # time.time()
+    size: int  # Bytes of the html
+
+    def serves(self, query_strs):
+        """Checks whether the page answers a request for the query strings without a fetch."""
+        return self.browser_checked or contains_all(self.result.html, query_strs)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.page = None
+        self.error = None
+
+
+class PageCache:
+    """
+    Parameters:
+    -----------
+        `fetcher`: `PageFetcher`
+        `ttl`: `float`; (Seconds a page is kept; 0 turns the cache off, not the single-flight)
+        `max_bytes`: `int`; (Html kept in memory at most)
+        `cache_dir`: `str`; (Directory shared by the processes, optional)
+    """
+
+    def __init__(self, fetcher, ttl=120, max_bytes=32 * 1024 * 1024, cache_dir=None):
+        self.fetcher = fetcher
+        self.configure(ttl, max_bytes, cache_dir)
+        self._pages = OrderedDict()  # {url: CachedPage}, the least recently used first
+        self._bytes = 0
+        self._flights = {}  # {url: _Flight}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0}
+
+    def configure(self, ttl, max_bytes, cache_dir=None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir or None
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def init_app(self, app):
+        """Reads the `PAGE_CACHE_*` settings from the app config."""
+        self.configure(
+            ttl=app.config['PAGE_CACHE_TTL'],
+            max_bytes=app.config['PAGE_CACHE_MAX_BYTES'],
+            cache_dir=app.config['PAGE_CACHE_DIR']
+        )
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    # --- In memory ---
+
+    def _get(self, url: str):
+        with self._lock:
+            page = self._pages.get(url)
+            if page is None:
+                return None
+            if page.expires_at <= time.time():
+                self._drop(url)
+                return None
+            self._pages.move_to_end(url)
+            return page
+
+    def _drop(self, url: str):
+        page = self._pages.pop(url)
+        self._bytes -= page.size
+
+    def _put(self, url: str, page: CachedPage):
+        if page.size > self.max_bytes:
+            return
+        with self._lock:
+            if url in self._pages:
+                self._drop(url)
+            self._pages[url] = page
+            self._bytes += page.size
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._pages)))
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self._bytes = 0
+
+    # --- On disk ---
+
+    def _path(self, url: str, ext: str):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode()).hexdigest() + ext)
+
+    def _read_disk(self, url: str):
+        if not self.cache_dir:
+            return None
+        path = self._path(url, '.json')
+        try:
+            if os.path.getmtime(path) + self.ttl <= time.time():
+                return None
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('url') != url:
+            return None
+        result = FetchResult(url=url, html=data['html'], mode=data['mode'], status_code=data['status_code'])
+        return CachedPage(
+            result=result, browser_checked=data['browser_checked'],
+            expires_at=data['fetched_at'] + self.ttl, size=len(data['html'].encode())
+        )
+
+    def _write_disk(self, url: str, page: CachedPage):
+        if not self.cache_dir:
+            return
+        path = self._path(url, '.json')
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(
+                    {
+                        'url': url,
+                        'html': page.result.html,
+                        'mode': page.result.mode,
+                        'status_code': page.result.status_code,
+                        'browser_checked': page.browser_checked,
+                        'fetched_at': page.expires_at - self.ttl
+                    },
+                    f
+                )
+            os.replace(tmp_path, path)  # Readers never see half a file
+        except OSError as e:
+            logger.warning(f"PAGE_CACHE: Couldn't write '{url}' to the disk cache. \t {e}")
+
+    def _lock_file(self, url: str):
+        """Opens (and locks) the lock file of the url; `None` without a disk cache."""
+        if not self.cache_dir or fcntl is None:
+            return None
+        lock_file = open(self._path(url, '.lock'), 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    # --- Fetching ---
+
+    def _fetch(self, url: str, key: str, query_strs, stale: CachedPage = None):
+        """Fetches the page (only renders it if the static `stale` page lacks the query strings)."""
+        lock_file = self._lock_file(key)
+        try:
+            if lock_file is not None:
+                # Another process may have fetched it while we waited for the lock.
+                page = self._read_disk(key)
+                if page is not None and page.serves(query_strs):
+                    self._count('disk_hits')
+                    self._put(key, page)
+                    return page
+
+            if stale is not None:
+                result = self.fetcher.pick(url, stale.result, self.fetcher.fetch_browser(url), query_strs)
+            else:
+                result = self.fetcher.fetch(url, query_strs)
+
+            browser_checked = result.ok and (
+                result.mode == FETCH_MODE_BROWSER or not contains_all(result.html, query_strs)
+            )
+            page = CachedPage(
+                result=result,
+                browser_checked=browser_checked,
+                expires_at=time.time() + self.ttl,
+                size=len(result.html.encode()) if result.ok else 0
+            )
+            if result.ok and self.ttl > 0:
+                self._put(key, page)
+                self._write_disk(key, page)
+            return page
+
+        finally:
+            if lock_file is not None:
+                lock_file.close()  # (Releases the lock)
+
+    def _single_flight(self, key: str, fetch):
+        """Runs `fetch()` for the url unless it is already running; then waits for that one."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.stats['coalesced'] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.page
+
+        try:
+            flight.page = fetch()
+            return flight.page
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def get(self, url: str, query_strs=()):
+        """
+        Returns the (cached or fetched) page showing the query strings.
+
+        Returns:
+        --------
+            `FetchResult` (a copy; the caller may change it)
+        """
+        query_strs = list(query_strs)
+        key = canonicalize_url(url)
+
+        page = self._get(key)
+        if page is None and self.ttl > 0:
+            page = self._read_disk(key)
+            if page is not None:
+                self._count('disk_hits')
+                self._put(key, page)
+
+        if page is not None and page.serves(query_strs):
+            self._count('hits')
+            return replace(page.result, url=url)
+
+        self._count('misses')
+        for _ in range(2):
+            stale = page
+            page = self._single_flight(key, lambda: self._fetch(url, key, query_strs, stale))
+            # The fetch we waited for may have looked for other query strings.
+            if not page.result.ok or page.serves(query_strs):
+                break
+        return replace(page.result, url=url)
+
+    def evaluate(self, url: str, query_strs):
+        """
+        `PageFetcher.evaluate` through the cache.
+
+        Returns:
+        --------
+            `FetchResult` with `counts` = {query_str: (occurrence_count, webpage_hash)}.
+        """
+        query_strs = list(query_strs)
+        return self.fetcher.count(self.get(url, query_strs), query_strs)
@@ -0,0 +1,186 @@
+# Per-host rate limiting for every fetch
+#
+# Author: Indrajit Ghosh
+#
+# Date: Mar 07, 2024
+#
+
+"""
+Several portals (state PSC sites) throttle or block us when their pages are
+fetched back-to-back. `HostRateLimiter` keeps a token bucket per host: a host
+gets `rate` requests per second on average with bursts of up to `burst`
+requests, unless a per-domain override says otherwise. With `respect_robots`
+on, the `Crawl-delay` of the host's robots.txt lowers its rate further.
+
+Every fetch (plain HTTP or browser, sync or async) first waits for a token of
+its host:
+
+    >>> host_rate_limiter.wait('https://wbpsc.gov.in/notices')          # threads
+    >>> await host_rate_limiter.wait_async('https://wbpsc.gov.in/notices')  # asyncio
+
+`host_rate_limiter` is the limiter shared by the whole process; the app
+configures it from the `FETCH_RATE_*` settings.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+from urllib.robotparser import RobotFileParser
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+ROBOTS_USER_AGENT = "AdNotifier"
+ROBOTS_TIMEOUT = (5, 10)  # (connect, read) seconds
+
+
+def parse_rate_overrides(spec: str):
+    """
+    Parses per-domain rates written as 'wbpsc.gov.in=0.2,pscwbonline.gov.in=1'.
+
+    Returns:
+    --------
+        {domain: requests per second}
+    """
+    overrides = {}
+    for item in (spec or '').split(','):
+        if '=' not in item:
+            continue
+        domain, rate = item.split('=', 1)
+        try:
+            overrides[domain.strip().lower()] = float(rate)
+        except ValueError:
+            logger.warning(f"RATE_LIMITER: Ignoring the invalid rate override '{item.strip()}'.")
+    return overrides
+
+
+class TokenBucket:
+    """
+    A token bucket which hands out reservations: `reserve()` takes a token
+    right away (possibly going into debt) and returns how long the caller has
+    to wait before using it. So waiting never happens under the lock and
+    works the same for threads and coroutines.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class HostRateLimiter:
+    """
+    Parameters:
+    -----------
+        `rate`: `float`; (Requests per second per host; 0 disables the limiter)
+        `burst`: `int`; (Requests a host may get back-to-back)
+        `overrides`: `dict`; ({domain: rate} for particular domains and their subdomains)
+        `respect_robots`: `bool`; (Whether to honour the `Crawl-delay` of robots.txt)
+    """
+
+    def __init__(self, rate=1.0, burst=2, overrides=None, respect_robots=False):
+        self.configure(rate, burst, overrides, respect_robots)
+
+    def configure(self, rate, burst, overrides=None, respect_robots=False):
+        self.rate = rate
+        self.burst = burst
+        self.overrides = {domain.lower(): value for domain, value in (overrides or {}).items()}
+        self.respect_robots = respect_robots
+        self._buckets = {}
+        self._crawl_delays = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Reads the `FETCH_RATE_*` settings from the app config."""
+        self.configure(
+            rate=app.config['FETCH_RATE_PER_HOST'],
+            burst=app.config['FETCH_RATE_BURST'],
+            overrides=parse_rate_overrides(app.config['FETCH_RATE_OVERRIDES']),
+            respect_robots=app.config['FETCH_RESPECT_ROBOTS']
+        )
+
+    def _host_rate(self, host: str):
+        rate = self.rate
+        domain = host
+        while domain:
+            if domain in self.overrides:
+                rate = self.overrides[domain]
+                break
+            domain = domain.partition('.')[2]
+
+        crawl_delay = self._crawl_delays.get(host)
+        if crawl_delay:
+            rate = min(rate, 1 / crawl_delay) if rate > 0 else 1 / crawl_delay
+        return rate
+
+    def _bucket(self, host: str):
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                rate = self._host_rate(host)
+                bucket = self._buckets[host] = TokenBucket(rate, self.burst) if rate > 0 else None
+            return bucket
+
+    def _load_crawl_delay(self, url: str, host: str):
+        """Reads the `Crawl-delay` of the host's robots.txt (once per host)."""
+        if not self.respect_robots or host in self._crawl_delays:
+            return
+
+        parts = urlsplit(url)
+        crawl_delay = None
+        try:
+            response = requests.get(f"{parts.scheme}://{parts.netloc}/robots.txt", timeout=ROBOTS_TIMEOUT)
+            if response.ok:
+                robots = RobotFileParser()
+                robots.parse(response.text.splitlines())
+                robots.modified()  # (`crawl_delay` ignores a parser never marked as read)
+                crawl_delay = robots.crawl_delay(ROBOTS_USER_AGENT)
+        except Exception as e:
+            logger.debug(f"RATE_LIMITER: Couldn't read the robots.txt of '{host}'. \t {e}")
+
+        with self._lock:
+            self._crawl_delays[host] = float(crawl_delay) if crawl_delay else None
+            self._buckets.pop(host, None)  # Rebuilt with the crawl delay
+        if crawl_delay:
+            logger.info(f"RATE_LIMITER: '{host}' asks for a crawl delay of {crawl_delay} seconds.")
+
+    def reserve(self, url: str):
+        """Takes a token of the url's host and returns the seconds to wait before fetching."""
+        host = (urlsplit(url).hostname or '').lower()
+        bucket = self._bucket(host)
+        return bucket.reserve() if bucket is not None else 0.0
+
+    def wait(self, url: str):
+        """Blocks until the url may be fetched."""
+        self._load_crawl_delay(url, (urlsplit(url).hostname or '').lower())
+        delay = self.reserve(url)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    async def wait_async(self, url: str):
+        """Sleeps (without blocking the event loop) until the url may be fetched."""
+        host = (urlsplit(url).hostname or '').lower()
+        if self.respect_robots and host not in self._crawl_delays:
+            await asyncio.get_running_loop().run_in_executor(None, self._load_crawl_delay, url, host)
+        delay = self.reserve(url)
+        if delay:
+            await asyncio.sleep(delay)
+        return delay
+
+
+# The limiter shared by every fetch of the process
+host_rate_limiter = HostRateLimiter()
@@ -0,0 +1,302 @@
+# Multi-core (sharded) fetching and counting for the check runs
+#
+# Author: Indrajit Ghosh
+#
+# Date: Mar 04, 2024
+#
+
+"""
+Parsing and hashing the pages is CPU-bound, so a single process spends most
+of a check run on one core. `ShardedChecker` splits the pages of a run by
+domain into shards and lets a pool of worker processes fetch, parse and
+count their shard (every worker has its own `FetchEngine`, `PageFetcher`
+and browser pool). The counted pages are streamed back to the parent, which
+stays the only one touching the database and notifying users, exactly as
+in a sequential run.
+
+Sharding by domain keeps every host in a single worker, so the per-host
+concurrency limit (and the circuit breaker of every domain) still holds
+across the whole run.
+
+The workers are never forked from the app's process (with its scheduler
+threads, database connections and browsers): they are started by a fork
+server (or spawned where there is none) and only import this module, which
+doesn't build the app. Everything they need (including the fetch timeouts
+and rate limits the app configured) comes with their settings.
+
+The worker processes (and their browsers) live as long as the checker: a
+check run streams all its windows through one checker and closes it at the
+end.
+
+Usage:
+------
+    >>> with ShardedChecker(workers=4, parser='lxml', js_domains={'wbpsc.gov.in': True}) as checker:
+    ...     for page in checker.stream([('https://wbpsc.gov.in', ['ADV-1'])]):
+    ...         print(page.url, page.counts)
+    >>> checker.new_decisions
+    {}
+"""
+
+import heapq
+import logging
+import multiprocessing
+import multiprocessing.util
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from scripts.fetcher import get_domain
+from scripts.rate_limiter import host_rate_limiter
+from scripts.timeouts import fetch_timeouts
+
+logger = logging.getLogger(__name__)
+
+# The fetcher of a worker process (set up by `_init_worker`)
+_worker_fetcher = None
+
+
+def shard_jobs(jobs, shards: int):
+    """
+    Splits the fetch jobs [(url, query_strs), ...] into at most `shards`
+    lists such that all urls of a domain end up in the same shard and the
+    shards get about the same number of urls.
+    """
+    by_domain = {}
+    for url, query_strs in jobs:
+        by_domain.setdefault(get_domain(url), []).append((url, query_strs))
+
+    # Biggest domains first, each to the currently smallest shard
+    heap = [(0, i) for i in range(max(1, shards))]
+    sharded = [[] for _ in heap]
+    for domain in sorted(by_domain, key=lambda domain: (-len(by_domain[domain]), domain)):
+        size, i = heapq.heappop(heap)
+        sharded[i].extend(by_domain[domain])
+        heapq.heappush(heap, (size + len(by_domain[domain]), i))
+
+    return [shard for shard in sharded if shard]
+
+
+def _init_worker(settings: dict, js_domains: dict):
+    global _worker_fetcher
+
+    from scripts.browser_pool import BrowserPool
+    from scripts.fetcher import PageFetcher
+    from scripts.rate_limiter import host_rate_limiter
+    from scripts.timeouts import fetch_timeouts
+
+    fetch_timeouts.configure(*settings['fetch_timeouts'])
+    host_rate_limiter.configure(**settings['rate_limits'])
+
+    pool = BrowserPool(
+        size=settings['browser_pool_size'],
+        max_pages=settings['browser_max_pages'],
+        max_rss_mb=settings['browser_max_rss_mb'],
+        checkout_timeout=settings['browser_checkout_timeout']
+    )
+    # (`atexit` doesn't run in the pool's workers; their finalizers do.)
+    multiprocessing.util.Finalize(None, pool.close, exitpriority=10)
+    _worker_fetcher = PageFetcher(pool=pool, js_domains=js_domains, parser=settings['parser'])
+
+
+def _check_shard(jobs, validators: dict, settings: dict, breaker_states=None, js_domains=None):
+    """
+    Fetches and counts the pages of a shard in a worker process (knowing the
+    {domain: needs_js} decisions `js_domains` the other workers took so far).
+
+    Returns:
+    --------
+        ([FetchResult, ...], {domain: needs_js}, {domain: BreakerState})
+    """
+    from scripts.circuit_breaker import DomainCircuitBreaker
+    from scripts.fetch_engine import FetchEngine
+
+    breaker = None
+    if settings['breaker'] is not None:
+        breaker = DomainCircuitBreaker(states=breaker_states, **settings['breaker'])
+
+    engine = FetchEngine(
+        _worker_fetcher,
+        max_concurrency=settings['max_concurrency'],
+        per_host=settings['per_host'],
+        timeout=settings['timeout'],
+        browser_workers=settings['browser_pool_size'],
+        breaker=breaker,
+        deadline=settings['deadline']
+    )
+    query_strs_by_url = {url: query_strs for url, query_strs in jobs}
+    _worker_fetcher.remember_domains(js_domains or {})
+
+    pages = []
+    for page in engine.stream(jobs, validators=validators):
+        if not page.not_modified:
+            _worker_fetcher.count(page, query_strs_by_url[page.url], last_check=validators.get(page.url))
+            if page.ok:
+                # The parent only needs the counts; an empty html keeps `ok`.
+                page.html = ''
+        pages.append(page)
+
+    return pages, _worker_fetcher.pop_new_decisions(), breaker.pop_changes() if breaker is not None else {}
+
+
+def _worker_context():
+    """
+    The multiprocessing context of the workers: a fork server (preloading
+    this module, so that every worker starts with it imported) where there
+    is one, otherwise spawn. Forking the app's process would copy its
+    scheduler, database connections and browsers into every worker.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+class ShardedChecker:
+    """
+    Fetches and counts the pages of a check run in a pool of processes.
+
+    Parameters:
+    -----------
+        `workers`: `int`; (Worker processes)
+        `parser`: `str`; (The html parser used for counting and hashing)
+        `js_domains`: `dict`; ({domain: needs_js} decisions known beforehand)
+        `max_concurrency`: `int`; (Pages in flight at once, over all workers)
+        `per_host`: `int`; (Pages in flight at once per host)
+        `timeout`: `float`; (Seconds a single page may take)
+        `browser_pool_size`: `int`; (Browsers over all workers; every worker gets at least one)
+        `browser_max_pages`, `browser_max_rss_mb`, `browser_checkout_timeout`: see `BrowserPool`
+        `breaker`: `DomainCircuitBreaker`; (optional; updated with what the workers learn)
+        `deadline`: `float`; (optional; `time.time()` by which the fetching has to stop)
+    """
+
+    def __init__(self, workers=4, parser='html.parser', js_domains=None, max_concurrency=16,
+                 per_host=2, timeout=60, browser_pool_size=2, browser_max_pages=50,
+                 browser_max_rss_mb=1024, browser_checkout_timeout=300, breaker=None, deadline=None):
+        self.workers = max(1, workers)
+        self.js_domains = dict(js_domains or {})
+        self.breaker = breaker
+        self.settings = {
+            'parser': parser,
+            'max_concurrency': max(1, max_concurrency // self.workers),
+            'per_host': per_host,
+            'timeout': timeout,
+            'browser_pool_size': max(1, browser_pool_size // self.workers),
+            'browser_max_pages': browser_max_pages,
+            'browser_max_rss_mb': browser_max_rss_mb,
+            'browser_checkout_timeout': browser_checkout_timeout,
+            'breaker': breaker.settings() if breaker is not None else None,
+            'deadline': deadline,
+            # (As configured in this process; the workers don't inherit them.)
+            'fetch_timeouts': (fetch_timeouts.connect, fetch_timeouts.read, fetch_timeouts.render),
+            'rate_limits': {
+                'rate': host_rate_limiter.rate,
+                'burst': host_rate_limiter.burst,
+                'overrides': host_rate_limiter.overrides,
+                'respect_robots': host_rate_limiter.respect_robots,
+            },
+        }
+        self.new_decisions = {}
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Stops the worker processes (which quit their browsers)."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def _pool(self):
+        """The pool of worker processes, started on first use."""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=_worker_context(),
+                initializer=_init_worker,
+                initargs=(self.settings, self.js_domains)
+            )
+        return self._executor
+
+    @classmethod
+    def from_config(cls, config, js_domains=None, breaker=None, deadline=None):
+        """Builds the checker from the app config."""
+        return cls(
+            workers=config['CHECK_WORKERS'],
+            parser=config['HTML_PARSER'],
+            js_domains=js_domains,
+            max_concurrency=config['FETCH_CONCURRENCY'],
+            per_host=config['FETCH_PER_HOST_CONCURRENCY'],
+            timeout=config['FETCH_TIMEOUT'],
+            browser_pool_size=config['BROWSER_POOL_SIZE'],
+            browser_max_pages=config['BROWSER_MAX_PAGES'],
+            browser_max_rss_mb=config['BROWSER_MAX_RSS_MB'],
+            browser_checkout_timeout=config['BROWSER_CHECKOUT_TIMEOUT'],
+            breaker=breaker,
+            deadline=deadline
+        )
+
+    def stream(self, jobs, validators=None):
+        """
+        Fetches and counts the pages of `jobs` in the worker processes and
+        yields a counted `FetchResult` for each of them, shard by shard.
+        The {domain: needs_js} decisions the workers took are collected in
+        `new_decisions`, the breaker states they changed go to `breaker`.
+
+        Parameters:
+        -----------
+            `jobs`: [(url, query_strs), ...]
+            `validators`: {url: {'etag': ..., 'last_modified': ..., 'raw_digest': ..., 'text_digest': ...,
+                          'locators': ...}}; (optional; all but the validators are what the pages are
+                          counted against, see `PageFetcher.count`)
+        """
+        validators = validators or {}
+        breaker_states = self.breaker.states if self.breaker is not None else {}
+        shards = shard_jobs([(url, list(query_strs)) for url, query_strs in jobs], self.workers)
+        if not shards:
+            return
+
+        executor = self._pool()
+        futures = {
+            executor.submit(
+                _check_shard, shard,
+                {url: validators[url] for url, _ in shard if url in validators},
+                self.settings,
+                {
+                    domain: breaker_states[domain]
+                    for domain in {get_domain(url) for url, _ in shard} if domain in breaker_states
+                },
+                self.js_domains
+            ): shard
+            for shard in shards
+        }
+
+        for future in as_completed(futures):
+            try:
+                pages, decisions, breaker_changes = future.result()
+            except Exception as e:
+                # A crashed worker must not lose its pages silently.
+                logger.error(f"SHARDED_CHECKER: A worker crashed while checking {len(futures[future])} pages. \t {e}")
+                pages, decisions, breaker_changes = self._failed_pages(futures[future], e), {}, {}
+                if isinstance(e, BrokenProcessPool) and self._executor is executor:
+                    # (A broken pool takes no more work; the next stream starts a new one.)
+                    self._executor = None
+                    executor.shutdown(wait=False)
+
+            self.new_decisions.update(decisions)
+            self.js_domains.update(decisions)
+            if self.breaker is not None:
+                self.breaker.merge(breaker_changes)
+            yield from pages
+
+    @staticmethod
+    def _failed_pages(shard, err):
+        from scripts.fetcher import FetchResult
+
+        return [
+            FetchResult(url=url, error=str(err), counts={query_str: (-1, None) for query_str in query_strs})
+            for url, query_strs in shard
+        ]
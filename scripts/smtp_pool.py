@@ -0,0 +1,214 @@
+# A pool of reusable SMTP sessions
+#
+# Author: Indrajit Ghosh
+#
+# Date: Mar 10, 2024
+#
+
+"""
+Opening an SMTP session (connect, STARTTLS, login) takes longer than sending
+a message through it, and Gmail throttles clients which log in for every
+single message. `SMTPPool` keeps a few logged in sessions around and sends
+every message through one of them:
+
+    - at most `size` sessions are open (and in use) at once; a sender waits
+      up to `checkout_timeout` seconds for a free one,
+    - a session is closed after `max_messages` messages or once it was idle
+      for longer than `idle_timeout` seconds (the server drops it anyway),
+    - a session the server dropped is replaced and the message sent again
+      (once); an error about the message itself (e.g. a refused recipient)
+      is raised without a retry.
+
+Usage:
+------
+    >>> pool = SMTPPool(host='smtp.gmail.com', port=587, username=..., password=...)
+    >>> pool.send(EmailMessage(sender_email_id=..., to='someone@gmail.com', subject='Hi'))
+"""
+
+import atexit
+import logging
+import queue
+import smtplib
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _is_dropped(err: Exception):
+    """Checks whether an error means the session is gone (and not that the message was refused)."""
+    if isinstance(err, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    if isinstance(err, smtplib.SMTPResponseException):
+        return err.smtp_code == 421  # Service not available, closing the channel
+    # (Every `smtplib` error is an `OSError` too.)
+    return isinstance(err, OSError) and not isinstance(err, smtplib.SMTPException)
+
+
+class PooledSMTP:
+    """
+    A logged in SMTP session along with some bookkeeping.
+    """
+
+    def __init__(self, host, port, username, password, timeout=30):
+        self.server = smtplib.SMTP(host, port, timeout=timeout)
+        try:
+            self.server.starttls()
+            self.server.login(username, password)
+        except Exception:
+            self.close()
+            raise
+        self.messages = 0
+        self.last_used = time.monotonic()
+
+    def is_alive(self):
+        try:
+            return self.server.noop()[0] == 250
+        except Exception:
+            return False
+
+    def send(self, from_addr, to_addrs, message):
+        self.server.sendmail(from_addr, to_addrs, message)
+        self.messages += 1
+        self.last_used = time.monotonic()
+
+    def close(self):
+        try:
+            self.server.quit()
+        except Exception:
+            try:
+                self.server.close()
+            except Exception:
+                pass
+
+
+class SMTPPool:
+    """
+    Parameters:
+    -----------
+        `host`, `port`: The SMTP server
+        `username`, `password`: The login of the sender
+        `size`: `int`; (Sessions open at once)
+        `max_messages`: `int`; (Messages sent through a session before it is replaced)
+        `idle_timeout`: `float`; (Seconds a session may stay idle before it is closed)
+        `checkout_timeout`: `float`; (Seconds to wait for a free session)
+        `timeout`: `float`; (Seconds of the socket operations of a session)
+    """
+
+    def __init__(self, host=None, port=587, username=None, password=None, size=2, max_messages=100,
+                 idle_timeout=60, checkout_timeout=120, timeout=30):
+        self.configure(host, port, username, password, size, max_messages, idle_timeout, checkout_timeout, timeout)
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self.stats = {'sessions': 0, 'messages': 0, 'reconnects': 0}
+        atexit.register(self.close)
+
+    def configure(self, host, port, username, password, size=2, max_messages=100, idle_timeout=60,
+                  checkout_timeout=120, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = max(1, size)
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    def init_app(self, app):
+        """Reads the mail server and the pool settings from the app config."""
+        host, port = app.config['MAIL_SERVER']
+        self.configure(
+            host=host,
+            port=port,
+            username=app.config['MAIL_USERNAME'],
+            password=app.config['MAIL_PASSWORD'],
+            size=app.config['SMTP_POOL_SIZE'],
+            max_messages=app.config['SMTP_MAX_MESSAGES'],
+            idle_timeout=app.config['SMTP_IDLE_TIMEOUT'],
+            checkout_timeout=app.config['SMTP_CHECKOUT_TIMEOUT'],
+            timeout=app.config['SMTP_TIMEOUT'],
+        )
+
+    def _connect(self):
+        session = PooledSMTP(self.host, self.port, self.username, self.password, timeout=self.timeout)
+        with self._lock:
+            self.stats['sessions'] += 1
+        return session
+
+    def _checkout(self):
+        """Returns an idle session which is still usable (or a new one)."""
+        while True:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+
+            if time.monotonic() - session.last_used > self.idle_timeout or not session.is_alive():
+                session.close()
+                continue
+            return session
+
+    def _return(self, session):
+        if self._closed or session.messages >= self.max_messages:
+            session.close()
+        else:
+            self._idle.put(session)
+
+    def send(self, msg):
+        """Sends an `EmailMessage` through a pooled session (see `send_raw`)."""
+        self.send_raw(msg.sender, msg.recipients, msg.as_string())
+
+    def send_raw(self, from_addr, to_addrs, message: str):
+        """
+        Sends a MIME message (a string) through a pooled session.
+
+        Raises:
+        -------
+            `TimeoutError` if no session got free in time, or the `smtplib`
+            error of a failed send.
+        """
+        if self._closed:
+            raise RuntimeError("The SMTP pool has been closed.")
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            raise TimeoutError("Timed out waiting for a free SMTP session.")
+
+        try:
+            session = self._checkout()
+            try:
+                session.send(from_addr, to_addrs, message)
+            except Exception as e:
+                # The session may be in the middle of a transaction.
+                session.close()
+                if not _is_dropped(e):
+                    raise
+
+                # The server dropped the session; try once more on a new one.
+                logger.warning(f"SMTP_POOL: Reconnecting after a dropped session. \t {e}")
+                with self._lock:
+                    self.stats['reconnects'] += 1
+                session = self._connect()
+                try:
+                    session.send(from_addr, to_addrs, message)
+                except Exception:
+                    session.close()
+                    raise
+
+            with self._lock:
+                self.stats['messages'] += 1
+            self._return(session)
+
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Closes every idle session of the pool."""
+        self._closed = True
+        while True:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            session.close()
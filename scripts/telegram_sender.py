@@ -0,0 +1,231 @@
+# Concurrent, rate limited Telegram delivery
+#
+# Author: Indrajit Ghosh
+#
+# Date: Mar 12, 2024
+#
+
+"""
+Sending the Telegram notifications of a check run one GET request after
+another (each on a new connection) is slow, and going faster gets the bot
+throttled. `TelegramSender` delivers a batch of messages
+
+    - with POST requests over one keep-alive session (a connection pool as
+      big as the number of worker threads),
+    - from `workers` threads at once, but never faster than Telegram's limit
+      for a bot (about 30 messages a second overall and one message a second
+      per chat),
+    - honouring the `retry_after` of a `429 Too Many Requests`: every worker
+      pauses that long before the message is sent again,
+    - retrying server errors and dropped connections a few times; other
+      errors (e.g. `403`: the user blocked the bot) are final.
+
+Usage:
+------
+    >>> sender = TelegramSender(bot_token='123:abc')
+    >>> stats = sender.send_many([(228394822, 'Hello!')])
+    >>> stats['sent'], stats['failed']
+    (1, 0)
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from scripts.rate_limiter import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+
+# Telegram cuts messages longer than this
+MAX_MESSAGE_LENGTH = 4096
+
+
+@dataclass
+class TelegramResult:
+    chat_id: int
+    ok: bool = False
+    status_code: int = None
+    error: str = None
+    attempts: int = 0
+    rate_limited: int = 0  # Times Telegram answered `429`
+
+
+class TelegramSender:
+    """
+    Parameters:
+    -----------
+        `bot_token`: `str`
+        `api_url`: `str`; (The Bot API server; a local stand-in for testing)
+        `workers`: `int`; (Messages in flight at once)
+        `rate`: `float`; (Messages per second over all chats)
+        `per_chat_interval`: `float`; (Seconds between two messages to the same chat)
+        `max_attempts`: `int`; (Attempts of a message, not counting the `429`s)
+        `timeout`: (connect, read) seconds of a request
+    """
+
+    def __init__(self, bot_token=None, api_url=TELEGRAM_API_URL, workers=8, rate=25,
+                 per_chat_interval=1.0, max_attempts=3, timeout=(10, 30)):
+        self.configure(bot_token, api_url, workers, rate, per_chat_interval, max_attempts, timeout)
+
+    def configure(self, bot_token, api_url=TELEGRAM_API_URL, workers=8, rate=25,
+                  per_chat_interval=1.0, max_attempts=3, timeout=(10, 30)):
+        self.bot_token = bot_token
+        self.api_url = api_url.rstrip('/')
+        self.workers = max(1, workers)
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max(1, max_attempts)
+        self.timeout = timeout
+        self._bucket = TokenBucket(rate, max(1, int(rate))) if rate > 0 else None
+        self._chat_next = {}  # {chat_id: time.monotonic() of its next allowed message}
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self._session = None
+
+    def init_app(self, app):
+        """Reads the `TELEGRAM_*` settings from the app config."""
+        self.configure(
+            bot_token=app.config['TELEGRAM_BOT_TOKEN'],
+            api_url=app.config['TELEGRAM_API_URL'],
+            workers=app.config['TELEGRAM_WORKERS'],
+            rate=app.config['TELEGRAM_RATE_PER_SECOND'],
+            per_chat_interval=app.config['TELEGRAM_PER_CHAT_INTERVAL'],
+            max_attempts=app.config['TELEGRAM_MAX_ATTEMPTS'],
+            timeout=(app.config['FETCH_CONNECT_TIMEOUT'], app.config['FETCH_READ_TIMEOUT'])
+        )
+
+    @property
+    def session(self):
+        # (`requests.Session` is fine to share between threads for plain
+        # POSTs; its pool keeps a connection per worker alive.)
+        with self._lock:
+            if self._session is None:
+                self._session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+                self._session.mount('https://', adapter)
+                self._session.mount('http://', adapter)
+            return self._session
+
+    def _wait_turn(self, chat_id):
+        """Sleeps until a message may go to the chat."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._paused_until, self._chat_next.get(chat_id, 0.0))
+            self._chat_next[chat_id] = start + self.per_chat_interval
+        delay = start - now
+        if self._bucket is not None:
+            delay = max(delay, self._bucket.reserve())
+        if delay > 0:
+            time.sleep(delay)
+
+        # A `429` of another message may have paused everyone meanwhile.
+        paused = self._paused_until - time.monotonic()
+        if paused > 0:
+            time.sleep(paused)
+
+    def _pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def send(self, chat_id, text: str):
+        """
+        Sends a message to a chat (retrying as described above).
+
+        Returns:
+        --------
+            `TelegramResult`
+        """
+        result = TelegramResult(chat_id=chat_id)
+        url = f"{self.api_url}/bot{self.bot_token}/sendMessage"
+        payload = {'chat_id': chat_id, 'text': text[:MAX_MESSAGE_LENGTH]}
+
+        while result.attempts < self.max_attempts:
+            self._wait_turn(chat_id)
+            try:
+                response = self.session.post(url, json=payload, timeout=self.timeout)
+            except requests.RequestException as e:
+                result.attempts += 1
+                result.error = str(e)
+                time.sleep(min(2 ** result.attempts, 30))
+                continue
+
+            result.status_code = response.status_code
+            if response.status_code == 429:
+                # Doesn't count as an attempt: Telegram tells us when to come back.
+                retry_after = self._retry_after(response)
+                result.rate_limited += 1
+                result.error = f"Too Many Requests: retry after {retry_after}"
+                logger.warning(f"TELEGRAM_RATE_LIMITED: Pausing for {retry_after} seconds.")
+                self._pause(retry_after)
+                if result.rate_limited > 2 * self.max_attempts:
+                    break
+                continue
+
+            result.attempts += 1
+            if response.ok:
+                result.ok = True
+                result.error = None
+                return result
+
+            result.error = self._description(response)
+            if response.status_code < 500:
+                break  # Final (bad chat id, the bot was blocked, ...)
+            time.sleep(min(2 ** result.attempts, 30))
+
+        return result
+
+    @staticmethod
+    def _retry_after(response):
+        try:
+            return float(response.json()['parameters']['retry_after'])
+        except Exception:
+            return float(response.headers.get('Retry-After', 1))
+
+    @staticmethod
+    def _description(response):
+        try:
+            return response.json().get('description') or response.reason
+        except Exception:
+            return response.reason
+
+    def send_many(self, messages):
+        """
+        Sends the messages [(chat_id, text), ...] concurrently.
+
+        Returns:
+        --------
+            `dict`: {'sent': ..., 'failed': ..., 'rate_limited': ..., 'retries': ..., 'results': [TelegramResult, ...]}
+        """
+        messages = list(messages)
+        stats = {'sent': 0, 'failed': 0, 'rate_limited': 0, 'retries': 0, 'results': []}
+        if not messages:
+            return stats
+        if not self.bot_token:
+            logger.error("TELEGRAM_ERR: No bot token configured; the messages are not sent.")
+            stats['failed'] = len(messages)
+            return stats
+
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(messages)), thread_name_prefix="telegram") as executor:
+            results = list(executor.map(lambda message: self.send(*message), messages))
+
+        for result in results:
+            if result.ok:
+                stats['sent'] += 1
+                logger.info(f"TELEGRAM_SENT: Telegram message sent to `{result.chat_id}`.")
+            else:
+                stats['failed'] += 1
+                logger.error(f"TELEGRAM_ERR: Telegram message couldn't be sent to `{result.chat_id}`. \t {result.error}")
+            stats['rate_limited'] += result.rate_limited
+            stats['retries'] += max(0, result.attempts - 1)
+        stats['results'] = results
+        return stats
+
+
+# The sender shared by the whole process
+telegram_sender = TelegramSender()
@@ -0,0 +1,68 @@
+# Timeouts of every fetch
+#
+# Author: Indrajit Ghosh
+#
+# Date: Mar 09, 2024
+#
+
+"""
+A fetch without a timeout can hang forever on a site that accepts the
+connection and never answers, and with it the whole check run. Every fetch
+(plain HTTP, httpx or a browser) takes its limits from `fetch_timeouts`:
+
+    - `connect`: seconds to establish the connection,
+    - `read`: seconds to wait for the server between two chunks of data,
+    - `render`: seconds a browser may take to load a page.
+
+    >>> requests.get(url, timeout=fetch_timeouts.http)
+    >>> driver.set_page_load_timeout(fetch_timeouts.render)
+
+`fetch_timeouts` is shared by the whole process; the app configures it from
+the `FETCH_*_TIMEOUT` settings.
+"""
+
+TIMEOUT_CONNECT = 'connect'
+TIMEOUT_READ = 'read'
+TIMEOUT_RENDER = 'render'
+TIMEOUT_PAGE = 'page'  # The page took longer than `FETCH_TIMEOUT` altogether
+TIMEOUT_QUEUE = 'queue'  # No browser of the pool got free in time (our fault, not the site's)
+
+
+class FetchTimeouts:
+    """
+    Parameters:
+    -----------
+        `connect`: `float`; (Seconds)
+        `read`: `float`; (Seconds)
+        `render`: `float`; (Seconds)
+    """
+
+    def __init__(self, connect=10, read=30, render=45):
+        self.configure(connect, read, render)
+
+    def configure(self, connect, read, render):
+        self.connect = connect
+        self.read = read
+        self.render = render
+
+    def init_app(self, app):
+        """Reads the `FETCH_*_TIMEOUT` settings from the app config."""
+        self.configure(
+            connect=app.config['FETCH_CONNECT_TIMEOUT'],
+            read=app.config['FETCH_READ_TIMEOUT'],
+            render=app.config['FETCH_RENDER_TIMEOUT']
+        )
+
+    @property
+    def http(self):
+        """The (connect, read) timeout of `requests`."""
+        return (self.connect, self.read)
+
+    @property
+    def page(self):
+        """Seconds a page may take through all the stages (HTTP, then the browser)."""
+        return self.connect + self.read + self.render
+
+
+# The timeouts shared by every fetch of the process
+fetch_timeouts = FetchTimeouts()
@@ -6,18 +6,34 @@
 #
 
 import random
+import re
 import hashlib
 from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 import requests
 from bs4 import BeautifulSoup
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
 
+from scripts.matcher import MultiPatternMatcher
+from scripts.rate_limiter import host_rate_limiter
+from scripts.timeouts import fetch_timeouts
+from scripts.telegram_sender import TelegramSender, telegram_sender
+from scripts.html_parser import parse_html, lowest_common_ancestor, REGION_CONTEXT_LEVELS
+
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Bump this whenever the way a page region is hashed changes. Stored hashes
+# carry the scheme they were computed with so that a change in the scheme is
+# not mistaken for a change on the webpage.
+REGION_HASH_VERSION = 3
+
+# Hashes stored before the schemes were recorded came from the browser.
+LEGACY_HASH_SCHEME = 'browser/v1'
+
 def send_telegram_message_by_BOT(bot_token:str, user_id:str, message:str='Hello World!'):
     """
     Sends msg to a user from a bot
@@ -27,14 +43,19 @@ def send_telegram_message_by_BOT(bot_token:str, user_id:str, message:str='Hello
         `user_id`: str; Telegram user_id of the receipent # use 'userinfobot' in 
                         telegram to know the user_id
         `message`: str
+
+    Returns:
+    --------
+        `bool`: Whether the message was sent
     """
-    message = message.replace('&', 'and')
-    telegram_api_url = f"https://api.telegram.org/bot{bot_token}/sendMessage?chat_id={user_id}&text={message}"
-    try:
-        requests.get(telegram_api_url)
+    # The shared sender keeps its connection to Telegram alive.
+    sender = telegram_sender if bot_token == telegram_sender.bot_token else TelegramSender(bot_token=bot_token)
+    result = sender.send(user_id, message)
+    if result.ok:
         logger.info(f"TELEGRAM_SENT: Telegram message sent to `{user_id}`.")
-    except Exception as err:
-        logger.error(f"TELEGRAM_ERR: Telegram message couldn't be sent to `{user_id}`. \t {err}.\n")
+    else:
+        logger.error(f"TELEGRAM_ERR: Telegram message couldn't be sent to `{user_id}`. \t {result.error}.\n")
+    return result.ok
 
 def generate_otp():
     """Generate a random 6-digit OTP (One-Time Password).
@@ -110,10 +131,11 @@ def get_webpage_sha256(url):
     :rtype: str or int
     """
     try:
+        host_rate_limiter.wait(url)
         try:
-            res = requests.get(url)
+            res = requests.get(url, timeout=fetch_timeouts.http)
         except requests.exceptions.SSLError:
-            res = requests.get(url, verify=False)
+            res = requests.get(url, timeout=fetch_timeouts.http, verify=False)
         res.raise_for_status()
 
         soup = BeautifulSoup(res.text, 'html.parser')
@@ -140,8 +162,10 @@ def get_webpage_sha256_selenium(url):
         chrome_options = Options()
         chrome_options.add_argument('--headless')
         driver = webdriver.Chrome(options=chrome_options)
+        driver.set_page_load_timeout(fetch_timeouts.render)
 
         # Fetch the webpage
+        host_rate_limiter.wait(url)
         driver.get(url)
 
         # Wait for some time to ensure dynamic content is loaded (you may need to adjust this)
@@ -187,10 +211,11 @@ def count_query_occurance(url:str, query_str:str):
     """
     try:
         # Fetch HTML content of the website
+        host_rate_limiter.wait(url)
         try:
-            response = requests.get(url)
+            response = requests.get(url, timeout=fetch_timeouts.http)
         except requests.exceptions.SSLError:
-            response = requests.get(url, verify=False)
+            response = requests.get(url, timeout=fetch_timeouts.http, verify=False)
         response.raise_for_status()  # Raise an HTTPError for bad responses
 
         # Parse the HTML content
@@ -215,46 +240,143 @@ def count_query_occurance(url:str, query_str:str):
         return -1  # Error indicator
     
 
-def find_minimal_tag(soup: BeautifulSoup, query_str: str):
+def _context_ancestor(node, levels=REGION_CONTEXT_LEVELS):
+    """Climbs `levels` parents up (or as far as possible) from the node."""
+    for _ in range(levels):
+        if node.parent is None:
+            break
+        node = node.parent
+    return node
+
+
+def find_minimal_tag(soup: BeautifulSoup, query_str: str, occurrences=None):
     """
     Finds the minimal HTML tag containing all occurrences of the specified query string.
 
+    Every occurrence is taken along with its surrounding context (the tag
+    `REGION_CONTEXT_LEVELS` levels above the text) and the minimal tag is the
+    lowest common ancestor of these.
+
     Parameters:
     - soup (BeautifulSoup): The BeautifulSoup object representing the HTML content.
     - query_str (str): The query string to search for.
+    - occurrences (list, optional): The text nodes containing the query string,
+      if they are already known (see `MultiPatternMatcher.find_text_nodes`).
 
     Returns:
     str: The minimal HTML tag containing all occurrences of the query string.
     """
     # Find all occurrences of the query string
-    occurrences = soup.find_all(string=lambda text: query_str in text)
+    if occurrences is None:
+        occurrences = soup.find_all(string=lambda text: query_str in text)
+
+    return lowest_common_ancestor(_context_ancestor(occurrence) for occurrence in occurrences)
 
-    # Find the minimal HTML tag containing all occurrences
-    minimal_tag = None
-    for occurrence in occurrences:
-        # Traverse the tree upwards to find the common ancestor
-        ancestor = occurrence.find_parent().find_parent().find_parent()
-        if minimal_tag is None or ancestor.find(minimal_tag):
-            minimal_tag = ancestor
+def normalize_url(url: str):
+    """
+    Normalizes a website url so that trivially different spellings of the
+    same page (case of the scheme/host, surrounding whitespace, fragments)
+    are treated as one page during a check run.
 
-    return minimal_tag
+    Parameters:
+    - url (str): The url entered by the user.
 
-def count_query_occurrences_and_hash(url: str, query_str: str):
+    Returns:
+    str: The normalized url.
+
+    Example:
+        >>> normalize_url(' HTTPS://WBPSC.gov.in/Notices#latest ')
+        'https://wbpsc.gov.in/Notices'
     """
-    Counts the occurrences of a query string on a webpage using Selenium and returns a hash of the minimal HTML tag.
+    parts = urlsplit(url.strip())
+    return urlunsplit(
+        (parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, '')
+    )
+
+
+# Query parameters added by mailers, ads and social sites; they never change the page.
+TRACKING_QUERY_PARAMS = frozenset(
+    ('fbclid', 'gclid', 'dclid', 'msclkid', 'yclid', 'igshid', 'mc_cid', 'mc_eid', '_ga', '_gl')
+)
+
+def canonicalize_url(url: str):
+    """
+    The canonical url of a webpage: the one key under which every spelling
+    users enter for it (http or https, with or without 'www.', a trailing
+    slash, tracking query params like 'utm_source', a fragment) is stored,
+    queued, cached and checked.
+
+    It is an identity, not necessarily an address to fetch: a host may only
+    answer on 'www.' or over http. Fetch one of the urls the users entered
+    (see `normalize_url`) instead.
 
     Parameters:
-    - url (str): The URL of the webpage to analyze.
-    - query_str (str): The query string to search for.
+    - url (str): The url entered by the user.
 
     Returns:
-    tuple: A tuple containing the number of occurrences of the query string and the hash of the minimal HTML tag.
+    str: The canonical url.
+
+    Example:
+        >>> canonicalize_url(' http://WWW.wbpsc.gov.in:80/Notices/?utm_source=mail&b=2&a=1#latest ')
+        'https://wbpsc.gov.in/Notices?a=1&b=2'
+    """
+    url = url.strip()
+    if '://' not in url:
+        url = 'http://' + url  # (Entered without a scheme, e.g. 'wbpsc.gov.in')
+    parts = urlsplit(url)
+
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').rstrip('.')
+    if host.startswith('www.'):
+        host = host[len('www.'):]
+    if ':' in host:
+        host = f"[{host}]"  # (An IPv6 address)
+    port = parts.port
+    default_port = {'http': 80, 'https': 443}.get(scheme)
+    if scheme in ('http', 'https'):
+        scheme = 'https'
+    netloc = host if port is None or port == default_port else f"{host}:{port}"
+
+    path = parts.path.rstrip('/') or '/'
+    query = urlencode(sorted(
+        (name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not name.lower().startswith('utm_') and name.lower() not in TRACKING_QUERY_PARAMS
+    ))
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+
+def fetch_page_source(url: str, pool=None, rate_limited=False, on_ready=None):
+    """
+    Fetches the rendered html of a webpage using a headless Chrome browser.
+
+    Parameters:
+    - url (str): The URL of the webpage.
+    - pool (BrowserPool, optional): The pool to borrow the browser from. If not
+      given, a new browser is started and quit for this page only.
+    - rate_limited (bool, optional): Whether the caller already took the host's
+      rate-limit token for this fetch.
+    - on_ready (callable, optional): Called right before the page starts loading
+      (i.e. after the wait for the host and for a browser).
+
+    Returns:
+    str: The page source of the webpage.
     """
+    # Be polite to the host (see `scripts.rate_limiter`)
+    if not rate_limited:
+        host_rate_limiter.wait(url)
+
+    if pool is not None:
+        return pool.fetch(url, on_ready=on_ready)
+
+    # Set up a headless Chrome browser
+    chrome_options = Options()
+    chrome_options.add_argument('--headless')
+    driver = webdriver.Chrome(options=chrome_options)
+    driver.set_page_load_timeout(fetch_timeouts.render)
+
     try:
-        # Set up a headless Chrome browser
-        chrome_options = Options()
-        chrome_options.add_argument('--headless')
-        driver = webdriver.Chrome(options=chrome_options)
+        if on_ready is not None:
+            on_ready()
 
         # Fetch the webpage
         driver.get(url)
@@ -262,25 +384,188 @@ def count_query_occurrences_and_hash(url: str, query_str: str):
         # Wait for some time to ensure dynamic content is loaded (you may need to adjust this)
         driver.implicitly_wait(5)
 
-        # # Find all occurrences of the query string on the page
-        # elements = driver.find_elements(By.XPATH, f"//*[contains(text(), '{query_str}')]")
-        # occurrences = len(elements)
+        return driver.page_source
 
-        # Extract HTML content from the current page
-        html_content = driver.page_source
-        occurrence_count = html_content.count(query_str)
+    finally:
+        # Close the browser
+        driver.quit()
 
-        # Parse the HTML content with Beautiful Soup
-        soup = BeautifulSoup(html_content, 'html.parser')
 
-        # Find the minimal HTML tag containing the query_str
-        minimal_tag = find_minimal_tag(soup=soup, query_str=query_str)
-        webpage_hash = sha256_hash(minimal_tag)
+def get_hash_scheme(fetch_mode: str):
+    """
+    Returns the scheme of the hashes computed from a page fetched with `fetch_mode`.
 
-        # Close the browser
-        driver.quit()
+    Example:
+        >>> get_hash_scheme('http')
+        'http/v3'
+    """
+    return f"{fetch_mode}/v{REGION_HASH_VERSION}"
 
-        return occurrence_count, webpage_hash
+
+# Markup that never shows in a region's hash: comments and the contents of
+# scripts and styles (see `ParsedPage.canonical_html`).
+_UNHASHED_MARKUP = re.compile(
+    r'<!--.*?-->|(<(script|style)\b[^>]*>).*?(</\2\s*>)', re.DOTALL | re.IGNORECASE
+)
+
+def raw_page_digest(html_content: str, query_strs, hash_scheme: str):
+    """
+    The digest of a page exactly as fetched, for the given query strings and
+    hash scheme: if it didn't change since the last check, neither did the
+    counts and hashes of the query strings.
+
+    Returns:
+    str: The hexadecimal SHA-256 digest.
+    """
+    header = '\n'.join([hash_scheme, *sorted(set(query_strs))])
+    return sha256_hash(f"{header}\n\n{html_content}")
+
+
+def text_page_digest(html_content: str, occurrence_counts: dict, hash_scheme: str):
+    """
+    The digest of a page's normalized text: its markup without the comments
+    and the script/style contents (unless they contain a query string, since
+    those are part of a region), with the whitespace collapsed (and dropped
+    between tags), along with
+    the occurrence counts of the query strings. What it leaves out never
+    changes a count or a region's hash, so a page whose digest didn't change
+    (e.g. only a timestamp in a script or the indentation did) needs no
+    parsing.
+
+    Parameters:
+    - html_content (str): The html of the webpage.
+    - occurrence_counts (dict): {query_str: count} on the page (see `MultiPatternMatcher.count`).
+    - hash_scheme (str): The scheme the regions are hashed with.
+
+    Returns:
+    str: The hexadecimal SHA-256 digest.
+    """
+    def strip(match):
+        if any(query_str in match.group(0) for query_str in occurrence_counts):
+            return match.group(0)
+        return (match.group(1) or '') + (match.group(3) or '')
+
+    text = ' '.join(_UNHASHED_MARKUP.sub(strip, html_content).split()).replace('> <', '><')
+    header = '\n'.join([hash_scheme, *(f"{query_str}={count}" for query_str, count in sorted(occurrence_counts.items()))])
+    return sha256_hash(f"{header}\n\n{text}")
+
+
+def _region_at(page, locator: str, query_str: str, occurrence_count: int):
+    """
+    The region of the query string on a page, looked for only in the subtree
+    at the `locator` where it was last time. None unless the subtree still
+    has all of its occurrences (then the region is the one a search of the
+    whole page would find).
+    """
+    node = page.find_locator(locator)
+    if node is None:
+        return None
+
+    nodes = []
+    found = 0
+    for text, text_node in page.iter_texts(node):
+        if query_str in text:
+            nodes.append(text_node)
+            found += text.count(query_str)
+
+    if not nodes or found != occurrence_count:
+        return None  # (Some occurrence lies elsewhere now)
+    return page.minimal_region(nodes)
+
+
+def hash_page_regions(html_content: str, query_strs, parser: str = 'html.parser',
+                      occurrence_counts: dict = None, locators: dict = None):
+    """
+    Counts the occurrences of every query string on an already fetched page and
+    hashes the minimal region around each of them. The page is parsed only once
+    and all query strings are matched together in a single pass (see
+    `MultiPatternMatcher`) no matter how many of them are given.
+
+    A query string with a `locator` (where its region was found last time)
+    is first looked for in that subtree only; the rest of the page is
+    searched only for the query strings not found there.
+
+    Parameters:
+    - html_content (str): The html of the webpage.
+    - query_strs (list): The query strings (advertisement numbers) to search for.
+    - parser (str, optional): The html parser to use (see `scripts.html_parser`).
+      Every parser gives the same counts and hashes.
+    - occurrence_counts (dict, optional): {query_str: count}, if already counted.
+    - locators (dict, optional): {query_str: locator} of the regions found last time.
+
+    Returns:
+    tuple: ({query_str: (occurrence_count, webpage_hash)}, {query_str: locator}
+           of the regions found, the number of regions found at their locator).
+           A query string not on the page gets `(0, None)`; one whose region
+           couldn't be hashed gets `(-1, None)`.
+    """
+    matcher = MultiPatternMatcher(query_strs)
+    if occurrence_counts is None:
+        occurrence_counts = matcher.count(html_content)
+    locators = locators or {}
+
+    # Parse the HTML content
+    page = parse_html(html_content, parser)
+
+    regions = {}
+    for query_str in matcher.patterns:
+        if locators.get(query_str) and occurrence_counts[query_str] > 0:
+            region = _region_at(page, locators[query_str], query_str, occurrence_counts[query_str])
+            if region is not None:
+                regions[query_str] = region
+    hits = len(regions)
+
+    missed = [query_str for query_str in matcher.patterns if query_str not in regions]
+    if missed:
+        text_nodes = MultiPatternMatcher(missed).find_text_nodes(page.iter_texts())
+
+    results = {}
+    found_locators = {}
+    for query_str in matcher.patterns:
+        if occurrence_counts[query_str] == 0 and not (missed and text_nodes[query_str]):
+            # Not on the page (e.g. the notice was taken down): no region to hash.
+            results[query_str] = (0, None)
+            continue
+        try:
+            # Find the minimal region containing the query_str
+            region = regions[query_str] if query_str in regions else page.minimal_region(text_nodes[query_str])
+            results[query_str] = (occurrence_counts[query_str], sha256_hash(page.canonical_html(region)))
+            found_locators[query_str] = page.locator(region)
+
+        except Exception as e:
+            results[query_str] = (-1, None)  # Error indicator
+
+    return results, found_locators, hits
+
+
+def count_and_hash_page(html_content: str, query_strs, parser: str = 'html.parser', occurrence_counts: dict = None):
+    """
+    Counts the occurrences of every query string on an already fetched page and
+    hashes the minimal region around each of them (see `hash_page_regions`).
+
+    Returns:
+    dict: {query_str: (occurrence_count, webpage_hash)}. A query string not
+          on the page gets `(0, None)`; one whose region couldn't be hashed
+          gets `(-1, None)`.
+    """
+    return hash_page_regions(html_content, query_strs, parser, occurrence_counts)[0]
+
+
+def count_query_occurrences_and_hash(url: str, query_str: str, pool=None):
+    """
+    Counts the occurrences of a query string on a webpage using Selenium and returns a hash of the minimal HTML tag.
+
+    Parameters:
+    - url (str): The URL of the webpage to analyze.
+    - query_str (str): The query string to search for.
+    - pool (BrowserPool, optional): The browser pool to render the page with.
+
+    Returns:
+    tuple: A tuple containing the number of occurrences of the query string and the hash of the minimal HTML tag.
+    """
+    try:
+        html_content = fetch_page_source(url, pool=pool)
+        return count_and_hash_page(html_content, [query_str])[query_str]
 
     except Exception as e:
         return -1, None  # Error indicator